@@ -7,30 +7,116 @@ function fetchApiBaseUrl() {
     return Promise.resolve();
 }
 
+// --- SESSION TOKENS ---
+// Issued by /api/login; admin endpoints require the access token
+let adminTokens = JSON.parse(sessionStorage.getItem('adminTokens') || 'null');
+
+function saveAdminTokens(data) {
+    adminTokens = data ? { access_token: data.access_token, refresh_token: data.refresh_token } : null;
+    if (adminTokens) {
+        sessionStorage.setItem('adminTokens', JSON.stringify(adminTokens));
+    } else {
+        sessionStorage.removeItem('adminTokens');
+    }
+}
+
+function showAdminLogin() {
+    saveAdminTokens(null);
+    document.getElementById('admin-dashboard').style.display = 'none';
+    document.getElementById('admin-login-modal').style.display = 'flex';
+}
+
+// fetch() with the access token; on 401 refreshes the tokens once and retries
+function adminFetch(url, options = {}, retried = false) {
+    const headers = Object.assign({}, options.headers);
+    if (adminTokens) headers['Authorization'] = `Bearer ${adminTokens.access_token}`;
+    return fetch(url, Object.assign({}, options, { headers })).then(res => {
+        if (res.status !== 401 || retried || !adminTokens) return res;
+        return fetch(`${API_BASE}/token/refresh`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ refresh_token: adminTokens.refresh_token })
+        })
+        .then(refreshRes => refreshRes.json())
+        .then(data => {
+            if (!data.success) {
+                showAdminLogin();
+                return res;
+            }
+            saveAdminTokens(data);
+            return adminFetch(url, options, true);
+        });
+    });
+}
+
 function fetchAndUpdateStats() {
     if (!API_BASE) {
         console.warn('API_BASE not loaded yet, skipping stats fetch');
         return;
     }
     
-    fetch(`${API_BASE}/resources`)
+    // One request for all dashboard totals; the browser revalidates it with the ETag
+    adminFetch(`${API_BASE}/admin/stats`)
         .then(res => res.json())
         .then(data => {
-            document.getElementById('stat-books').textContent = data.books.length;
-            document.getElementById('stat-papers').textContent = data.papers.length;
-            document.getElementById('stat-setbooks').textContent = data.setbooks.length;
+            if (data.error) return;
+            const byType = data.resources.by_type;
+            document.getElementById('stat-books').textContent = byType.book || 0;
+            document.getElementById('stat-papers').textContent = byType.paper || 0;
+            document.getElementById('stat-setbooks').textContent = byType.setbook || 0;
+            document.getElementById('stat-users').textContent = data.users.total;
         })
         .catch(error => {
             console.error('Failed to fetch stats:', error);
         });
-        
-    fetch(`${API_BASE}/users`)
+}
+
+function fetchAndRenderSales() {
+    if (!API_BASE) {
+        console.warn('API_BASE not loaded yet, skipping sales fetch');
+        return;
+    }
+    
+    const params = new URLSearchParams();
+    const from = document.getElementById('sales-from').value;
+    const to = document.getElementById('sales-to').value;
+    if (from) params.set('from', from);
+    if (to) params.set('to', to);
+    params.set('group', document.getElementById('sales-group').value);
+    
+    adminFetch(`${API_BASE}/admin/stats/sales?${params.toString()}`)
         .then(res => res.json())
         .then(data => {
-            document.getElementById('stat-users').textContent = data.count;
+            const summary = document.getElementById('sales-summary');
+            const table = document.getElementById('sales-table');
+            if (data.error) {
+                summary.textContent = data.error;
+                table.innerHTML = '';
+                return;
+            }
+            summary.textContent = `${data.from} to ${data.to}: ${data.totals.payments} payments, KES ${data.totals.amount.toFixed(2)}`;
+            if (!data.rows.length) {
+                table.innerHTML = '<p>No sales in this period.</p>';
+                return;
+            }
+            const header = data.group.map(g => `<th>${g}</th>`).join('');
+            const body = data.rows.map(row => `
+                <tr>
+                    ${data.group.map(g => `<td>${row[g] === null ? '-' : row[g]}</td>`).join('')}
+                    <td>${row.payments}</td>
+                    <td>${row.amount.toFixed(2)}</td>
+                    <td>${row.buyers}</td>
+                </tr>
+            `).join('');
+            table.innerHTML = `
+                <table class="sales-table">
+                    <thead><tr>${header}<th>Payments</th><th>Amount (KES)</th><th>Buyers</th></tr></thead>
+                    <tbody>${body}</tbody>
+                </table>
+            `;
         })
         .catch(error => {
-            console.error('Failed to fetch user count:', error);
+            console.error('Failed to fetch sales:', error);
         });
 }
 
@@ -65,7 +151,7 @@ function fetchAndRenderList(type, containerId) {
                 btn.addEventListener('click', function() {
                     const id = this.getAttribute('data-id');
                     if (confirm('Are you sure you want to delete this resource?')) {
-                        fetch(`${API_BASE}/resource/${id}`, {
+                        adminFetch(`${API_BASE}/resource/${id}`, {
                             method: 'DELETE'
                         })
                         .then(res => res.json())
@@ -206,7 +292,7 @@ function mainAdminInit() {
             }
             
             // Send to backend API
-            fetch(`${API_BASE}/upload`, {
+            adminFetch(`${API_BASE}/upload`, {
                 method: 'POST',
                 body: formData
             })
@@ -260,8 +346,10 @@ function mainAdminInit() {
             .then(res => res.json())
             .then(data => {
                 if (data.success) {
+                    saveAdminTokens(data);
                     adminLoginModal.style.display = 'none';
                     adminDashboard.style.display = '';
+                    fetchAndUpdateStats();
                 } else {
                     errorDiv.textContent = data.error || 'Login failed';
                 }
@@ -279,6 +367,14 @@ function mainAdminInit() {
     fetchAndRenderList('papers', 'papers-list');
     fetchAndRenderList('setbooks', 'setbooks-list');
 
+    const salesFilterForm = document.getElementById('sales-filter-form');
+    if (salesFilterForm) {
+        salesFilterForm.onsubmit = function(e) {
+            e.preventDefault();
+            fetchAndRenderSales();
+        };
+    }
+
     // Sidebar navigation
     document.querySelectorAll('.admin-menu a[data-section]').forEach(link => {
         link.addEventListener('click', function(e) {
@@ -294,6 +390,7 @@ function mainAdminInit() {
             if (section === 'books') fetchAndRenderList('books', 'books-list');
             if (section === 'papers') fetchAndRenderList('papers', 'papers-list');
             if (section === 'setbooks') fetchAndRenderList('setbooks', 'setbooks-list');
+            if (section === 'analytics') fetchAndRenderSales();
             if (section === 'upload') {
                 // Ensure upload form is visible and ready
                 if (classGradeSelect && subjectSelect && uploadForm) {
@@ -317,8 +414,14 @@ function mainAdminInit() {
     document.querySelectorAll('#admin-logout').forEach(logoutBtn => {
         logoutBtn.addEventListener('click', function(e) {
             e.preventDefault();
-            document.getElementById('admin-dashboard').style.display = 'none';
-            document.getElementById('admin-login-modal').style.display = 'flex';
+            if (adminTokens) {
+                adminFetch(`${API_BASE}/logout`, {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ refresh_token: adminTokens.refresh_token })
+                }).catch(error => console.error('Logout API error:', error));
+            }
+            showAdminLogin();
         });
     });
 
@@ -331,7 +434,7 @@ function mainAdminInit() {
             const newPassword = document.getElementById('new-password').value;
             const msgDiv = document.getElementById('settings-message');
             msgDiv.textContent = '';
-            fetch(`${API_BASE}/change_password`, {
+            adminFetch(`${API_BASE}/change_password`, {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({
@@ -343,6 +446,8 @@ function mainAdminInit() {
             .then(res => res.json())
             .then(data => {
                 if (data.success) {
+                    // Other sessions were signed out; keep this one with the new tokens
+                    saveAdminTokens(data);
                     msgDiv.textContent = 'Password updated successfully!';
                     msgDiv.style.color = 'green';
                     settingsForm.reset();
@@ -1,69 +1,216 @@
-from flask import Flask, request, jsonify, send_file, abort
+from flask import Blueprint, Flask, Response, current_app, g, request, jsonify, send_file, abort, stream_with_context
 from flask_cors import CORS
-from models import db, Resource, User, Payment
-from config import Config
-import requests
+from models import db, normalize_identifier, MigrationCheckpoint, PAYMENT_STATUS_CODES, Resource, User, UserIdentifier, Payment
+from config import config_profile
+from database import configure_database, configure_sqlite, dispose_engines_after_fork, read_replica, replica_router
+from idempotency import idempotent, purge_expired_keys
+from circuit_breaker import CircuitBreaker, Bulkhead, BulkheadFullError, CircuitOpenError, GatewayUnavailableError
+from password_hashing import HashingBusyError, password_hasher
+from auth_tokens import REFRESH, TokenError, admin_required, purge_expired_revocations, session_tokens
+from rate_limit import rate_limiter
+from logging_config import configure_logging
+from metrics import metrics
+from tracing import CLIENT, tracer
+from sql_profiler import sql_profiler
+from profiling import ProfilerBusyError, cpu_profiler, memory_profiler
+from rollups import GROUP_COLUMNS, record_payment_change, rebuild_rollups, sales_report
+from counters import count_payment_change, counter_value, dashboard_stats, rebuild_counters, stats_etag
+from archive import archive_payments
+from jobs import job_runner
+from outbox import outbox
+from health import readiness, warmup
+from exports import (EXPORT_FORMATS, PAYMENT_COLUMNS, RESOURCE_COLUMNS, export_chunks, gzip_chunks,
+                     payment_rows, resource_rows, write_export)
 import os
 import logging
-import uuid
-from datetime import datetime
-from flask_migrate import Migrate
+from datetime import datetime, timedelta
+from flask.cli import AppGroup
+from sqlalchemy import inspect
+from sqlalchemy.orm import selectinload
+from sqlalchemy.exc import IntegrityError
+import click
 import time
-import random
 import json
+import threading
 import re
+import signal
+from urllib.parse import urlencode
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('app.log')
-    ]
-)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-app.config.from_object(Config)
-CORS(app)
-db.init_app(app)
-migrate = Migrate(app, db)
-
-def ensure_admin_user():
-    admin = User.query.filter_by(username='admin').first()
-    if not admin:
-        admin = User(username='admin', email='admin@somafy.co.ke')
-        admin.set_password('admin123')
-        db.session.add(admin)
-        db.session.commit()
-        logger.info("Admin user created")
+api = Blueprint('api', __name__, cli_group=None)
+
+# Alembic revisions live next to backend/, whichever directory flask runs from
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+
+def init_migrate(app):
+    """Set up Flask-Migrate (and import Alembic) on first use; this also adds ``flask db``."""
+    if 'migrate' not in app.extensions:
+        from flask_migrate import Migrate
+        Migrate(app, db, directory=MIGRATIONS_DIR)
+
+class AppCommands(AppGroup):
+    """``app.cli`` that sets up Flask-Migrate, and imports Alembic, only when ``flask db`` runs."""
+
+    def get_command(self, ctx, name):
+        if name == 'db' and name not in self.commands:
+            init_migrate(current_app)
+        return super().get_command(ctx, name)
+
+    def list_commands(self, ctx):
+        return sorted({*super().list_commands(ctx), 'db'})
+
+# Guards around the PesaPal gateway, one set per worker process (built by create_app)
+pesapal_breaker = None
+pesapal_bulkhead = None
+
+def create_app(config_object=None, **overrides):
+    """Build and configure the Flask app.
+
+    ``config_object`` defaults to the profile named by ``APP_CONFIG`` (see
+    config.py); ``overrides`` are applied on top, e.g. a test database URI.
+    Nothing touches the database here: create the schema and the admin user
+    with ``flask --app app init-db`` and ``create-admin``.
+    """
+    global pesapal_breaker, pesapal_bulkhead
+    app = Flask(__name__)
+    app.cli = AppCommands(app.name)
+    app.config.from_object(config_object or config_profile())
+    app.config.update(overrides)
+    configure_logging(app.config)
+    CORS(app)
+    configure_database(app)
+    db.init_app(app)
+    configure_sqlite(app, db)
+    dispose_engines_after_fork(app, db)
+    replica_router.init_app(app, db)
+    tracer.init_app(app)
+    metrics.init_app(app)
+    sql_profiler.init_app(app, db)
+    password_hasher.init_app(app)
+    session_tokens.init_app(app)
+    rate_limiter.init_app(app)
+    cpu_profiler.init_app(app)
+    memory_profiler.init_app(app)
+    job_runner.init_app(app)
+    outbox.init_app(app)
+    warmup.init_app(app)
+
+    pesapal_breaker = CircuitBreaker.from_config('pesapal', app.config, 'PESAPAL')
+    pesapal_bulkhead = Bulkhead(
+        'pesapal',
+        app.config['PESAPAL_MAX_CONCURRENT_CALLS'],
+        app.config['PESAPAL_BULKHEAD_TIMEOUT']
+    )
+    app.register_blueprint(api)
+    return app
+
+def create_schema():
+    """Create any missing tables. Returns True when the database was empty.
+
+    An empty database gets the current schema and is stamped with the latest
+    migration, so later ``flask db upgrade`` runs apply only newer revisions.
+    """
+    empty = not inspect(db.engine).get_table_names()
+    db.create_all()
+    if empty:
+        from flask_migrate import stamp
+        init_migrate(current_app)
+        stamp()
+    return empty
+
+def ensure_admin_user(username, email, password):
+    """Create the admin account unless a user with ``username`` exists; returns True if created."""
+    admin = User.query.filter_by(username=username).first()
+    if admin:
+        return False
+    admin = User(username=username, email=email)
+    admin.set_password(password)
+    db.session.add(admin)
+    db.session.commit()
+    logger.info("Admin user created")
+    return True
+
+def pesapal_post(url, **kwargs):
+    """POST to PesaPal through the bulkhead and circuit breaker, recording its latency.
+
+    The call runs in a client span and sends ``traceparent`` along. Raises
+    ``GatewayUnavailableError`` without making the call when the circuit is
+    open or too many calls are already in flight.
+    """
+    import requests  # imported on first use, it's slow to load
+
+    timeout = (current_app.config['PESAPAL_CONNECT_TIMEOUT'], current_app.config['PESAPAL_READ_TIMEOUT'])
+    operation = url.rstrip('/').rsplit('/', 1)[-1]
+    with tracer.span(f"PesaPal {operation}", CLIENT, **{'http.method': 'POST', 'http.url': url}) as span:
+        kwargs['headers'] = tracer.inject(kwargs.get('headers'))
+        started = time.perf_counter()
+        try:
+            with pesapal_bulkhead:
+                resp = pesapal_breaker.call(
+                    requests.post, url, timeout=timeout,
+                    is_failure=lambda resp: resp.status_code >= 500,
+                    **kwargs
+                )
+        except CircuitOpenError:
+            metrics.count_pesapal_rejection(operation, 'circuit_open')
+            raise
+        except BulkheadFullError:
+            metrics.count_pesapal_rejection(operation, 'bulkhead_full')
+            raise
+        except Exception:
+            metrics.observe_pesapal_call(operation, time.perf_counter() - started)
+            raise
+        else:
+            metrics.observe_pesapal_call(operation, time.perf_counter() - started, resp)
+            span.set_attribute('http.status_code', resp.status_code)
+            return resp
+        finally:
+            metrics.set_breaker_state(pesapal_breaker.state)
+
+def gateway_unavailable_response(error):
+    """Fast-fail 503 for calls rejected by the PesaPal circuit breaker or bulkhead"""
+    response = jsonify({'error': 'Payment service temporarily unavailable, please try again shortly'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+# PesaPal tokens last five minutes; each worker reuses one until shortly before then
+_pesapal_token = {'key': None, 'value': None, 'expires_at': 0.0}
+_pesapal_token_lock = threading.Lock()
+
+def get_pesapal_token(refresh=False):
+    """PesaPal access token, cached for PESAPAL_TOKEN_TTL seconds; ``refresh`` always asks for a new one"""
+    config = current_app.config
+    key = (config['PESAPAL_BASE_URL'], config['PESAPAL_CONSUMER_KEY'])
+    # Held while fetching, so concurrent checkouts wait for one token request instead of each making one
+    with _pesapal_token_lock:
+        if not refresh and _pesapal_token['key'] == key and time.monotonic() < _pesapal_token['expires_at']:
+            return _pesapal_token['value']
+        token = request_pesapal_token()
+        _pesapal_token.update(key=key, value=token, expires_at=time.monotonic() + config['PESAPAL_TOKEN_TTL'])
+        return token
 
-def get_pesapal_token():
+def request_pesapal_token():
     """Get PesaPal access token"""
+    import requests
     try:
         logger.info("=== PESAPAL TOKEN REQUEST START ===")
-        auth_url = f"{app.config['PESAPAL_BASE_URL']}/Auth/RequestToken"
+        auth_url = f"{current_app.config['PESAPAL_BASE_URL']}/Auth/RequestToken"
         
         auth_data = {
-            'consumer_key': app.config['PESAPAL_CONSUMER_KEY'],
-            'consumer_secret': app.config['PESAPAL_CONSUMER_SECRET']
+            'consumer_key': current_app.config['PESAPAL_CONSUMER_KEY'],
+            'consumer_secret': current_app.config['PESAPAL_CONSUMER_SECRET']
         }
         
-        logger.info(f"Auth URL: {auth_url}")
-        logger.info(f"Consumer key exists: {bool(app.config['PESAPAL_CONSUMER_KEY'])}")
-        logger.info(f"Consumer secret exists: {bool(app.config['PESAPAL_CONSUMER_SECRET'])}")
+        logger.debug(f"Auth URL: {auth_url}, timeout: {current_app.config['PESAPAL_CONNECT_TIMEOUT']}s connect, "
+                     f"{current_app.config['PESAPAL_READ_TIMEOUT']}s read")
         
-        # Log request details (without exposing secrets)
-        logger.info(f"Request method: POST")
-        logger.info(f"Request headers: Content-Type: application/json")
-        logger.info(f"Request timeout: 30 seconds")
-        
-        auth_resp = requests.post(auth_url, json=auth_data, timeout=30)
+        auth_resp = pesapal_post(auth_url, json=auth_data)
         
+        # The body carries the access token; never log it
         logger.info(f"PesaPal auth response status: {auth_resp.status_code}")
-        logger.info(f"PesaPal auth response headers: {dict(auth_resp.headers)}")
-        logger.info(f"PesaPal auth response body: {auth_resp.text}")
+        logger.debug(f"PesaPal auth response headers: {dict(auth_resp.headers)}")
         
         if not auth_resp.ok:
             error_details = {
@@ -98,6 +245,9 @@ def get_pesapal_token():
         logger.info("=== PESAPAL TOKEN REQUEST END ===")
         return access_token
         
+    except GatewayUnavailableError as e:
+        logger.warning(f"PesaPal authentication skipped: {str(e)}")
+        raise
     except requests.exceptions.Timeout:
         logger.error("PesaPal authentication request timed out")
         raise Exception("PesaPal authentication request timed out")
@@ -111,12 +261,62 @@ def get_pesapal_token():
         logger.error(f"Unexpected error getting PesaPal token: {str(e)}")
         raise e
 
+CROCKFORD_BASE32 = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+_order_id_lock = threading.Lock()
+_last_order_id = [0, 0]  # [timestamp_ms, randomness] of the previous ID
+
 def generate_unique_order_id():
-    """Generate a unique order tracking ID"""
-    return str(uuid.uuid4())
+    """Generate a unique, time-sortable order tracking ID.
+
+    The suffix is a ULID: 48 bits of millisecond timestamp followed by 80
+    random bits, Crockford base32 encoded, so IDs sort by creation time and
+    do not collide across workers. IDs generated in the same millisecond by
+    this process increment the random part, keeping them strictly ordered.
+    """
+    with _order_id_lock:
+        timestamp_ms = int(time.time() * 1000)
+        if timestamp_ms <= _last_order_id[0] and _last_order_id[1] < (1 << 80) - 1:
+            timestamp_ms = _last_order_id[0]
+            randomness = _last_order_id[1] + 1
+        else:
+            randomness = int.from_bytes(os.urandom(10), 'big')
+        _last_order_id[:] = [timestamp_ms, randomness]
+    value = (timestamp_ms << 80) | randomness
+    chars = []
+    for _ in range(26):
+        value, index = divmod(value, 32)
+        chars.append(CROCKFORD_BASE32[index])
+    return f"ORDER_{''.join(reversed(chars))}"
+
+def download_url(resource_id, email, order_tracking_id):
+    """The page where a buyer downloads what they paid for"""
+    query = urlencode({'resource_id': resource_id, 'email': email, 'orderTrackingId': order_tracking_id})
+    return f"{current_app.config['DOWNLOAD_URL']}?{query}"
+
+def queue_payment_receipt(payment, transaction_tracking_id):
+    """Queue the buyer's receipt and the payment.completed webhook; they commit with the payment"""
+    resource = db.session.get(Resource, payment.resource_id)
+    title = resource.title if resource else f"resource {payment.resource_id}"
+    outbox.send_mail(
+        payment.user_email,
+        f"Your receipt for {title}",
+        f"Thank you for your purchase.\n\n"
+        f"Item: {title}\n"
+        f"Amount: {payment.currency or 'KES'} {payment.amount:.2f}\n"
+        f"Order: {payment.order_tracking_id}\n\n"
+        f"Download it here: {download_url(payment.resource_id, payment.user_email, payment.order_tracking_id)}\n"
+    )
+    outbox.send_webhook('payment.completed', {
+        'order_tracking_id': payment.order_tracking_id,
+        'transaction_tracking_id': transaction_tracking_id,
+        'resource_id': payment.resource_id,
+        'email': payment.user_email,
+        'amount': payment.amount,
+        'currency': payment.currency or 'KES',
+    })
 
 def create_payment_record(order_tracking_id, resource_id, user_email, amount, status='PENDING'):
-    """Create a payment record"""
+    """Create a payment record; one created COMPLETED commits with its receipt queued"""
     try:
         payment = Payment(
             order_tracking_id=order_tracking_id,
@@ -126,6 +326,11 @@ def create_payment_record(order_tracking_id, resource_id, user_email, amount, st
             status=status
         )
         db.session.add(payment)
+        db.session.flush()
+        record_payment_change(payment, new_status=status)
+        count_payment_change(payment, new_status=status)
+        if status == 'COMPLETED':
+            queue_payment_receipt(payment, transaction_tracking_id=None)
         db.session.commit()
         logger.info(f"Payment record created successfully: {order_tracking_id}")
         return payment
@@ -134,6 +339,15 @@ def create_payment_record(order_tracking_id, resource_id, user_email, amount, st
         db.session.rollback()
         raise
 
+@api.app_errorhandler(HashingBusyError)
+def handle_hashing_busy(error):
+    """Fast rejection when the password hashing queue is full"""
+    db.session.rollback()
+    response = jsonify({'success': False, 'error': 'Server is busy, please try again shortly'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
 def is_strong_password(password):
     """Check if password meets strength requirements"""
     if len(password) < 8:
@@ -146,11 +360,32 @@ def is_strong_password(password):
         return False
     return True
 
-@app.route('/')
+def parse_date_arg(name, default=None):
+    """Read a YYYY-MM-DD query parameter; raises ValueError when malformed"""
+    value = request.args.get(name)
+    if not value:
+        return default
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+@api.route('/')
 def index():
     return "Welcome to the Books Management System API!"
 
-@app.route('/admin')
+@api.route('/healthz')
+def healthz():
+    """Liveness: the process is up and serving requests; checks nothing else"""
+    return jsonify({'status': 'ok'})
+
+@api.route('/readyz')
+def readyz():
+    """Readiness: database reachable, schema at the latest migration, warmup finished"""
+    ready, checks = readiness(MIGRATIONS_DIR)
+    response = jsonify({'status': 'ready' if ready else 'not ready', 'checks': checks})
+    response.status_code = 200 if ready else 503
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@api.route('/admin')
 def admin_dashboard():
     """Serve the admin dashboard"""
     try:
@@ -163,7 +398,7 @@ def admin_dashboard():
         logger.error(f"Error serving admin dashboard: {str(e)}")
         return "Error serving admin dashboard", 500
 
-@app.route('/admin/<path:filename>')
+@api.route('/admin/<path:filename>')
 def admin_static(filename):
     """Serve admin static files (CSS, JS, images)"""
     try:
@@ -182,7 +417,7 @@ def admin_static(filename):
         logger.error(f"Error serving admin static file {filename}: {str(e)}")
         return "Error serving file", 500
 
-@app.route('/user')
+@api.route('/user')
 def user_dashboard():
     """Serve the user dashboard"""
     try:
@@ -195,7 +430,7 @@ def user_dashboard():
         logger.error(f"Error serving user dashboard: {str(e)}")
         return "Error serving user dashboard", 500
 
-@app.route('/user/<path:filename>')
+@api.route('/user/<path:filename>')
 def user_static(filename):
     """Serve user static files (CSS, JS, images)"""
     try:
@@ -214,7 +449,8 @@ def user_static(filename):
         logger.error(f"Error serving user static file {filename}: {str(e)}")
         return "Error serving file", 500
 
-@app.route('/api/upload', methods=['POST'])
+@api.route('/api/upload', methods=['POST'])
+@admin_required
 def upload_resource():
     resource_type = request.form.get('resourceType')
     class_grade = request.form.get('classGrade')
@@ -246,7 +482,16 @@ def upload_resource():
     db.session.commit()
     return jsonify({'success': True, 'id': resource.id})
 
-@app.route('/api/resources', methods=['GET'])
+def featured_resources():
+    """The front page's featured lists: a few books, papers and setbooks"""
+    return {
+        'books': Resource.query.filter_by(resource_type='book').limit(3).all(),
+        'papers': Resource.query.filter_by(resource_type='paper').limit(2).all(),
+        'setbooks': Resource.query.filter_by(resource_type='setbook').limit(2).all(),
+    }
+
+@api.route('/api/resources', methods=['GET'])
+@read_replica
 def get_resources():
     try:
         # Get query parameters for filtering
@@ -277,25 +522,20 @@ def get_resources():
         
         # Only show limited resources if no filters are applied
         if not selected_class and not selected_subject:
-            books = Resource.query.filter_by(resource_type='book').limit(3).all()
-            papers = Resource.query.filter_by(resource_type='paper').limit(2).all()
-            setbooks = Resource.query.filter_by(resource_type='setbook').limit(2).all()
+            featured = featured_resources()
         else:
-            books = []
-            papers = []
-            setbooks = []
+            featured = {'books': [], 'papers': [], 'setbooks': []}
         
         return jsonify({
             'all': [r.to_dict() for r in all_resources],  # New filtered results
-            'books': [b.to_dict() for b in books],
-            'papers': [p.to_dict() for p in papers],
-            'setbooks': [s.to_dict() for s in setbooks]
+            **{name: [r.to_dict() for r in resources] for name, resources in featured.items()}
         })
     except Exception as e:
         logger.error(f"Error fetching resources: {str(e)}")
         return jsonify({'error': f'Failed to fetch resources: {str(e)}'}), 500
 
-@app.route('/api/resource/<int:resource_id>', methods=['DELETE'])
+@api.route('/api/resource/<int:resource_id>', methods=['DELETE'])
+@admin_required
 def delete_resource(resource_id):
     try:
         resource = Resource.query.get(resource_id)
@@ -310,7 +550,7 @@ def delete_resource(resource_id):
         logger.error(f"Error deleting resource {resource_id}: {str(e)}")
         return jsonify({'success': False, 'error': f'Failed to delete resource: {str(e)}'}), 500
 
-@app.route('/api/register', methods=['POST'])
+@api.route('/api/register', methods=['POST'])
 def register():
     data = request.json
     if not data or not data.get('username') or not data.get('email') or not data.get('password'):
@@ -329,9 +569,14 @@ def register():
             'error': 'Password must be at least 8 characters with uppercase, lowercase, and numbers'
         }), 400
     
+    # Admin rights go with these names, so only `flask create-admin` may take them
+    reserved = {normalize_identifier(name) for name in current_app.config['ADMIN_USERNAMES']}
+    if reserved & {normalize_identifier(username), normalize_identifier(email)}:
+        logger.warning(f"Registration with a reserved admin name refused: {username}")
+        return jsonify({'success': False, 'error': 'Username is reserved'}), 400
+    
     # Check if user already exists
-    existing_user = User.query.filter((User.username == username) | (User.email == email)).first()
-    if existing_user:
+    if UserIdentifier.taken(username, email):
         logger.warning(f"User already exists: {username} or {email}")
         return jsonify({'success': False, 'error': 'Username or email already exists'}), 400
     
@@ -339,20 +584,22 @@ def register():
     user = User(username=username, email=email)
     user.set_password(password)
     
-    logger.info(f"Password hash generated: {bool(user.password_hash)}")
-    logger.info(f"Password hash length: {len(user.password_hash) if user.password_hash else 0}")
-    
     try:
         db.session.add(user)
         db.session.commit()
         logger.info(f"User registered successfully: {username} (ID: {user.id})")
         return jsonify({'success': True})
+    except IntegrityError:
+        # Lost a race with another registration for the same name or email
+        db.session.rollback()
+        logger.warning(f"User already exists: {username} or {email}")
+        return jsonify({'success': False, 'error': 'Username or email already exists'}), 400
     except Exception as e:
         db.session.rollback()
         logger.error(f"Error registering user: {str(e)}")
         return jsonify({'success': False, 'error': 'Failed to register user'}), 500
 
-@app.route('/api/login', methods=['POST'])
+@api.route('/api/login', methods=['POST'])
 def login():
     data = request.json
     if not data or not data.get('username') or not data.get('password'):
@@ -364,30 +611,46 @@ def login():
     logger.info(f"Login attempt for username: {username}")
     
     # Find user by username or email
-    user = User.query.filter((User.username == username) | (User.email == username)).first()
+    user = User.find_by_login(username)
     
     if not user:
         logger.warning(f"User not found: {username}")
         return jsonify({'success': False, 'error': 'Invalid credentials'}), 401
     
     logger.info(f"User found: {username} (ID: {user.id})")
-    logger.info(f"Password hash exists: {bool(user.password_hash)}")
     
     # Check password
     password_valid = user.check_password(password)
-    logger.info(f"Password check result: {password_valid}")
+    logger.debug(f"Password check result: {password_valid}")
     
     if password_valid:
         logger.info(f"Login successful for user: {username}")
-        return jsonify({'success': True, 'user': {'id': user.id, 'username': user.username, 'email': user.email}})
+        
+        # Upgrade hashes made with an older algorithm or cost while we have the password
+        if user.password_needs_rehash():
+            try:
+                user.set_password(password)
+                db.session.commit()
+                logger.info(f"Password hash upgraded for user: {username}")
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"Could not upgrade password hash for user {username}: {str(e)}")
+        return jsonify({
+            'success': True,
+            'user': {'id': user.id, 'username': user.username, 'email': user.email},
+            **session_tokens.issue_pair(user)
+        })
     else:
         logger.warning(f"Invalid password for user: {username}")
         return jsonify({'success': False, 'error': 'Invalid credentials'}), 401
 
-@app.route('/api/change_password', methods=['POST'])
+@api.route('/api/change_password', methods=['POST'])
 def change_password():
+    if g.auth_error:
+        return jsonify({'success': False, 'error': g.auth_error}), 401
     data = request.json
-    if not data or not data.get('username') or not data.get('old_password') or not data.get('new_password'):
+    # With an access token the user comes from the token; otherwise from 'username'
+    if not data or not (g.current_user or data.get('username')) or not data.get('old_password') or not data.get('new_password'):
         return jsonify({'success': False, 'error': 'Missing fields'}), 400
     
     # Check password strength
@@ -397,52 +660,296 @@ def change_password():
             'error': 'Password must be at least 8 characters with uppercase, lowercase, and numbers'
         }), 400
     
-    user = User.query.filter_by(username=data['username']).first()
+    if g.current_user:
+        user = db.session.get(User, g.current_user.id)
+    else:
+        user = User.find_by_login(data['username'])
     if not user or not user.check_password(data['old_password']):
         return jsonify({'success': False, 'error': 'Old password is incorrect'}), 401
     
     user.set_password(data['new_password'])
+    # Sign out every existing session; the caller gets fresh tokens
+    session_tokens.revoke_user(user.id)
     db.session.commit()
+    return jsonify({'success': True, **session_tokens.issue_pair(user)})
+
+@api.route('/api/token/refresh', methods=['POST'])
+def refresh_token():
+    """Exchange a refresh token for a new access/refresh token pair"""
+    data = request.get_json(silent=True) or {}
+    if not data.get('refresh_token'):
+        return jsonify({'success': False, 'error': 'Missing refresh_token'}), 400
+    try:
+        claims = session_tokens.verify(data['refresh_token'], REFRESH)
+    except TokenError as e:
+        return jsonify({'success': False, 'error': str(e)}), 401
+    
+    user = db.session.get(User, claims.id)
+    if not user:
+        return jsonify({'success': False, 'error': 'Invalid token'}), 401
+    
+    # Refresh tokens are single use. The revocation row is the claim: a replay
+    # loses on its unique token id in any worker, before the worker's
+    # revocation cache has caught up
+    session_tokens.revoke(claims)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        logger.warning(f"Refresh token replayed for user {claims.id}")
+        return jsonify({'success': False, 'error': 'Token revoked'}), 401
+    return jsonify({'success': True, **session_tokens.issue_pair(user)})
+
+@api.route('/api/logout', methods=['POST'])
+def logout():
+    """Revoke the caller's access token and, if given, its refresh token"""
+    data = request.get_json(silent=True) or {}
+    tokens = [g.current_user] if g.current_user else []
+    if data.get('refresh_token'):
+        try:
+            tokens.append(session_tokens.verify(data['refresh_token'], REFRESH))
+        except TokenError:
+            pass
+    for token in tokens:
+        session_tokens.revoke(token)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()  # revoked already, by another worker
     return jsonify({'success': True})
 
-@app.route('/api/reset_password', methods=['POST'])
+@api.route('/api/reset_password', methods=['POST'])
 def reset_password():
     data = request.json
     email = data.get('email')
     if not email:
         return jsonify({'success': False, 'error': 'Missing email'}), 400
     
-    user = User.query.filter_by(email=email).first()
+    user = User.find_by_login(email, kind='email')
     if not user:
         return jsonify({'success': False, 'error': 'User not found'}), 404
     
-    # Implement actual password reset logic here
-    # (Send email with reset token, etc.)
+    # Queued in the outbox and sent by the job worker, so SMTP doesn't slow this request
+    link = f"{current_app.config['PASSWORD_RESET_URL']}?{urlencode({'token': session_tokens.issue_reset(user)})}"
+    outbox.send_mail(
+        user.email,
+        'Reset your password',
+        f"Hello {user.username},\n\n"
+        f"Use this link to choose a new password. It works once and expires in "
+        f"{current_app.config['PASSWORD_RESET_TTL'] // 60} minutes:\n\n{link}\n\n"
+        f"If you didn't ask to reset your password, you can ignore this mail.\n"
+    )
+    db.session.commit()
     
     return jsonify({'success': True, 'message': 'Password reset instructions sent'})
 
-@app.route('/api/users', methods=['GET'])
+@api.route('/api/reset_password/confirm', methods=['POST'])
+def confirm_password_reset():
+    """Set a new password with the token from a reset mail"""
+    data = request.get_json(silent=True) or {}
+    if not data.get('token') or not data.get('new_password'):
+        return jsonify({'success': False, 'error': 'Missing fields'}), 400
+    if not is_strong_password(data['new_password']):
+        return jsonify({
+            'success': False,
+            'error': 'Password must be at least 8 characters with uppercase, lowercase, and numbers'
+        }), 400
+    try:
+        user = session_tokens.verify_reset(data['token'])
+    except TokenError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    user.set_password(data['new_password'])
+    # Sign out every existing session; the caller gets fresh tokens
+    session_tokens.revoke_user(user.id)
+    db.session.commit()
+    logger.info(f"Password reset for user: {user.username}")
+    return jsonify({'success': True, **session_tokens.issue_pair(user)})
+
+@api.route('/api/users', methods=['GET'])
+@read_replica
 def get_user_count():
-    count = User.query.count()
+    count = counter_value('users', 'total')
     return jsonify({'count': count})
 
-@app.route('/api/debug/pesapal-config', methods=['GET'])
+@api.route('/api/admin/stats', methods=['GET'])
+@admin_required
+@read_replica
+def admin_stats():
+    """Dashboard totals from the maintained counters; revalidate with If-None-Match"""
+    stats = dashboard_stats()
+    etag = stats_etag(stats)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(stats)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@api.route('/api/admin/stats/sales', methods=['GET'])
+@admin_required
+@read_replica
+def sales_stats():
+    """Sales totals from the daily rollups, e.g. ?from=2025-01-01&to=2025-01-31&group=day,status"""
+    try:
+        today = datetime.utcnow().date()
+        start = parse_date_arg('from', today - timedelta(days=29))
+        end = parse_date_arg('to', today)
+    except ValueError:
+        return jsonify({'error': 'from and to must be dates in YYYY-MM-DD format'}), 400
+    if start > end:
+        return jsonify({'error': 'from must not be after to'}), 400
+    
+    group_by = [name.strip() for name in request.args.get('group', 'day').split(',') if name.strip()]
+    unknown = [name for name in group_by if name not in GROUP_COLUMNS]
+    if unknown:
+        return jsonify({'error': f"Unknown group: {', '.join(unknown)}. Use any of: {', '.join(GROUP_COLUMNS)}"}), 400
+    
+    try:
+        rows = sales_report(start, end, group_by, status=request.args.get('status'))
+        return jsonify({
+            'from': start.isoformat(),
+            'to': end.isoformat(),
+            'group': group_by,
+            'rows': rows,
+            'totals': {
+                'payments': sum(r['payments'] for r in rows),
+                'amount': sum(r['amount'] for r in rows)
+            }
+        })
+    except Exception as e:
+        logger.error(f"Error building sales report: {str(e)}")
+        return jsonify({'error': f'Failed to build sales report: {str(e)}'}), 500
+
+def export_response(chunks, fmt, name):
+    """Stream an export, gzip-compressed on the fly when the client accepts it"""
+    headers = {
+        'Content-Disposition': f'attachment; filename={name}-{datetime.utcnow():%Y%m%d}.{fmt}',
+        'Cache-Control': 'no-store',
+        'Vary': 'Accept-Encoding'
+    }
+    if request.args.get('gzip') == '1' or 'gzip' in request.headers.get('Accept-Encoding', ''):
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(chunks), mimetype=EXPORT_FORMATS[fmt], headers=headers)
+
+@api.route('/api/admin/export/payments', methods=['GET'])
+@admin_required
+@read_replica
+def export_payments():
+    """Stream payments as CSV or NDJSON, e.g. ?from=2025-01-01&to=2025-01-31&status=COMPLETED&format=csv"""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unknown format: {fmt}. Use one of: {', '.join(EXPORT_FORMATS)}"}), 400
+    try:
+        start = parse_date_arg('from')
+        end = parse_date_arg('to')
+    except ValueError:
+        return jsonify({'error': 'from and to must be dates in YYYY-MM-DD format'}), 400
+    
+    status = request.args.get('status')
+    if status and status not in PAYMENT_STATUS_CODES:
+        return jsonify({'error': f"Unknown status: {status}. Use one of: {', '.join(PAYMENT_STATUS_CODES)}"}), 400
+    
+    rows = payment_rows(start, end, status=status, resource_id=request.args.get('resource_id', type=int))
+    logger.info(f"Payment export started: from={start} to={end} status={status} format={fmt}")
+    return export_response(export_chunks(rows, PAYMENT_COLUMNS, fmt), fmt, 'payments')
+
+@api.route('/api/admin/export/resources', methods=['GET'])
+@admin_required
+@read_replica
+def export_resources():
+    """Stream resources as CSV or NDJSON, e.g. ?type=book&class=form1&format=ndjson"""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unknown format: {fmt}. Use one of: {', '.join(EXPORT_FORMATS)}"}), 400
+    
+    rows = resource_rows(resource_type=request.args.get('type'), class_grade=request.args.get('class'),
+                         subject=request.args.get('subject'))
+    return export_response(export_chunks(rows, RESOURCE_COLUMNS, fmt), fmt, 'resources')
+
+@api.route('/api/admin/profile/cpu', methods=['POST'])
+@admin_required
+def start_cpu_profile():
+    """Sample this worker's stacks, e.g. ?seconds=30&interval_ms=5; ?wait=true returns the folded stacks"""
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval = float(request.args['interval_ms']) / 1000.0 if 'interval_ms' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'seconds and interval_ms must be numbers'}), 400
+    include_idle = request.args.get('idle', 'false').lower() == 'true'
+    try:
+        path = cpu_profiler.start(seconds, interval, include_idle)
+    except ProfilerBusyError as e:
+        return jsonify({'error': str(e)}), 409
+    if request.args.get('wait', 'false').lower() == 'true':
+        cpu_profiler.join()
+        return send_file(path, mimetype='text/plain', as_attachment=True)
+    return jsonify({'pid': os.getpid(), 'profile': os.path.basename(path), 'seconds': seconds}), 202
+
+@api.route('/api/admin/profile/cpu', methods=['GET'])
+@admin_required
+def list_cpu_profiles():
+    """Finished CPU profiles from every worker, newest first"""
+    return jsonify({'profiles': cpu_profiler.profiles(), 'running_in_this_worker': cpu_profiler.running})
+
+@api.route('/api/admin/profile/cpu/<name>', methods=['GET'])
+@admin_required
+def download_cpu_profile(name):
+    """Download a collapsed-stack profile for flamegraph.pl or speedscope"""
+    path = cpu_profiler.profile_path(name)
+    if path is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    return send_file(path, mimetype='text/plain', as_attachment=True)
+
+@api.route('/api/admin/profile/memory', methods=['POST'])
+@admin_required
+def start_memory_profile():
+    """Start tracemalloc in this worker and take the baseline snapshot"""
+    try:
+        return jsonify(memory_profiler.start(request.args.get('frames', type=int)))
+    except ProfilerBusyError as e:
+        return jsonify({'error': str(e)}), 409
+
+@api.route('/api/admin/profile/memory', methods=['GET'])
+@admin_required
+def memory_profile():
+    """Allocation changes since the baseline, e.g. ?limit=25&group_by=lineno|filename|traceback&reset=true"""
+    group_by = request.args.get('group_by', 'lineno')
+    if group_by not in ('lineno', 'filename', 'traceback'):
+        return jsonify({'error': 'group_by must be lineno, filename or traceback'}), 400
+    report = memory_profiler.diff(request.args.get('limit', 25, type=int), group_by,
+                                  request.args.get('reset', 'false').lower() == 'true')
+    if report is None:
+        return jsonify({'error': f"Memory tracing is not running in worker {os.getpid()}"}), 409
+    return jsonify(report)
+
+@api.route('/api/admin/profile/memory', methods=['DELETE'])
+@admin_required
+def stop_memory_profile():
+    """Stop tracemalloc in this worker"""
+    memory_profiler.stop()
+    return jsonify(memory_profiler.status())
+
+@api.route('/api/debug/pesapal-config', methods=['GET'])
+@admin_required
 def debug_pesapal_config():
     """Debug endpoint to check PesaPal configuration (for development only)"""
     try:
         config_info = {
-            'pesapal_base_url': app.config.get('PESAPAL_BASE_URL'),
-            'consumer_key_exists': bool(app.config.get('PESAPAL_CONSUMER_KEY')),
-            'consumer_secret_exists': bool(app.config.get('PESAPAL_CONSUMER_SECRET')),
-            'notification_id': app.config.get('PESAPAL_NOTIFICATION_ID'),
-            'callback_url': 'https://books-management-system-bcr5.onrender.com/api/pesapal-callback'
+            'pesapal_base_url': current_app.config.get('PESAPAL_BASE_URL'),
+            'consumer_key_exists': bool(current_app.config.get('PESAPAL_CONSUMER_KEY')),
+            'consumer_secret_exists': bool(current_app.config.get('PESAPAL_CONSUMER_SECRET')),
+            'notification_id': current_app.config.get('PESAPAL_NOTIFICATION_ID'),
+            'callback_url': current_app.config.get('PESAPAL_CALLBACK_URL')
         }
         
         # Test PesaPal connectivity if credentials are configured
-        if app.config.get('PESAPAL_CONSUMER_KEY') and app.config.get('PESAPAL_CONSUMER_SECRET'):
+        if current_app.config.get('PESAPAL_CONSUMER_KEY') and current_app.config.get('PESAPAL_CONSUMER_SECRET'):
             try:
                 logger.info("Testing PesaPal connectivity...")
-                access_token = get_pesapal_token()
+                access_token = get_pesapal_token(refresh=True)
                 config_info['pesapal_connectivity'] = 'SUCCESS'
                 config_info['access_token_received'] = bool(access_token)
             except Exception as e:
@@ -450,6 +957,7 @@ def debug_pesapal_config():
                 config_info['connectivity_error'] = str(e)
         else:
             config_info['pesapal_connectivity'] = 'NOT_CONFIGURED'
+        config_info['circuit_breaker'] = pesapal_breaker.snapshot()
         
         return jsonify(config_info)
         
@@ -457,9 +965,32 @@ def debug_pesapal_config():
         logger.error(f"Error in debug endpoint: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/pay', methods=['POST'])
+@api.route('/api/metrics/gateway', methods=['GET'])
+def gateway_metrics():
+    """Circuit breaker and bulkhead state for the PesaPal gateway in this worker"""
+    if not metrics.authorized():
+        return jsonify({'error': 'Invalid or missing metrics token'}), 401
+    return jsonify({
+        'pid': os.getpid(),
+        'pesapal': {
+            'breaker': pesapal_breaker.snapshot(),
+            'bulkhead': pesapal_bulkhead.snapshot()
+        }
+    })
+
+@api.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus metrics for every worker on this node"""
+    if not metrics.authorized():
+        return jsonify({'error': 'Invalid or missing metrics token'}), 401
+    metrics.set_breaker_state(pesapal_breaker.state)
+    return metrics.render()
+
+@api.route('/api/pay', methods=['POST'])
+@idempotent('pay')
 def pay():
     """PesaPal v3 API payment endpoint"""
+    import requests
     try:
         logger.info("=== PESAPAL PAYMENT REQUEST START ===")
         
@@ -469,11 +1000,11 @@ def pay():
             logger.error("No JSON data provided in payment request")
             return jsonify({'error': 'No data provided'}), 400
         
-        logger.info(f"Payment request data: {data}")
+        logger.debug(f"Payment request data: {data}")
         
         # Extract and validate payment data
         resource_id = data.get('resource_id')
-        email = data.get('email')
+        email = data.get('email') or (g.current_user.email if g.current_user else None)
         amount = data.get('amount')
         name = data.get('name')
         phone = data.get('phone')
@@ -520,13 +1051,14 @@ def pay():
         logger.info(f"Resource found: {resource.title} (ID: {resource_id})")
         
         # Generate order tracking ID
-        order_tracking_id = f"ORDER_{int(time.time())}_{random.randint(1000, 9999)}"
+        order_tracking_id = generate_unique_order_id()
+        tracer.set_attribute('payment.order_tracking_id', order_tracking_id)
         logger.info(f"Generated order tracking ID: {order_tracking_id}")
         
         # Check PesaPal configuration
-        pesapal_key = app.config['PESAPAL_CONSUMER_KEY']
-        pesapal_secret = app.config['PESAPAL_CONSUMER_SECRET']
-        pesapal_base_url = app.config['PESAPAL_BASE_URL']
+        pesapal_key = current_app.config['PESAPAL_CONSUMER_KEY']
+        pesapal_secret = current_app.config['PESAPAL_CONSUMER_SECRET']
+        pesapal_base_url = current_app.config['PESAPAL_BASE_URL']
         
         if not pesapal_key or not pesapal_secret:
             logger.warning("PesaPal credentials not configured, using test mode")
@@ -537,20 +1069,23 @@ def pay():
                 amount=amount,
                 status='COMPLETED'
             )
-            db.session.add(payment)
-            db.session.commit()
             return jsonify({
                 'success': True,
                 'orderTrackingId': order_tracking_id,
-                'redirectUrl': f"https://books-management-system-bcr5.onrender.com/user/download-success.html?resource_id={resource_id}&email={email}&orderTrackingId={order_tracking_id}",
+                'redirectUrl': download_url(resource_id, email, order_tracking_id),
                 'message': 'Test payment successful (PesaPal not configured)'
             })
         
+        # Don't hold a pooled connection through the gateway round trips
+        db.session.close()
+        
         # Get PesaPal access token
         try:
             logger.info("Requesting PesaPal access token...")
             access_token = get_pesapal_token()
             logger.info("PesaPal access token received successfully")
+        except GatewayUnavailableError as e:
+            return gateway_unavailable_response(e)
         except Exception as e:
             logger.error(f"Failed to get PesaPal access token: {str(e)}")
             return jsonify({'error': f'Payment service temporarily unavailable: {str(e)}'}), 503
@@ -568,8 +1103,8 @@ def pay():
             'currency': 'KES',
             'amount': amount_float,
             'description': f"Purchase: {resource.title}",
-            'callback_url': 'https://books-management-system-bcr5.onrender.com/api/pesapal-callback',
-            'notification_id': app.config.get('PESAPAL_NOTIFICATION_ID', '4ad16ada-f09b-4b45-8c18-db86b60a879d'),
+            'callback_url': current_app.config['PESAPAL_CALLBACK_URL'],
+            'notification_id': current_app.config.get('PESAPAL_NOTIFICATION_ID', '4ad16ada-f09b-4b45-8c18-db86b60a879d'),
             'billing_address': {
                 'email_address': email,
                 'phone_number': phone,
@@ -585,18 +1120,20 @@ def pay():
         }
         
         logger.info(f"PesaPal order URL: {order_url}")
-        logger.info(f"PesaPal order data: {pesapal_order}")
-        logger.info(f"Request headers: {headers}")
+        logger.debug(f"PesaPal order data: {pesapal_order}")
         
         # Submit order to PesaPal
         try:
             logger.info("Submitting order to PesaPal...")
-            order_resp = requests.post(order_url, json=pesapal_order, headers=headers, timeout=30)
+            order_resp = pesapal_post(order_url, json=pesapal_order, headers=headers)
             
             logger.info(f"PesaPal order response status: {order_resp.status_code}")
-            logger.info(f"PesaPal order response headers: {dict(order_resp.headers)}")
-            logger.info(f"PesaPal order response body: {order_resp.text}")
+            logger.debug(f"PesaPal order response headers: {dict(order_resp.headers)}")
+            logger.debug(f"PesaPal order response body: {order_resp.text}")
             
+        except GatewayUnavailableError as e:
+            logger.warning(f"PesaPal order request skipped: {str(e)}")
+            return gateway_unavailable_response(e)
         except requests.exceptions.Timeout:
             logger.error("PesaPal order request timed out")
             return jsonify({'error': 'Payment service request timed out'}), 503
@@ -664,7 +1201,7 @@ def pay():
         # Prepare response
         redirect_url = order_response.get('redirect_url')
         if not redirect_url:
-            redirect_url = f"https://books-management-system-bcr5.onrender.com/user/download-success.html?resource_id={resource_id}&email={email}&orderTrackingId={order_tracking_id}"
+            redirect_url = download_url(resource_id, email, order_tracking_id)
             logger.warning(f"No redirect_url in PesaPal response, using fallback: {redirect_url}")
         
         logger.info(f"Payment initiated successfully. Redirect URL: {redirect_url}")
@@ -682,7 +1219,8 @@ def pay():
         logger.exception(f"Unexpected error in payment endpoint: {str(e)}")
         return jsonify({'error': f'Internal server error: {str(e)}'}), 500
 
-@app.route('/api/pesapal-callback', methods=['POST'])
+@api.route('/api/pesapal-callback', methods=['POST'])
+@idempotent('pesapal-callback')
 def pesapal_callback():
     """Handle PesaPal IPN (Instant Payment Notification)"""
     try:
@@ -692,6 +1230,7 @@ def pesapal_callback():
         
         # Extract payment information
         order_tracking_id = data.get('order_tracking_id')
+        tracer.set_attribute('payment.order_tracking_id', order_tracking_id)
         transaction_tracking_id = data.get('transaction_tracking_id')
         payment_status = data.get('payment_status')
         
@@ -699,26 +1238,51 @@ def pesapal_callback():
             logger.error("No order_tracking_id in callback")
             return jsonify({'error': 'Missing order_tracking_id'}), 400
         
-        # Find the payment record
-        payment = Payment.query.filter_by(order_tracking_id=order_tracking_id).first()
-        if not payment:
-            logger.error(f"Payment record not found for order: {order_tracking_id}")
-            return jsonify({'error': 'Payment record not found'}), 404
-        
-        # Update payment status
-        if payment_status == 'COMPLETED':
-            payment.status = 'COMPLETED'
-            payment.transaction_tracking_id = transaction_tracking_id
-            payment.ipn_received = True
-            payment.ipn_received_at = datetime.utcnow()
-            db.session.commit()
-            logger.info(f"Payment completed: {order_tracking_id}")
-        elif payment_status in ['FAILED', 'CANCELLED']:
-            payment.status = payment_status
-            payment.ipn_received = True
-            payment.ipn_received_at = datetime.utcnow()
+        for attempt in range(3):
+            # Find the payment record, locking the row so concurrent notifications
+            # for the same order are applied one at a time
+            payment = Payment.query.filter_by(order_tracking_id=order_tracking_id).with_for_update().first()
+            if not payment:
+                logger.error(f"Payment record not found for order: {order_tracking_id}")
+                return jsonify({'error': 'Payment record not found'}), 404
+            
+            # Repeated or late notifications must not change a settled payment
+            if payment.status == 'COMPLETED' or payment.status == payment_status:
+                db.session.rollback()
+                logger.info(f"Ignoring duplicate callback for order {order_tracking_id} ({payment.status} -> {payment_status})")
+                return jsonify({'success': True, 'message': 'Callback already processed'})
+            
+            if payment_status not in ['COMPLETED', 'FAILED', 'CANCELLED']:
+                db.session.rollback()
+                break
+            
+            # Update payment status
+            changes = {
+                'status': payment_status,
+                'ipn_received': True,
+                'ipn_received_at': datetime.utcnow()
+            }
+            if payment_status == 'COMPLETED':
+                changes['transaction_tracking_id'] = transaction_tracking_id
+            
+            # Compare-and-set on the status we read, so databases without row
+            # locks (SQLite) cannot let a stale notification overwrite a
+            # concurrent COMPLETED
+            updated = Payment.query.filter_by(
+                id=payment.id, status=payment.status
+            ).update(changes, synchronize_session=False)
+            if updated:
+                record_payment_change(payment, old_status=payment.status, new_status=payment_status)
+                count_payment_change(payment, old_status=payment.status, new_status=payment_status)
+                if payment_status == 'COMPLETED':
+                    queue_payment_receipt(payment, transaction_tracking_id)
             db.session.commit()
-            logger.info(f"Payment {payment_status}: {order_tracking_id}")
+            if updated:
+                logger.info(f"Payment {payment_status}: {order_tracking_id}")
+                break
+            logger.info(f"Payment {order_tracking_id} changed concurrently, re-checking")
+        else:
+            return jsonify({'error': 'Payment is being updated, retry later'}), 409
         
         return jsonify({'success': True, 'message': 'Callback processed'})
         
@@ -726,12 +1290,12 @@ def pesapal_callback():
         logger.exception('Error processing PesaPal callback: %s', str(e))
         return jsonify({'error': 'Internal server error'}), 500
 
-@app.route('/api/check-payment', methods=['GET'])
+@api.route('/api/check-payment', methods=['GET'])
 def check_payment():
     """Check payment status for a resource and email"""
     try:
         resource_id = request.args.get('resource_id')
-        email = request.args.get('email')
+        email = request.args.get('email') or (g.current_user.email if g.current_user else None)
         
         if not resource_id or not email:
             return jsonify({'error': 'Missing resource_id or email'}), 400
@@ -757,9 +1321,9 @@ def check_payment():
         logger.exception('Error checking payment: %s', str(e))
         return jsonify({'error': 'Internal server error'}), 500
 
-@app.route('/api/download/<int:resource_id>', methods=['GET'])
+@api.route('/api/download/<int:resource_id>', methods=['GET'])
 def download_resource(resource_id):
-    email = request.args.get('email')
+    email = request.args.get('email') or (g.current_user.email if g.current_user else None)
     order_tracking_id = request.args.get('orderTrackingId')
     
     if not email or not order_tracking_id:
@@ -792,9 +1356,235 @@ def download_resource(resource_id):
     logger.info(f"Resource downloaded: Resource {resource_id}, User {email}, Order {order_tracking_id}")
     return send_file(test_pdf_path, as_attachment=True, download_name=f'{resource.title}.pdf')
 
+@api.cli.command('init-db')
+def init_db_command():
+    """Create any missing tables (use `flask db upgrade` for schema changes)"""
+    if create_schema():
+        print("Database tables created and stamped with the latest migration")
+    else:
+        print("Missing tables created; run `flask db upgrade` to migrate existing ones")
+
+@api.cli.command('create-admin')
+@click.option('--username', default='admin', show_default=True)
+@click.option('--email', default='admin@somafy.co.ke', show_default=True)
+@click.option('--password', envvar='ADMIN_PASSWORD', prompt=True, hide_input=True, confirmation_prompt=True,
+              help='Read from ADMIN_PASSWORD when not given')
+def create_admin_command(username, email, password):
+    """Create the admin account if it doesn't exist"""
+    if ensure_admin_user(username, email, password):
+        print(f"Admin user {username} created")
+    else:
+        print(f"User {username} already exists")
+
+@api.cli.command('identifier-conflicts')
+@click.option('--fix', is_flag=True, help='Add the missing identifiers that no other user holds')
+def identifier_conflicts_command(fix):
+    """List users who can't log in with their username or email because another user holds it"""
+    missing = [(user.id, user.username, kind, value)
+               for user in User.query.options(selectinload(User.identifiers)).order_by(User.id).yield_per(500)
+               for kind, value in user.missing_identifiers().items()]
+    found = fixed = 0
+    for user_id, username, kind, value in missing:
+        holder = UserIdentifier.query.filter_by(value=value).first()
+        if holder is None and fix:
+            db.session.add(UserIdentifier(user_id=user_id, kind=kind, value=value))
+            fixed += 1
+            continue
+        found += 1
+        held_by = f"user {holder.user_id}" if holder else "nobody; --fix adds it"
+        print(f"User {user_id} ({username}): {kind} '{value}' is held by {held_by}")
+    db.session.commit()
+    print(f"{found} conflicts" + (f", {fixed} identifiers added" if fix else ''))
+
+@api.cli.command('purge-idempotency-keys')
+def purge_idempotency_keys_command():
+    """Delete expired Idempotency-Key records"""
+    removed = purge_expired_keys()
+    print(f"Removed {removed} expired idempotency keys")
+
+@api.cli.command('purge-revoked-tokens')
+def purge_revoked_tokens_command():
+    """Delete revocation records for tokens that have expired"""
+    removed = purge_expired_revocations()
+    print(f"Removed {removed} expired token revocations")
+
+def archive_old_payments(batch_size=None, pause_seconds=None, max_batches=None):
+    """Archive payments past PAYMENT_ARCHIVE_AFTER_DAYS / PAYMENT_ABANDONED_AFTER_DAYS; returns {status: moved}"""
+    config = current_app.config
+    now = datetime.utcnow()
+    archive_after = timedelta(days=config['PAYMENT_ARCHIVE_AFTER_DAYS'])
+    cutoffs = {
+        'FAILED': now - archive_after,
+        'CANCELLED': now - archive_after,
+        'PENDING': now - timedelta(days=config['PAYMENT_ABANDONED_AFTER_DAYS']),
+    }
+    return archive_payments(
+        cutoffs,
+        batch_size=batch_size or config['PAYMENT_ARCHIVE_BATCH_SIZE'],
+        pause_seconds=config['PAYMENT_ARCHIVE_PAUSE_SECONDS'] if pause_seconds is None else pause_seconds,
+        max_batches=max_batches
+    )
+
+@api.cli.command('archive-payments')
+@click.option('--batch-size', type=int, help='Rows moved per transaction (default: PAYMENT_ARCHIVE_BATCH_SIZE)')
+@click.option('--pause', type=float, help='Seconds between batches (default: PAYMENT_ARCHIVE_PAUSE_SECONDS)')
+@click.option('--max-batches', type=int, help='Stop after this many batches; the next run continues')
+def archive_payments_command(batch_size, pause, max_batches):
+    """Move old FAILED, CANCELLED and abandoned PENDING payments to the archive table"""
+    moved = archive_old_payments(batch_size, pause, max_batches)
+    print(f"Archived {sum(moved.values())} payments: " + ', '.join(f"{count} {status}" for status, count in moved.items()))
+
+@api.cli.command('backfills')
+def backfills_command():
+    """Show the progress of batched migration backfills"""
+    for checkpoint in MigrationCheckpoint.query.order_by(MigrationCheckpoint.started_at):
+        state = f"finished {checkpoint.finished_at:%Y-%m-%d %H:%M}" if checkpoint.finished_at else \
+            f"in progress, last updated {checkpoint.updated_at:%Y-%m-%d %H:%M}"
+        print(f"{checkpoint.name} ({checkpoint.table_name}): {checkpoint.rows_done} rows, "
+              f"up to id {checkpoint.last_key}, {state}")
+
+rollups_cli = AppGroup('rollups', help='Maintain the daily sales rollups')
+
+@rollups_cli.command('rebuild')
+@click.option('--from', 'start', type=click.DateTime(formats=['%Y-%m-%d']), help='First day to rebuild (default: first payment)')
+@click.option('--to', 'end', type=click.DateTime(formats=['%Y-%m-%d']), help='Last day to rebuild (default: last payment)')
+def rebuild_rollups_command(start, end):
+    """Recompute sales rollups from live and archived payments"""
+    written = rebuild_rollups(start.date() if start else None, end.date() if end else None)
+    print(f"Wrote {written} sales rollup rows")
+
+api.cli.add_command(rollups_cli)
+
+@api.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute the admin dashboard counters from the base tables"""
+    written = rebuild_counters()
+    print(f"Wrote {written} dashboard counters")
+
+export_cli = AppGroup('export', help='Export data to a file (gzip-compressed when the name ends in .gz)')
+
+@export_cli.command('payments')
+@click.option('--out', 'path', required=True, help='Output file, e.g. payments.csv.gz')
+@click.option('--format', 'fmt', type=click.Choice(list(EXPORT_FORMATS)), default='csv')
+@click.option('--from', 'start', type=click.DateTime(formats=['%Y-%m-%d']))
+@click.option('--to', 'end', type=click.DateTime(formats=['%Y-%m-%d']))
+@click.option('--status', type=click.Choice(list(PAYMENT_STATUS_CODES)))
+def export_payments_command(path, fmt, start, end, status):
+    """Export payments"""
+    rows = payment_rows(start.date() if start else None, end.date() if end else None, status=status)
+    written = write_export(path, export_chunks(rows, PAYMENT_COLUMNS, fmt))
+    print(f"Wrote {written} bytes to {path}")
+
+@export_cli.command('resources')
+@click.option('--out', 'path', required=True, help='Output file, e.g. resources.csv')
+@click.option('--format', 'fmt', type=click.Choice(list(EXPORT_FORMATS)), default='csv')
+def export_resources_command(path, fmt):
+    """Export resources"""
+    written = write_export(path, export_chunks(resource_rows(), RESOURCE_COLUMNS, fmt))
+    print(f"Wrote {written} bytes to {path}")
+
+api.cli.add_command(export_cli)
+
+# Warmup, run once per process before it serves (see health.py and wsgi.py)
+
+@warmup.step('catalog')
+def warm_catalog():
+    # The unfiltered /api/resources queries, so the first visitors find them compiled and
+    # their pages in the database's cache; the rows themselves are not kept
+    resources = [r.to_dict() for r in Resource.query.all()]
+    featured = featured_resources()
+    return f"{len(resources)} resources, {sum(len(items) for items in featured.values())} featured"
+
+@warmup.step('facets')
+def warm_facets():
+    # Same for the dashboard counters
+    counts = dashboard_stats()['resources']
+    return (f"{len(counts['by_type'])} types, {len(counts['by_class'])} classes, "
+            f"{len(counts['by_subject'])} subjects")
+
+@warmup.step('gateway-token')
+def warm_gateway_token():
+    if not current_app.config['PESAPAL_CONSUMER_KEY'] or not current_app.config['PESAPAL_CONSUMER_SECRET']:
+        return 'skipped, PesaPal not configured'
+    get_pesapal_token()
+    return f"cached for {current_app.config['PESAPAL_TOKEN_TTL']}s"
+
+# Scheduled maintenance, run by `flask jobs worker` (see jobs.py)
+
+@job_runner.task('purge-idempotency-keys', cron='7 * * * *')
+def purge_idempotency_keys_job():
+    purge_expired_keys()
+
+@job_runner.task('purge-revoked-tokens', cron='12 * * * *')
+def purge_revoked_tokens_job():
+    purge_expired_revocations()
+
+@job_runner.task('archive-payments', cron='30 3 * * *', max_attempts=3)
+def archive_payments_job(max_batches=None):
+    archive_old_payments(max_batches=max_batches)
+
+@job_runner.task('purge-jobs', cron='45 3 * * *')
+def purge_jobs_job():
+    job_runner.purge_finished(datetime.utcnow() - timedelta(days=current_app.config['JOB_KEEP_DAYS']))
+
+jobs_cli = AppGroup('jobs', help='Run and inspect background jobs')
+
+@jobs_cli.command('worker')
+@click.option('--queue', '-q', 'queues', multiple=True, help='Queue to take jobs from, in priority order (default: all)')
+@click.option('--threads', type=int, default=1, show_default=True, help='Jobs this process runs at once')
+@click.option('--burst', is_flag=True, help='Exit once no job is due')
+@click.option('--no-schedule', is_flag=True, help="Don't enqueue scheduled jobs from this worker")
+def jobs_worker_command(queues, threads, burst, no_schedule):
+    """Run background jobs until SIGTERM or Ctrl-C; running jobs finish first"""
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stop.set())
+    if not queues:
+        queues = sorted({task.queue for task in job_runner.tasks.values()} | set(job_runner.queue_concurrency))
+    job_runner.work(list(queues), threads=threads, stop=stop, burst=burst, schedule=not no_schedule)
+
+@jobs_cli.command('enqueue')
+@click.argument('name')
+@click.option('--payload', default='{}', help='JSON object of keyword arguments for the task')
+@click.option('--delay', type=float, default=0, help='Seconds before the job may run')
+def jobs_enqueue_command(name, payload, delay):
+    """Queue a job by task name"""
+    try:
+        job = job_runner.enqueue(name, run_at=datetime.utcnow() + timedelta(seconds=delay), **json.loads(payload))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    db.session.commit()
+    print(f"Enqueued job {job.id} ({name}) on queue {job.queue}")
+
+@jobs_cli.command('status')
+def jobs_status_command():
+    """Job counts per queue and status, and the task schedules"""
+    for (queue, status), count in sorted(job_runner.status_counts().items()):
+        print(f"{queue:<12} {status:<8} {count}")
+    for name, task in sorted(job_runner.tasks.items()):
+        schedule = job_runner.schedule(task)
+        print(f"{name}: {schedule.expression if schedule else 'not scheduled'} (queue {task.queue})")
+
+api.cli.add_command(jobs_cli)
+
+outbox_cli = AppGroup('outbox', help='Send and inspect queued mail and webhooks')
+
+@outbox_cli.command('deliver')
+@click.option('--batch-size', type=int, help='Messages claimed at a time (default: OUTBOX_BATCH_SIZE)')
+@click.option('--max-batches', type=int, help='Stop after this many batches')
+def outbox_deliver_command(batch_size, max_batches):
+    """Send due messages now, without waiting for the job worker"""
+    counts = outbox.deliver(batch_size=batch_size, max_batches=max_batches)
+    print(f"Sent {counts['sent']}, retrying {counts['retried']}, failed {counts['failed']}")
+
+@outbox_cli.command('status')
+def outbox_status_command():
+    """Message counts per channel and status"""
+    for (channel, status), count in sorted(outbox.status_counts().items()):
+        print(f"{channel:<8} {status:<8} {count}")
+
+api.cli.add_command(outbox_cli)
+
 if __name__ == '__main__':
-    with app.app_context():
-        db.create_all()
-        ensure_admin_user()
-    app.run(debug=True)
+    create_app().run(debug=True)
 
@@ -0,0 +1,100 @@
+# archive.py
+"""
+Payment archival.
+
+Abandoned checkouts leave ``PENDING``, ``FAILED`` and ``CANCELLED`` rows
+behind, and the table that ``check_payment``, ``download_resource`` and the
+IPN handler search would otherwise grow with every one of them.
+``archive_payments`` moves FAILED and CANCELLED payments, and checkouts that
+are still PENDING long after any IPN could arrive, into ``payment_archive``.
+COMPLETED payments stay where they are: they are what grants downloads.
+
+Rows move in small batches. Each batch copies a set of ids and deletes them
+in one short transaction, so it only ever locks those rows. An optional pause
+between batches leaves room for other writers and for replicas to catch up.
+A run can stop at any point and the next run picks up where it left off.
+
+The archive keeps every column and the original ids. ``payment_history``
+reads both tables as one, which is how the rollup and counter rebuilds see
+archived payments. ``exports.payment_rows`` includes them as well. Totals
+that are already maintained stay the same, because archiving never changes
+a payment's status.
+"""
+import logging
+import time
+from datetime import datetime
+
+from sqlalchemy import delete, insert, literal, select, union_all
+
+from models import db, Payment, PaymentArchive
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_COLUMNS = [column.name for column in Payment.__table__.columns]
+
+
+def payment_history(start=None, end=None):
+    """Live and archived payments created in [start, end) as one ``payment_history`` subquery."""
+    selects = []
+    for table in (Payment.__table__, PaymentArchive.__table__):
+        stmt = select(*[table.c[name] for name in PAYMENT_COLUMNS])
+        if start is not None:
+            stmt = stmt.where(table.c.created_at >= start)
+        if end is not None:
+            stmt = stmt.where(table.c.created_at < end)
+        selects.append(stmt)
+    return union_all(*selects).subquery('payment_history')
+
+
+def _archivable_ids(status, before, after, limit):
+    # (status, created_at) covers this scan. Starting at the last batch's
+    # created_at skips the entries that batch has just deleted.
+    query = Payment.query.with_entities(Payment.id, Payment.created_at).filter(
+        Payment.status == status, Payment.created_at < before
+    )
+    if after is not None:
+        query = query.filter(Payment.created_at >= after)
+    return query.order_by(Payment.created_at).limit(limit).all()
+
+
+def _move(ids, status, before):
+    source = Payment.__table__
+    # Filtering on status again means a row that changed since it was picked stays put
+    still_archivable = (source.c.id.in_(ids), source.c.status == status, source.c.created_at < before)
+    db.session.execute(insert(PaymentArchive.__table__).from_select(
+        PAYMENT_COLUMNS + ['archived_at'],
+        select(*[source.c[name] for name in PAYMENT_COLUMNS], literal(datetime.utcnow(), db.DateTime))
+        .where(*still_archivable)
+    ))
+    moved = db.session.execute(delete(source).where(*still_archivable)).rowcount
+    db.session.commit()
+    return moved
+
+
+def archive_payments(cutoffs, batch_size=500, pause_seconds=0.0, max_batches=None):
+    """Move payments older than their status's cutoff into ``payment_archive``.
+
+    ``cutoffs`` maps a status to a datetime, e.g. ``{'FAILED': ..., 'PENDING': ...}``.
+    Every batch of at most ``batch_size`` rows is its own transaction.
+    ``pause_seconds`` is slept between batches. ``max_batches`` bounds a run.
+    Returns {status: rows moved}.
+    """
+    if 'COMPLETED' in cutoffs:
+        raise ValueError("COMPLETED payments grant downloads and are never archived")
+    moved = {status: 0 for status in cutoffs}
+    batches = 0
+    for status, before in cutoffs.items():
+        after = None
+        while max_batches is None or batches < max_batches:
+            rows = _archivable_ids(status, before, after, batch_size)
+            if not rows:
+                break
+            if batches and pause_seconds:
+                time.sleep(pause_seconds)
+            moved[status] += _move([row.id for row in rows], status, before)
+            batches += 1
+            after = rows[-1].created_at
+            if len(rows) < batch_size:
+                break
+    logger.info(f"Archived payments in {batches} batches: {moved}")
+    return moved
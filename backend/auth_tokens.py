@@ -0,0 +1,321 @@
+# auth_tokens.py
+"""
+Signed session tokens.
+
+``/api/login`` issues a short-lived access token and a longer-lived refresh
+token. Both are ``itsdangerous``-signed JSON carrying the user's id, name,
+email and admin flag, so a ``before_request`` hook can authenticate a request
+with an HMAC check and a dict lookup: no password check and no user query.
+
+Password reset links carry a third kind of token. It holds a fingerprint of
+the user's password hash, so it stops working once the password changes and
+can be used only once without being stored anywhere.
+
+Revocations (logout, refresh-token rotation, password changes) are stored in
+the ``revoked_token`` table and mirrored into an in-process cache. Each worker
+picks up revocations made by other workers the next time its cache is older
+than ``TOKEN_REVOCATION_REFRESH_SECONDS``, so a revoked token stops working
+everywhere within that interval. Refresh tokens don't wait for that: the row
+that revokes one on use has a unique token id, so only the first redemption
+commits, whichever worker a replay reaches.
+"""
+import hashlib
+import hmac
+import logging
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+
+from flask import g, jsonify, request
+from itsdangerous import BadSignature, URLSafeSerializer
+
+from models import db, RevokedToken, User
+
+logger = logging.getLogger(__name__)
+
+ACCESS = 'access'
+REFRESH = 'refresh'
+RESET = 'reset'
+
+
+class TokenError(Exception):
+    """Raised when a token is malformed, tampered with, expired or revoked."""
+
+
+@dataclass(frozen=True)
+class AuthenticatedUser:
+    """The user a verified token was issued to."""
+    id: int
+    username: str
+    email: str
+    is_admin: bool
+    token_id: str
+    issued_at: float
+    expires_at: float
+
+
+def _password_fingerprint(user):
+    return hashlib.sha256(user.password_hash.encode()).hexdigest()[:16]
+
+
+def _epoch(value):
+    # Columns hold naive UTC datetimes
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+
+# Auto-increment ids are handed out at insert but can commit out of order (InnoDB),
+# so each reload also re-reads this many ids below the highest one seen
+LATE_COMMIT_WINDOW = 1000
+
+UNIX_EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def _now_micros():
+    # Issue times and revocation cut-offs are both whole microseconds, which
+    # revoked_at stores exactly, so a token issued after a revocation never
+    # compares as older than it
+    return time.time_ns() // 1000
+
+
+def _micros(value):
+    """Whole microseconds since the epoch for a naive UTC datetime or epoch seconds"""
+    if isinstance(value, datetime):
+        return (value - UNIX_EPOCH) // MICROSECOND
+    return round(value * 1_000_000)
+
+
+class RevocationCache:
+    """Revoked token ids and per-user cut-offs, reloaded from the database periodically."""
+
+    def __init__(self, refresh_seconds=30):
+        self.refresh_seconds = refresh_seconds
+        self._token_ids = {}  # jti -> expiry (epoch seconds)
+        self._users = {}  # user id -> tokens issued before this time (epoch microseconds) are revoked
+        self._last_id = 0
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def add(self, token_id=None, user_id=None, revoked_before=None, expires_at=None):
+        with self._lock:
+            if token_id:
+                self._token_ids[token_id] = expires_at
+            if user_id is not None:
+                self._users[user_id] = max(self._users.get(user_id, 0), revoked_before)
+
+    def is_revoked(self, user):
+        self._refresh_if_stale()
+        if user.token_id in self._token_ids:
+            return True
+        return _micros(user.issued_at) < self._users.get(user.id, 0)
+
+    def _refresh_if_stale(self):
+        now = time.monotonic()
+        if self._loaded_at is not None and now - self._loaded_at < self.refresh_seconds:
+            return
+        with self._lock:
+            if self._loaded_at is not None and now - self._loaded_at < self.refresh_seconds:
+                return
+            try:
+                rows = db.session.query(RevokedToken).filter(
+                    RevokedToken.id > self._last_id - LATE_COMMIT_WINDOW,
+                    RevokedToken.expires_at > datetime.utcnow()
+                ).order_by(RevokedToken.id).all()
+            except Exception as e:
+                # Keep serving from what we have; try again next interval
+                db.session.rollback()
+                logger.warning(f"Could not refresh token revocations: {str(e)}")
+                self._loaded_at = now
+                return
+            for row in rows:
+                # Rows seen before are simply merged in again
+                self._last_id = max(self._last_id, row.id)
+                if row.token_id:
+                    self._token_ids[row.token_id] = _epoch(row.expires_at)
+                if row.user_id is not None:
+                    cutoff = _micros(row.revoked_at)
+                    self._users[row.user_id] = max(self._users.get(row.user_id, 0), cutoff)
+            self._prune()
+            self._loaded_at = now
+
+    def _prune(self):
+        now = time.time()
+        self._token_ids = {jti: exp for jti, exp in self._token_ids.items() if exp is None or exp > now}
+
+    def clear(self):
+        with self._lock:
+            self._token_ids.clear()
+            self._users.clear()
+            self._last_id = 0
+            self._loaded_at = None
+
+
+class TokenService:
+    def __init__(self, app=None):
+        self.access_ttl = 900
+        self.refresh_ttl = 14 * 86400
+        self.reset_ttl = 3600
+        self.admin_usernames = {'admin'}
+        self.revocations = RevocationCache()
+        self._serializers = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        secret = app.config['SECRET_KEY']
+        if not app.testing and secret in (None, '', 'dev'):
+            # Anyone who knows the key can sign an access token with the admin claim
+            raise RuntimeError("Set SECRET_KEY to a long random value; tokens can't be signed with a default key")
+        self._serializers = {
+            ACCESS: URLSafeSerializer(secret, salt='access-token'),
+            REFRESH: URLSafeSerializer(secret, salt='refresh-token'),
+            RESET: URLSafeSerializer(secret, salt='password-reset'),
+        }
+        self.access_ttl = app.config['ACCESS_TOKEN_TTL']
+        self.refresh_ttl = app.config['REFRESH_TOKEN_TTL']
+        self.reset_ttl = app.config['PASSWORD_RESET_TTL']
+        self.admin_usernames = set(app.config['ADMIN_USERNAMES'])
+        self.revocations = RevocationCache(app.config['TOKEN_REVOCATION_REFRESH_SECONDS'])
+        app.before_request(self._authenticate_request)
+
+    def _authenticate_request(self):
+        g.current_user = None
+        g.auth_error = None
+        header = request.headers.get('Authorization', '')
+        if not header.lower().startswith('bearer '):
+            return
+        try:
+            g.current_user = self.verify(header[7:].strip(), ACCESS)
+        except TokenError as e:
+            g.auth_error = str(e)
+
+    def _issue(self, user, kind, ttl):
+        now = _now_micros() / 1_000_000
+        claims = {
+            'sub': user.id,
+            'name': user.username,
+            'email': user.email,
+            'admin': user.username in self.admin_usernames,
+            'jti': uuid.uuid4().hex,
+            'iat': now,
+            'exp': int(now + ttl),
+        }
+        return self._serializers[kind].dumps(claims)
+
+    def issue_pair(self, user):
+        """Access and refresh tokens for ``user``, shaped for a JSON response."""
+        return {
+            'access_token': self._issue(user, ACCESS, self.access_ttl),
+            'refresh_token': self._issue(user, REFRESH, self.refresh_ttl),
+            'token_type': 'Bearer',
+            'expires_in': self.access_ttl,
+        }
+
+    def verify(self, token, kind=ACCESS):
+        """Check signature, expiry and revocation; returns an ``AuthenticatedUser``."""
+        try:
+            claims = self._serializers[kind].loads(token)
+        except BadSignature:
+            raise TokenError('Invalid token')
+        try:
+            user = AuthenticatedUser(
+                id=claims['sub'], username=claims['name'], email=claims['email'],
+                is_admin=bool(claims['admin']), token_id=claims['jti'],
+                issued_at=float(claims['iat']), expires_at=float(claims['exp'])
+            )
+        except (KeyError, TypeError, ValueError):
+            raise TokenError('Invalid token')
+        if user.expires_at <= time.time():
+            raise TokenError('Token expired')
+        if self.revocations.is_revoked(user):
+            raise TokenError('Token revoked')
+        return user
+
+    def issue_reset(self, user):
+        """A password reset token for ``user`` (a ``User``), valid until it expires or the password changes."""
+        return self._serializers[RESET].dumps({
+            'sub': user.id,
+            'pwd': _password_fingerprint(user),
+            'exp': int(time.time() + self.reset_ttl),
+        })
+
+    def verify_reset(self, token):
+        """The ``User`` a reset token was issued to; raises ``TokenError`` if it is invalid, expired or used."""
+        try:
+            claims = self._serializers[RESET].loads(token)
+            user_id, fingerprint, expires_at = claims['sub'], claims['pwd'], float(claims['exp'])
+        except (BadSignature, KeyError, TypeError, ValueError):
+            raise TokenError('Invalid token')
+        if expires_at <= time.time():
+            raise TokenError('Token expired')
+        user = db.session.get(User, user_id)
+        if user is None or not hmac.compare_digest(fingerprint, _password_fingerprint(user)):
+            raise TokenError('Token already used')
+        return user
+
+    def revoke(self, user):
+        """Revoke one token (a verified ``AuthenticatedUser``). The caller commits."""
+        expires_at = datetime.utcfromtimestamp(user.expires_at)
+        db.session.add(RevokedToken(token_id=user.token_id, user_id=None, expires_at=expires_at))
+        self.revocations.add(token_id=user.token_id, expires_at=user.expires_at)
+
+    def revoke_user(self, user_id):
+        """Revoke every token issued to ``user_id`` so far. The caller commits."""
+        now = _now_micros()
+        revoked_at = UNIX_EPOCH + now * MICROSECOND
+        db.session.add(RevokedToken(
+            token_id=None, user_id=user_id, revoked_at=revoked_at,
+            expires_at=revoked_at + timedelta(seconds=self.refresh_ttl)
+        ))
+        self.revocations.add(user_id=user_id, revoked_before=now)
+
+
+def purge_expired_revocations(batch_size=1000):
+    """Delete revocations whose tokens have expired anyway. Returns the number removed."""
+    removed = 0
+    while True:
+        ids = [row.id for row in RevokedToken.query.with_entities(RevokedToken.id)
+               .filter(RevokedToken.expires_at <= datetime.utcnow()).limit(batch_size)]
+        if not ids:
+            return removed
+        RevokedToken.query.filter(RevokedToken.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        removed += len(ids)
+
+
+def _unauthorized():
+    message = g.get('auth_error') or 'Authentication required'
+    response = jsonify({'success': False, 'error': message})
+    response.status_code = 401
+    error = ' error="invalid_token"' if g.get('auth_error') else ''
+    response.headers['WWW-Authenticate'] = f'Bearer{error}'
+    return response
+
+
+def login_required(view):
+    """Reject requests without a valid access token."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if g.get('current_user') is None:
+            return _unauthorized()
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def admin_required(view):
+    """Reject requests unless the access token belongs to an admin."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        user = g.get('current_user')
+        if user is None:
+            return _unauthorized()
+        if not user.is_admin:
+            return jsonify({'success': False, 'error': 'Admin access required'}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+
+session_tokens = TokenService()
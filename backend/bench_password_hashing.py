@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Password hashing benchmark
+
+Measures login throughput (password verifications per second) for the inline
+hasher and for process pools of increasing size, with enough client threads
+to keep every pool process busy, and reports the rate per core:
+
+    python bench_password_hashing.py --logins 200
+    python bench_password_hashing.py --method pbkdf2:sha256:600000 --workers 1 2 4
+
+Use it to pick PASSWORD_HASH_WORKERS for a host: throughput should grow with
+workers until the cores are used up, and a worker count past that only adds
+queueing.
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from password_hashing import HashingBusyError, PasswordHasher
+
+
+def run(hasher, password_hash, logins, threads):
+    """Verify ``password_hash`` ``logins`` times from ``threads`` client threads."""
+    rejected = 0
+
+    def login(_):
+        nonlocal rejected
+        try:
+            return hasher.verify(password_hash, 'correct horse battery staple')
+        except HashingBusyError:
+            rejected += 1
+            return False
+
+    # Start the pool processes before timing
+    hasher.verify(password_hash, 'warmup')
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        verified = sum(pool.map(login, range(logins)))
+    return verified, rejected, time.perf_counter() - started
+
+
+def main():
+    cores = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description='Benchmark password verification throughput')
+    parser.add_argument('--method', default='scrypt', help='Werkzeug hash method (default: scrypt)')
+    parser.add_argument('--logins', type=int, default=100, help='Verifications per run')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        help=f"Pool sizes to test, 0 = inline (default: 0 1 2 4 .. {cores})")
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    workers = args.workers
+    if workers is None:
+        workers = [0] + sorted({n for n in (1, 2, 4, 8, 16, 32) if n <= cores} | {cores})
+
+    results = []
+    for count in workers:
+        threads = max(1, count)
+        # Queue room for every client thread so the benchmark measures throughput, not rejection
+        hasher = PasswordHasher(args.method, workers=count, max_queue=threads)
+        password_hash = hasher.hash('correct horse battery staple')
+        verified, rejected, elapsed = run(hasher, password_hash, args.logins, threads)
+        hasher.shutdown()
+        rate = verified / elapsed if elapsed else 0.0
+        results.append({
+            'workers': count,
+            'logins': args.logins,
+            'verified': verified,
+            'rejected': rejected,
+            'elapsed_seconds': round(elapsed, 3),
+            'logins_per_second': round(rate, 2),
+            'logins_per_second_per_core': round(rate / min(threads, cores), 2)
+        })
+
+    if args.json:
+        print(json.dumps({'method': args.method, 'cpu_count': cores, 'results': results}, indent=2))
+        return
+
+    print(f"Method: {args.method}, CPUs: {cores}")
+    print(f"{'workers':>8} {'logins/s':>10} {'per core':>10} {'elapsed':>9} {'rejected':>9}")
+    for r in results:
+        label = 'inline' if r['workers'] == 0 else r['workers']
+        print(f"{label:>8} {r['logins_per_second']:>10} {r['logins_per_second_per_core']:>10} "
+              f"{r['elapsed_seconds']:>8}s {r['rejected']:>9}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Serving-mode benchmark
+
+Runs the app under gunicorn once per worker class (sync, then gevent), each
+time with the same number of workers, against the PesaPal emulator with a
+realistic gateway latency. It pushes concurrent checkouts through /api/pay
+and reports checkouts per second per worker and /api/pay latency:
+
+    python bench_serving.py --checkouts 200 --concurrency 50 --latency-ms 300
+    python bench_serving.py --worker-classes sync gevent --workers 2 --json
+
+A sync worker handles one checkout at a time, so with two gateway calls per
+checkout it tops out at about 1 / (2 * latency) checkouts per second. A
+gevent worker keeps up to GUNICORN_WORKER_CONNECTIONS checkouts in flight
+and should scale with --concurrency until the database or CPU is the limit.
+Each mode gets a fresh SQLite database, so the runs don't share state.
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from loadtest_payments import LoadTest, free_port, percentile
+from pesapal_emulator import EmulatorSettings, PesapalEmulator
+
+BACKEND = os.path.dirname(os.path.abspath(__file__))
+
+
+def create_database(path):
+    """A SQLite database with the schema and one resource to buy; returns the resource id."""
+    from app import create_app
+    from config import SQLiteConfig
+    from models import Resource, db
+
+    app = create_app(SQLiteConfig, SQLALCHEMY_DATABASE_URI=f"sqlite:///{path}", LOG_LEVEL='WARNING', SECRET_KEY='bench')
+    with app.app_context():
+        db.create_all()
+        resource = Resource(resource_type='book', class_grade='form1', subject='bench',
+                            title='Benchmark resource', description='Created by bench_serving.py')
+        db.session.add(resource)
+        db.session.commit()
+        resource_id = resource.id
+        db.engine.dispose()
+    return resource_id
+
+
+def start_gunicorn(worker_class, workers, port, env):
+    command = [sys.executable, '-m', 'gunicorn', '--config', os.path.join(BACKEND, 'gunicorn.conf.py'),
+               '--workers', str(workers), '--bind', f"127.0.0.1:{port}", 'wsgi:app']
+    process = subprocess.Popen(command, cwd=BACKEND, env={**env, 'GUNICORN_WORKER_CLASS': worker_class},
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return process
+        except requests.exceptions.ConnectionError:
+            if process.poll() is not None:
+                raise RuntimeError(f"gunicorn ({worker_class}) exited with status {process.returncode}")
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"gunicorn ({worker_class}) did not start within 30s")
+
+
+def run(worker_class, args, emulator, emulator_url):
+    workdir = tempfile.mkdtemp(prefix=f"bench-{worker_class}-")
+    resource_id = create_database(os.path.join(workdir, 'bench.db'))
+    # create_app configured logging for this process too; keep the report readable
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    port = free_port()
+    env = {
+        **os.environ,
+        'APP_CONFIG': 'sqlite',
+        'SECRET_KEY': 'bench',
+        'SQLITE_URL': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'PESAPAL_BASE_URL': emulator_url,
+        'PESAPAL_CALLBACK_URL': f"http://127.0.0.1:{port}/api/pesapal-callback",
+        'PESAPAL_CONSUMER_KEY': 'emulator-key',
+        'PESAPAL_CONSUMER_SECRET': 'emulator-secret',
+        # Every simulated customer shares 127.0.0.1
+        'RATE_LIMIT_ENABLED': 'false',
+        'LOG_FILE': '',
+        'LOG_LEVEL': 'WARNING',
+        'PROMETHEUS_MULTIPROC_DIR': os.path.join(workdir, 'prometheus'),
+    }
+    process = start_gunicorn(worker_class, args.workers, port, env)
+    try:
+        test = LoadTest(f"http://127.0.0.1:{port}", resource_id, retry_rate=0.0)
+        elapsed = test.run(args.checkouts, args.concurrency)
+        # Let this run's IPNs land before its server goes away
+        emulator.wait_for_notifications(args.settle_timeout)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+    successful = len(test.checkouts)
+    return {
+        'worker_class': worker_class,
+        'workers': args.workers,
+        'successful_checkouts': successful,
+        'elapsed_seconds': round(elapsed, 3),
+        'checkouts_per_second': round(successful / elapsed, 2),
+        'checkouts_per_second_per_worker': round(successful / elapsed / args.workers, 2),
+        'pay_latency_ms': {
+            'p50': round(percentile(test.latencies, 50) * 1000, 1),
+            'p95': round(percentile(test.latencies, 95) * 1000, 1),
+            'p99': round(percentile(test.latencies, 99) * 1000, 1),
+        },
+        'pay_status_codes': {str(k): v for k, v in test.status_codes.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare gunicorn worker classes on the checkout path')
+    parser.add_argument('--worker-classes', nargs='+', default=['sync', 'gevent'])
+    parser.add_argument('--workers', type=int, default=1, help='Gunicorn workers per run')
+    parser.add_argument('--checkouts', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--latency-ms', type=float, default=300.0, help='PesaPal emulator latency per call')
+    parser.add_argument('--settle-timeout', type=float, default=60.0, help='Seconds to wait for IPNs after each run')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    emulator = PesapalEmulator(EmulatorSettings(
+        latency_ms=args.latency_ms, latency_jitter_ms=args.latency_ms / 10,
+        failure_rate=0.0, duplicate_rate=0.0, out_of_order_rate=0.0
+    ))
+    emulator_url = emulator.start()
+    try:
+        results = [run(worker_class, args, emulator, emulator_url) for worker_class in args.worker_classes]
+    finally:
+        emulator.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.checkouts} checkouts at concurrency {args.concurrency}, {args.workers} worker(s), "
+          f"gateway latency {args.latency_ms:.0f}ms")
+    print(f"{'worker class':>12} {'ok':>5} {'/s':>8} {'/s/worker':>10} {'p50 ms':>9} {'p95 ms':>9}  status codes")
+    for result in results:
+        latency = result['pay_latency_ms']
+        print(f"{result['worker_class']:>12} {result['successful_checkouts']:>5} {result['checkouts_per_second']:>8.2f} "
+              f"{result['checkouts_per_second_per_worker']:>10.2f} {latency['p50']:>9.1f} {latency['p95']:>9.1f}  "
+              f"{result['pay_status_codes']}")
+
+
+if __name__ == '__main__':
+    main()
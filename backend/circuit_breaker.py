@@ -0,0 +1,225 @@
+# circuit_breaker.py
+"""
+Circuit breaker and bulkhead for calls to external services.
+
+The breaker keeps a rolling window of the most recent call outcomes. When the
+error rate or the slow-call rate in that window crosses its threshold the
+circuit opens and calls fail immediately for ``open_seconds``. After that a
+limited number of trial calls are let through (half-open); if they all succeed
+the circuit closes again, otherwise it re-opens.
+
+The bulkhead caps how many calls may be in flight at once in this process, so
+a slow dependency cannot tie up every worker thread.
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class GatewayUnavailableError(Exception):
+    """Raised instead of calling a dependency that is known to be unavailable."""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = max(1, int(round(retry_after)))
+
+
+class CircuitOpenError(GatewayUnavailableError):
+    pass
+
+
+class BulkheadFullError(GatewayUnavailableError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, name, window_size=20, min_calls=5, failure_rate_threshold=0.5,
+                 slow_call_seconds=5.0, slow_call_rate_threshold=0.8,
+                 open_seconds=30.0, half_open_max_calls=1, clock=time.monotonic):
+        self.name = name
+        self.window_size = window_size
+        self.min_calls = min_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.open_seconds = open_seconds
+        self.half_open_max_calls = half_open_max_calls
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window_size)  # (failed, slow) per call
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._half_open_in_flight = 0
+        self._half_open_successes = 0
+        self.rejected_calls = 0
+        self.state_changes = 0
+
+    @classmethod
+    def from_config(cls, name, config, prefix):
+        """Build a breaker from ``<prefix>_BREAKER_*`` config values."""
+        return cls(
+            name,
+            window_size=config[f'{prefix}_BREAKER_WINDOW'],
+            min_calls=config[f'{prefix}_BREAKER_MIN_CALLS'],
+            failure_rate_threshold=config[f'{prefix}_BREAKER_FAILURE_RATE'],
+            slow_call_seconds=config[f'{prefix}_BREAKER_SLOW_CALL_SECONDS'],
+            slow_call_rate_threshold=config[f'{prefix}_BREAKER_SLOW_CALL_RATE'],
+            open_seconds=config[f'{prefix}_BREAKER_OPEN_SECONDS'],
+        )
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == OPEN and self._clock() - self._opened_at >= self.open_seconds:
+            self._transition(HALF_OPEN)
+        return self._state
+
+    def _transition(self, state):
+        if state == self._state:
+            return
+        logger.warning(f"Circuit '{self.name}' {self._state} -> {state}")
+        self._state = state
+        self.state_changes += 1
+        if state == OPEN:
+            self._opened_at = self._clock()
+        elif state == HALF_OPEN:
+            self._half_open_in_flight = 0
+            self._half_open_successes = 0
+        elif state == CLOSED:
+            self._outcomes.clear()
+
+    def _retry_after(self):
+        return self.open_seconds - (self._clock() - self._opened_at)
+
+    def before_call(self):
+        """Reserve permission for one call or raise ``CircuitOpenError``.
+
+        Returns the state the call was allowed in; pass it to ``record``.
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == OPEN:
+                self.rejected_calls += 1
+                raise CircuitOpenError(f"Circuit '{self.name}' is open", self._retry_after())
+            if state == HALF_OPEN:
+                if self._half_open_in_flight >= self.half_open_max_calls:
+                    self.rejected_calls += 1
+                    raise CircuitOpenError(f"Circuit '{self.name}' is half-open", 1)
+                self._half_open_in_flight += 1
+            return state
+
+    def record(self, failed, duration, allowed_state):
+        """Record the outcome of a call that ``before_call`` allowed in ``allowed_state``.
+
+        Only calls let through as trials decide a half-open circuit, and only
+        calls made while closed count towards opening it. A call that outlives
+        the state it started in changes nothing.
+        """
+        slow = duration >= self.slow_call_seconds
+        with self._lock:
+            if allowed_state == HALF_OPEN:
+                if self._state != HALF_OPEN:
+                    return  # another trial already re-opened the circuit
+                self._half_open_in_flight = max(0, self._half_open_in_flight - 1)
+                if failed or slow:
+                    self._transition(OPEN)
+                else:
+                    self._half_open_successes += 1
+                    if self._half_open_successes >= self.half_open_max_calls:
+                        self._transition(CLOSED)
+                return
+
+            if self._state != CLOSED:
+                return
+            self._outcomes.append((failed, slow))
+            if len(self._outcomes) < self.min_calls:
+                return
+            calls = len(self._outcomes)
+            failure_rate = sum(1 for f, _ in self._outcomes if f) / calls
+            slow_rate = sum(1 for _, s in self._outcomes if s) / calls
+            if failure_rate >= self.failure_rate_threshold or slow_rate >= self.slow_call_rate_threshold:
+                logger.error(
+                    f"Opening circuit '{self.name}': failure rate {failure_rate:.0%}, "
+                    f"slow call rate {slow_rate:.0%} over {calls} calls"
+                )
+                self._transition(OPEN)
+
+    def call(self, func, *args, is_failure=None, **kwargs):
+        """Run ``func`` through the breaker.
+
+        Exceptions count as failures. ``is_failure`` may classify a returned
+        value as a failure too (for example an HTTP 5xx response).
+        """
+        allowed_state = self.before_call()
+        started = self._clock()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record(True, self._clock() - started, allowed_state)
+            raise
+        self.record(bool(is_failure and is_failure(result)), self._clock() - started, allowed_state)
+        return result
+
+    def snapshot(self):
+        with self._lock:
+            state = self._current_state()
+            calls = len(self._outcomes)
+            return {
+                'name': self.name,
+                'state': state,
+                'window_calls': calls,
+                'failure_rate': (sum(1 for f, _ in self._outcomes if f) / calls) if calls else 0.0,
+                'slow_call_rate': (sum(1 for _, s in self._outcomes if s) / calls) if calls else 0.0,
+                'rejected_calls': self.rejected_calls,
+                'state_changes': self.state_changes,
+                'retry_after': max(0.0, self._retry_after()) if state == OPEN else 0.0
+            }
+
+
+class Bulkhead:
+    def __init__(self, name, max_concurrent, acquire_timeout=0.0):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.acquire_timeout = acquire_timeout
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected_calls = 0
+
+    def __enter__(self):
+        if self.acquire_timeout:
+            acquired = self._semaphore.acquire(timeout=self.acquire_timeout)
+        else:
+            acquired = self._semaphore.acquire(blocking=False)
+        if not acquired:
+            with self._lock:
+                self.rejected_calls += 1
+            raise BulkheadFullError(f"Too many concurrent '{self.name}' calls", 1)
+        with self._lock:
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with self._lock:
+            self.in_flight -= 1
+        self._semaphore.release()
+        return False
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'name': self.name,
+                'max_concurrent': self.max_concurrent,
+                'in_flight': self.in_flight,
+                'rejected_calls': self.rejected_calls
+            }
@@ -1,32 +1,257 @@
 import os
+import tempfile
 from dotenv import load_dotenv
 
 load_dotenv()
 
 class Config:
-    SECRET_KEY = os.environ.get('SECRET_KEY', 'dev')
-    SQLALCHEMY_DATABASE_URI = (
+    SECRET_KEY = os.environ.get('SECRET_KEY')  # signs session and reset tokens; required outside tests
+    # DATABASE_URL overrides the MySQL settings (e.g. sqlite:///local.db for offline runs)
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or (
         f"mysql+pymysql://{os.environ.get('DB_USER')}:{os.environ.get('DB_PASSWORD')}"
         f"@{os.environ.get('DB_HOST', 'localhost')}:{os.environ.get('DB_PORT', '3306')}/{os.environ.get('DB_NAME')}"
     )
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Read replicas for @read_replica views: full URLs, or hosts sharing the primary's credentials
+    SQLALCHEMY_REPLICA_URIS = [u.strip() for u in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if u.strip()] or [
+        f"mysql+pymysql://{os.environ.get('DB_USER')}:{os.environ.get('DB_PASSWORD')}@{host.strip()}/{os.environ.get('DB_NAME')}"
+        for host in os.environ.get('DB_REPLICA_HOSTS', '').split(',') if host.strip()
+    ]
+    DB_REPLICA_STICKY_SECONDS = int(os.environ.get('DB_REPLICA_STICKY_SECONDS', '5'))  # reads stay on the primary after a write
+    DB_REPLICA_RETRY_SECONDS = float(os.environ.get('DB_REPLICA_RETRY_SECONDS', '30'))  # a failed replica sits out this long
+    
+    # Connection pool per engine (see database.py); ignored for SQLite
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '10'))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '10'))
+    DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))  # seconds to wait for a free connection
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', '280'))  # below MySQL's wait_timeout on managed hosts
+    DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+    DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', '5'))
+    DB_READ_TIMEOUT = int(os.environ.get('DB_READ_TIMEOUT', '30'))
+    DB_WRITE_TIMEOUT = int(os.environ.get('DB_WRITE_TIMEOUT', '30'))
+    # Set on every new SQLite connection (journal_mode is skipped for in-memory databases).
+    # Override with SQLITE_PRAGMAS='synchronous=FULL;cache_size=-64000'
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',  # readers don't block the writer
+        'synchronous': 'NORMAL',  # safe with WAL; only the last commits can be lost on power failure
+        'busy_timeout': '5000',  # ms to wait for the write lock instead of failing
+        'foreign_keys': 'ON',  # enforce them like InnoDB does
+        'cache_size': '-16000',  # KiB of page cache per connection
+        'temp_store': 'MEMORY',
+        'mmap_size': str(128 * 1024 * 1024),
+        **dict(
+            item.split('=', 1) for item in os.environ.get('SQLITE_PRAGMAS', '').split(';') if '=' in item
+        )
+    }
     PESAPAL_CONSUMER_KEY = os.environ.get('PESAPAL_CONSUMER_KEY')
     PESAPAL_CONSUMER_SECRET = os.environ.get('PESAPAL_CONSUMER_SECRET')
     
     # Production settings
     PESAPAL_IPN_SECRET = os.environ.get('PESAPAL_IPN_SECRET', 'your-ipn-secret-key')
     PESAPAL_BASE_URL = os.environ.get('PESAPAL_BASE_URL', 'https://pay.pesapal.com/v3/api')
+    PESAPAL_CALLBACK_URL = os.environ.get('PESAPAL_CALLBACK_URL', 'https://books-management-system-bcr5.onrender.com/api/pesapal-callback')
     
     # API Base URL for frontend
     API_BASE_URL = os.environ.get('API_BASE_URL', 'http://localhost:5000')
     
-    # Logging configuration
-    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
-    LOG_FILE = os.environ.get('LOG_FILE', 'app.log')
+    # Logging configuration (see logging_config.py)
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')  # e.g. 'INFO,werkzeug=WARNING,auth_tokens=DEBUG'
+    LOG_FILE = os.environ.get('LOG_FILE', 'app.log')  # empty = stderr only; only a path with '{pid}' (one file per worker) rotates
+    LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')  # json or text
+    LOG_ROTATE_WHEN = os.environ.get('LOG_ROTATE_WHEN', 'size')  # 'size' or a TimedRotatingFileHandler 'when' (midnight, H, ...); {pid} files only
+    LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+    LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', '7'))
+    LOG_COMPRESS = os.environ.get('LOG_COMPRESS', 'true').lower() == 'true'  # gzip rotated files
+    LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))  # records beyond this are dropped, not waited on
+    LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', '1'))
+    
+    # Prometheus metrics (see metrics.py); multiprocess mode is enabled by PROMETHEUS_MULTIPROC_DIR
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # /metrics and /api/metrics/gateway require 'Authorization: Bearer <token>'; unset, they are off
+    
+    # Request tracing (see tracing.py)
+    TRACE_EXPORT = os.environ.get('TRACE_EXPORT', 'none')  # none, file or otlp
+    TRACE_FILE = os.environ.get('TRACE_FILE', 'traces.jsonl')  # '{pid}' gives one file per worker
+    TRACE_COLLECTOR_URL = os.environ.get('TRACE_COLLECTOR_URL', 'http://localhost:4318/v1/traces')
+    TRACE_SERVICE_NAME = os.environ.get('TRACE_SERVICE_NAME', 'somafy-backend')
+    TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '1'))  # for traces started here
+    # true or false; unset, statements are commented only when spans are exported
+    TRACE_SQL_COMMENTS = {'true': True, 'false': False}.get(os.environ.get('TRACE_SQL_COMMENTS', '').lower())
+    TRACE_QUEUE_SIZE = int(os.environ.get('TRACE_QUEUE_SIZE', '10000'))  # spans beyond this are dropped
+    
+    # SQL profiler (see sql_profiler.py), off by default
+    SQL_PROFILER_ENABLED = os.environ.get('SQL_PROFILER_ENABLED', 'false').lower() == 'true'
+    SQL_SLOW_QUERY_MS = float(os.environ.get('SQL_SLOW_QUERY_MS', '200'))  # logged with their EXPLAIN
+    SQL_PROFILER_EXPLAIN = os.environ.get('SQL_PROFILER_EXPLAIN', 'true').lower() == 'true'
+    SQL_N_PLUS_ONE_THRESHOLD = int(os.environ.get('SQL_N_PLUS_ONE_THRESHOLD', '5'))  # same-shape queries per request
+    SQL_SERVER_TIMING = os.environ.get('SQL_SERVER_TIMING', 'false').lower() == 'true'  # adds a Server-Timing header
+    
+    # On-demand profiling for admins (see profiling.py)
+    PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'profiles'))
+    PROFILER_MAX_SECONDS = float(os.environ.get('PROFILER_MAX_SECONDS', '60'))
+    PROFILER_INTERVAL_MS = float(os.environ.get('PROFILER_INTERVAL_MS', '10'))
+    MEMORY_PROFILE_MAX_SECONDS = float(os.environ.get('MEMORY_PROFILE_MAX_SECONDS', '600'))  # tracemalloc stops itself
+    MEMORY_PROFILE_FRAMES = int(os.environ.get('MEMORY_PROFILE_FRAMES', '10'))
     
     # Security settings
     ALLOWED_HOSTS = os.environ.get('ALLOWED_HOSTS', '*').split(',')
     RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
-    RATE_LIMIT_REQUESTS = int(os.environ.get('RATE_LIMIT_REQUESTS', '100'))
-    RATE_LIMIT_WINDOW = int(os.environ.get('RATE_LIMIT_WINDOW', '3600'))  # 1 hour 
-    PESAPAL_NOTIFICATION_ID = os.environ.get('PESAPAL_NOTIFICATION_ID', '4ad16ada-f09b-4b45-8c18-db86b60a879d') 
\ No newline at end of file
+    # Default policy for endpoints not listed in RATE_LIMITS, per client IP
+    RATE_LIMIT_REQUESTS = int(os.environ.get('RATE_LIMIT_REQUESTS', '300'))
+    RATE_LIMIT_WINDOW = int(os.environ.get('RATE_LIMIT_WINDOW', '60'))  # seconds
+    # Per-endpoint policies: 'N/period' with an optional ' burst B'; a 'user:' prefix keys
+    # the bucket by user id for authenticated requests. Override with
+    # RATE_LIMIT_POLICIES='login=5/minute;pay=user:10/minute'
+    RATE_LIMITS = {
+        'login': '10/minute burst 5',
+        'register': '5/hour',
+        'reset_password': '5/hour',
+        'change_password': 'user:5/minute',
+        'refresh_token': '30/minute',
+        'pay': 'user:20/minute',
+        **dict(
+            item.split('=', 1) for item in os.environ.get('RATE_LIMIT_POLICIES', '').split(';') if '=' in item
+        )
+    }
+    RATE_LIMIT_EXEMPT = ['pesapal_callback', 'index', 'admin_dashboard', 'admin_static', 'user_dashboard', 'user_static',
+                         'prometheus_metrics', 'healthz', 'readyz']
+    RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'shared')  # 'shared' (all workers on the node) or 'memory'
+    RATE_LIMIT_SHARED_PATH = os.environ.get('RATE_LIMIT_SHARED_PATH')  # default: /dev/shm/ratelimit-<uid>-<slots>.bin
+    RATE_LIMIT_SHARED_SLOTS = int(os.environ.get('RATE_LIMIT_SHARED_SLOTS', '65536'))
+    # Proxies in front of the app that append to X-Forwarded-For: 1 on Render and Heroku, 0 when
+    # clients connect directly. Left at 0 behind a proxy, all clients share the proxy's limits
+    RATE_LIMIT_TRUSTED_PROXIES = int(os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', '0'))
+    PESAPAL_NOTIFICATION_ID = os.environ.get('PESAPAL_NOTIFICATION_ID', '4ad16ada-f09b-4b45-8c18-db86b60a879d')
+
+    # Payment archival (see archive.py); COMPLETED payments are never archived
+    PAYMENT_ARCHIVE_AFTER_DAYS = int(os.environ.get('PAYMENT_ARCHIVE_AFTER_DAYS', '30'))  # FAILED and CANCELLED
+    PAYMENT_ABANDONED_AFTER_DAYS = int(os.environ.get('PAYMENT_ABANDONED_AFTER_DAYS', '30'))  # PENDING, no IPN by then
+    PAYMENT_ARCHIVE_BATCH_SIZE = int(os.environ.get('PAYMENT_ARCHIVE_BATCH_SIZE', '500'))  # rows per transaction
+    PAYMENT_ARCHIVE_PAUSE_SECONDS = float(os.environ.get('PAYMENT_ARCHIVE_PAUSE_SECONDS', '0.2'))  # between batches
+
+    # Admin dashboard counters (see counters.py): rows per counter, so concurrent writers rarely share one
+    STAT_COUNTER_SHARDS = int(os.environ.get('STAT_COUNTER_SHARDS', '8'))
+
+    # Background jobs (see jobs.py), run by `flask jobs worker`
+    JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', '60'))  # a job is taken over this long after its last heartbeat
+    JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', '2'))  # idle workers check for due jobs this often
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '5'))  # unless the task sets its own
+    JOB_RETRY_BASE_SECONDS = float(os.environ.get('JOB_RETRY_BASE_SECONDS', '10'))  # doubles with every failed attempt
+    JOB_RETRY_MAX_SECONDS = float(os.environ.get('JOB_RETRY_MAX_SECONDS', '3600'))
+    JOB_KEEP_DAYS = int(os.environ.get('JOB_KEEP_DAYS', '7'))  # finished jobs are purged after this
+    # Running jobs per queue across all workers, e.g. JOB_QUEUE_CONCURRENCY='default=4;mail=2'
+    JOB_DEFAULT_CONCURRENCY = int(os.environ.get('JOB_DEFAULT_CONCURRENCY', '2'))
+    JOB_QUEUE_CONCURRENCY = dict(
+        item.split('=', 1) for item in os.environ.get('JOB_QUEUE_CONCURRENCY', '').split(';') if '=' in item
+    )
+    # Cron overrides for scheduled tasks, e.g. JOB_SCHEDULES='archive-payments=30 2 * * *;purge-jobs=off'
+    JOB_SCHEDULES = dict(
+        item.split('=', 1) for item in os.environ.get('JOB_SCHEDULES', '').split(';') if '=' in item
+    )
+
+    # Outgoing mail and webhooks (see outbox.py), sent by the 'deliver-outbox' job
+    OUTBOX_MAIL_TRANSPORT = os.environ.get('OUTBOX_MAIL_TRANSPORT', 'smtp')  # 'file' only in development: it keeps live reset links
+    OUTBOX_WEBHOOK_TRANSPORT = os.environ.get('OUTBOX_WEBHOOK_TRANSPORT', 'webhook')  # or 'file'
+    OUTBOX_FILE_DIR = os.environ.get('OUTBOX_FILE_DIR', os.path.join(tempfile.gettempdir(), f"outbox-{os.getuid()}"))  # 'file' transport, mode 0700
+    OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '100'))  # messages per claim, sent over one connection
+    OUTBOX_CLAIM_SECONDS = int(os.environ.get('OUTBOX_CLAIM_SECONDS', '300'))  # a claimed batch is retried after this if its sender dies
+    OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '10'))
+    OUTBOX_RETRY_BASE_SECONDS = float(os.environ.get('OUTBOX_RETRY_BASE_SECONDS', '30'))  # doubles with every failed attempt
+    OUTBOX_RETRY_MAX_SECONDS = float(os.environ.get('OUTBOX_RETRY_MAX_SECONDS', '21600'))
+    OUTBOX_KEEP_DAYS = int(os.environ.get('OUTBOX_KEEP_DAYS', '30'))  # sent and failed messages are purged after this
+    SMTP_HOST = os.environ.get('SMTP_HOST', 'localhost')
+    SMTP_PORT = int(os.environ.get('SMTP_PORT', '587'))
+    SMTP_USERNAME = os.environ.get('SMTP_USERNAME')
+    SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD')
+    SMTP_SECURITY = os.environ.get('SMTP_SECURITY', 'starttls')  # starttls, ssl or none
+    SMTP_TIMEOUT = float(os.environ.get('SMTP_TIMEOUT', '10'))
+    MAIL_FROM = os.environ.get('MAIL_FROM', 'Books Management System <no-reply@localhost>')
+    # Receivers of payment.completed events; each call is signed with WEBHOOK_SECRET
+    WEBHOOK_URLS = [u.strip() for u in os.environ.get('WEBHOOK_URLS', '').split(',') if u.strip()]
+    WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+    WEBHOOK_TIMEOUT = float(os.environ.get('WEBHOOK_TIMEOUT', '10'))
+    PASSWORD_RESET_TTL = int(os.environ.get('PASSWORD_RESET_TTL', '3600'))  # reset links expire after an hour
+    # The reset mail links here with ?token=...; the page posts it to /api/reset_password/confirm
+    PASSWORD_RESET_URL = os.environ.get('PASSWORD_RESET_URL', 'https://books-management-system-bcr5.onrender.com/user/index.html')
+    DOWNLOAD_URL = os.environ.get('DOWNLOAD_URL', 'https://books-management-system-bcr5.onrender.com/user/download-success.html')
+
+    # Preload the catalog, facet counts and gateway token before serving (see health.py)
+    WARMUP_ENABLED = os.environ.get('WARMUP_ENABLED', 'true').lower() == 'true'
+
+    # Batched backfills in migrations (see online_migration.py)
+    MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', '1000'))  # rows per transaction
+    MIGRATION_PAUSE_SECONDS = float(os.environ.get('MIGRATION_PAUSE_SECONDS', '0.1'))  # between batches
+
+    # Idempotency settings
+    IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', '86400'))  # 24 hours
+    IDEMPOTENCY_LOCK_TIMEOUT = int(os.environ.get('IDEMPOTENCY_LOCK_TIMEOUT', '60'))  # in-flight claim expiry
+
+    # PesaPal gateway resilience settings
+    PESAPAL_CONNECT_TIMEOUT = float(os.environ.get('PESAPAL_CONNECT_TIMEOUT', '5'))
+    PESAPAL_READ_TIMEOUT = float(os.environ.get('PESAPAL_READ_TIMEOUT', '30'))
+    PESAPAL_TOKEN_TTL = int(os.environ.get('PESAPAL_TOKEN_TTL', '240'))  # tokens last 5 minutes; reused for this long
+    PESAPAL_MAX_CONCURRENT_CALLS = int(os.environ.get('PESAPAL_MAX_CONCURRENT_CALLS', '4'))  # per worker process
+    PESAPAL_BULKHEAD_TIMEOUT = float(os.environ.get('PESAPAL_BULKHEAD_TIMEOUT', '0'))  # 0 = reject immediately when full
+    PESAPAL_BREAKER_WINDOW = int(os.environ.get('PESAPAL_BREAKER_WINDOW', '20'))  # calls in the rolling window
+    PESAPAL_BREAKER_MIN_CALLS = int(os.environ.get('PESAPAL_BREAKER_MIN_CALLS', '5'))
+    PESAPAL_BREAKER_FAILURE_RATE = float(os.environ.get('PESAPAL_BREAKER_FAILURE_RATE', '0.5'))
+    PESAPAL_BREAKER_SLOW_CALL_SECONDS = float(os.environ.get('PESAPAL_BREAKER_SLOW_CALL_SECONDS', '5'))
+    PESAPAL_BREAKER_SLOW_CALL_RATE = float(os.environ.get('PESAPAL_BREAKER_SLOW_CALL_RATE', '0.8'))
+    PESAPAL_BREAKER_OPEN_SECONDS = float(os.environ.get('PESAPAL_BREAKER_OPEN_SECONDS', '30'))
+
+    # Password hashing (Werkzeug method string, e.g. 'scrypt' or 'pbkdf2:sha256:1000000')
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '1'))  # pool processes per worker, 0 = inline
+    PASSWORD_HASH_MAX_QUEUE = int(os.environ.get('PASSWORD_HASH_MAX_QUEUE', '8'))  # waiting calls before rejecting
+    PASSWORD_HASH_ACQUIRE_TIMEOUT = float(os.environ.get('PASSWORD_HASH_ACQUIRE_TIMEOUT', '0'))
+    PASSWORD_HASH_START_METHOD = os.environ.get('PASSWORD_HASH_START_METHOD')  # default: forkserver where available
+
+    # Session tokens (signed with SECRET_KEY)
+    ACCESS_TOKEN_TTL = int(os.environ.get('ACCESS_TOKEN_TTL', '900'))  # 15 minutes
+    REFRESH_TOKEN_TTL = int(os.environ.get('REFRESH_TOKEN_TTL', '1209600'))  # 14 days
+    TOKEN_REVOCATION_REFRESH_SECONDS = float(os.environ.get('TOKEN_REVOCATION_REFRESH_SECONDS', '30'))
+    ADMIN_USERNAMES = [u.strip() for u in os.environ.get('ADMIN_USERNAMES', 'admin').split(',') if u.strip()]
+
+
+class SQLiteConfig(Config):
+    """Whole app on one SQLite file in WAL mode, for local development and benchmarks."""
+    # Relative paths are resolved against the instance folder (backend/instance)
+    SQLALCHEMY_DATABASE_URI = os.environ.get('SQLITE_URL', 'sqlite:///local.db')
+    SQLALCHEMY_REPLICA_URIS = []
+    LOG_FILE = os.environ.get('LOG_FILE', '')
+    LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+
+
+class TestConfig(SQLiteConfig):
+    """In-memory database and cheap settings for the Flask test client."""
+    TESTING = True
+    SECRET_KEY = 'test'
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    LOG_FILE = ''
+    LOG_LEVEL = os.environ.get('TEST_LOG_LEVEL', 'WARNING')
+    # No gateway credentials: payments complete in test mode without calling PesaPal
+    PESAPAL_CONSUMER_KEY = None
+    PESAPAL_CONSUMER_SECRET = None
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+    PASSWORD_HASH_WORKERS = 0
+    RATE_LIMIT_ENABLED = False
+    RATE_LIMIT_BACKEND = 'memory'
+    TRACE_EXPORT = 'none'
+    SQL_PROFILER_ENABLED = False
+    WARMUP_ENABLED = False
+
+
+# Selected with APP_CONFIG; 'default' uses DATABASE_URL or the MySQL settings
+CONFIG_PROFILES = {
+    'default': Config,
+    'sqlite': SQLiteConfig,
+    'test': TestConfig,
+}
+
+
+def config_profile(name=None):
+    """The config class for ``name`` (default: the APP_CONFIG environment variable)."""
+    name = name or os.environ.get('APP_CONFIG', 'default')
+    try:
+        return CONFIG_PROFILES[name]
+    except KeyError:
+        raise ValueError(f"Unknown APP_CONFIG {name!r}, expected one of {', '.join(CONFIG_PROFILES)}")
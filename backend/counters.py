@@ -0,0 +1,143 @@
+# counters.py
+"""
+Dashboard counters.
+
+``StatCounter`` holds running totals (resources per type/class/subject,
+users, payments and amounts per status) so ``/api/admin/stats`` reads a
+handful of rows instead of counting tables. Resource and user inserts and
+deletes are counted by a ``before_flush`` hook, so every code path that adds
+them through the ORM is covered. Payment status changes are made with bulk
+compare-and-set updates that bypass the ORM, so the payment write paths call
+``count_payment_change`` explicitly, next to the sales rollups.
+
+Each counter is spread over ``STAT_COUNTER_SHARDS`` rows and a write adds to
+one picked at random, so concurrent registrations and payments rarely wait
+on the same row lock; reads sum the shards. Nothing is written that every
+write touches: totals are the sum of the per-status rows, and the endpoint's
+ETag is a hash of the counters it returns.
+"""
+import hashlib
+import json
+import logging
+import random
+from collections import defaultdict
+
+from flask import current_app
+from sqlalchemy import delete, event, func, select
+
+from archive import payment_history
+from db_helpers import upsert_increment
+from models import db, payment_status_name, Resource, StatCounter, User
+
+logger = logging.getLogger(__name__)
+
+
+def _apply(changes, session=None, shard=None):
+    """Add ``changes`` ({(scope, key): [count, amount]}) to one shard of each counter."""
+    changes = {k: v for k, v in changes.items() if v[0] or v[1]}
+    if not changes:
+        return
+    if shard is None:
+        shard = random.randrange(max(current_app.config['STAT_COUNTER_SHARDS'], 1))
+    for (scope, key), (count, amount) in sorted(changes.items()):
+        upsert_increment(StatCounter, {'scope': scope, 'key': key, 'shard': shard}, {},
+                         {'count': count, 'amount': amount}, session)
+
+
+def _resource_changes(changes, resource, sign):
+    changes[('resources', 'total')][0] += sign
+    changes[('resource_type', resource.resource_type or '')][0] += sign
+    changes[('class_grade', resource.class_grade or '')][0] += sign
+    changes[('subject', resource.subject or '')][0] += sign
+
+
+@event.listens_for(db.session, 'before_flush')
+def _count_inserts_and_deletes(session, flush_context, instances):
+    changes = defaultdict(lambda: [0, 0.0])
+    for obj, sign in [(o, 1) for o in session.new] + [(o, -1) for o in session.deleted]:
+        if isinstance(obj, Resource):
+            _resource_changes(changes, obj, sign)
+        elif isinstance(obj, User):
+            changes[('users', 'total')][0] += sign
+    _apply(changes, session)
+
+
+def count_payment_change(payment, old_status=None, new_status=None):
+    """Move ``payment`` between status counters inside the current transaction. The caller commits."""
+    if old_status == new_status:
+        return
+    changes = defaultdict(lambda: [0, 0.0])
+    amount = float(payment.amount or 0)
+    if old_status:
+        changes[('payments', old_status)][0] -= 1
+        changes[('payments', old_status)][1] -= amount
+    if new_status:
+        changes[('payments', new_status)][0] += 1
+        changes[('payments', new_status)][1] += amount
+    _apply(changes)
+
+
+def counter_value(scope, key):
+    return db.session.query(func.sum(StatCounter.count)).filter_by(scope=scope, key=key).scalar() or 0
+
+
+def stats_etag(stats):
+    """ETag for ``dashboard_stats()``: a revalidation reads the counters but sends no body."""
+    digest = hashlib.sha1(json.dumps(stats, sort_keys=True).encode()).hexdigest()
+    return f"stats-{digest[:16]}"
+
+
+def dashboard_stats():
+    """All counters, shaped for the admin dashboard."""
+    stats = {
+        'resources': {'total': 0, 'by_type': {}, 'by_class': {}, 'by_subject': {}},
+        'users': {'total': 0},
+        'payments': {'total': 0, 'amount': 0.0, 'by_status': {}},
+    }
+    groups = {'resource_type': 'by_type', 'class_grade': 'by_class', 'subject': 'by_subject'}
+    rows = db.session.query(StatCounter.scope, StatCounter.key, func.sum(StatCounter.count),
+                            func.sum(StatCounter.amount)).group_by(StatCounter.scope, StatCounter.key)
+    amount_total = 0.0
+    for scope, key, count, amount in sorted(rows):
+        if scope == 'resources':
+            stats['resources']['total'] = count
+        elif scope in groups and count:
+            stats['resources'][groups[scope]][key] = count
+        elif scope == 'users':
+            stats['users']['total'] = count
+        elif scope == 'payments':
+            stats['payments']['total'] += count
+            amount_total += amount
+            if count:
+                stats['payments']['by_status'][key] = {'count': count, 'amount': round(amount, 2)}
+    stats['payments']['amount'] = round(amount_total, 2)
+    return stats
+
+
+def rebuild_counters():
+    """Recompute every counter from the base tables (archived payments included) in one transaction.
+
+    Returns the rows written.
+    """
+    db.session.execute(delete(StatCounter))
+    changes = defaultdict(lambda: [0, 0.0])
+
+    for column, name in ((Resource.resource_type, 'resource_type'), (Resource.class_grade, 'class_grade'),
+                         (Resource.subject, 'subject')):
+        for value, count in db.session.query(column, func.count()).group_by(column):
+            changes[(name, value or '')][0] += count
+            if name == 'resource_type':
+                changes[('resources', 'total')][0] += count
+    changes[('users', 'total')][0] = db.session.query(func.count(User.id)).scalar()
+    history = payment_history()
+    status = payment_status_name(history.c.status)
+    for value, count, amount in db.session.execute(
+        select(status, func.count(), func.coalesce(func.sum(history.c.amount), 0)).group_by(status)
+    ):
+        changes[('payments', value)] = [count, float(amount)]
+
+    # Writes land in an emptied table, so increments are plain inserts
+    _apply(changes, shard=0)
+    db.session.commit()
+    logger.info(f"Rebuilt {len(changes)} dashboard counters")
+    return len(changes)
@@ -0,0 +1,243 @@
+# database.py
+"""
+Database engines and read-replica routing.
+
+``configure_database(app)`` turns the ``DB_POOL_*`` and ``DB_*_TIMEOUT``
+settings into ``SQLALCHEMY_ENGINE_OPTIONS`` for the dialect in use, and
+registers each URL in ``SQLALCHEMY_REPLICA_URIS`` as a Flask-SQLAlchemy bind
+(``replica_0``, ``replica_1``, ...) with the same options. Call it before
+``db.init_app(app)``. ``configure_sqlite(app, db)``, called after it, applies
+``SQLITE_PRAGMAS`` (WAL, ``synchronous=NORMAL``, a busy timeout, ...) to
+SQLite connections.
+
+``RoutingSession`` is the session class behind ``db.session``. In a view
+decorated with ``@read_replica`` its reads go to one replica, chosen per
+request. Flushes, bulk ``UPDATE``/``DELETE``/``INSERT`` statements and every
+other view stay on the primary. Clients that wrote something recently also
+read from the primary: any successful ``POST``/``PUT``/``PATCH``/``DELETE``
+sets a short-lived cookie (``DB_REPLICA_STICKY_SECONDS``) that keeps that
+client's reads there, so nobody misses their own change because of
+replication lag.
+
+A replica that raises a connection error is taken out of rotation for
+``DB_REPLICA_RETRY_SECONDS``, and the request that hit the error is run
+again against the primary. This is safe because only read-only views are
+decorated.
+"""
+import logging
+import os
+import random
+import threading
+import time
+import weakref
+from functools import wraps
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+logger = logging.getLogger(__name__)
+
+STICKY_COOKIE = 'db_primary'
+WRITE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+
+def engine_options(url, config):
+    """Pool and driver settings for ``url`` from the DB_* config values."""
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend == 'sqlite':
+        # Flask-SQLAlchemy picks the pool for SQLite (StaticPool in memory)
+        return {}
+    options = {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+    if backend == 'mysql':
+        options['connect_args'] = {
+            'connect_timeout': config['DB_CONNECT_TIMEOUT'],
+            'read_timeout': config['DB_READ_TIMEOUT'],
+            'write_timeout': config['DB_WRITE_TIMEOUT'],
+        }
+    return options
+
+
+def configure_database(app):
+    """Fill in engine options and replica binds from the app config."""
+    config = app.config
+    options = engine_options(config['SQLALCHEMY_DATABASE_URI'], config)
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = {**options, **config.get('SQLALCHEMY_ENGINE_OPTIONS', {})}
+    binds = dict(config.get('SQLALCHEMY_BINDS') or {})
+    replica_keys = []
+    for index, url in enumerate(config['SQLALCHEMY_REPLICA_URIS']):
+        key = f"replica_{index}"
+        binds[key] = {'url': url, **engine_options(url, config)}
+        replica_keys.append(key)
+    config['SQLALCHEMY_BINDS'] = binds
+    replica_router.configure(replica_keys, config['DB_REPLICA_STICKY_SECONDS'], config['DB_REPLICA_RETRY_SECONDS'])
+
+
+def _sqlite_pragma_hook(pragmas, in_memory):
+    statements = [f"PRAGMA {name}={value}" for name, value in pragmas.items()
+                  if not (in_memory and name == 'journal_mode')]
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+    return set_pragmas
+
+
+def configure_sqlite(app, db):
+    """Run ``SQLITE_PRAGMAS`` on every new connection of the app's SQLite engines.
+
+    Call it after ``db.init_app(app)``; engines for other databases are left alone.
+    """
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name != 'sqlite':
+                continue
+            in_memory = engine.url.database in (None, '', ':memory:') or engine.url.query.get('mode') == 'memory'
+            event.listen(engine, 'connect', _sqlite_pragma_hook(app.config['SQLITE_PRAGMAS'], in_memory))
+
+
+# Engines of every app in this process, for dispose_engines_after_fork
+_fork_engines = weakref.WeakSet()
+
+
+def _dispose_inherited_engines():
+    for engine in list(_fork_engines):
+        # close=False: the parent's connections stay open for the parent
+        engine.dispose(close=False)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_dispose_inherited_engines)
+
+
+def dispose_engines_after_fork(app, db):
+    """Make forked children (gunicorn ``preload_app`` workers) open their own connections.
+
+    A connection pooled before the fork would otherwise be shared by the
+    parent and every worker, interleaving their traffic on one socket.
+    """
+    with app.app_context():
+        _fork_engines.update(db.engines.values())
+
+
+class ReplicaRouter:
+    def __init__(self):
+        self.replica_keys = []
+        self.sticky_seconds = 5
+        self.retry_seconds = 30
+        self._down_until = {}
+        self._lock = threading.Lock()
+        self._listening = weakref.WeakSet()
+        self.db = None
+
+    def configure(self, replica_keys, sticky_seconds, retry_seconds):
+        self.replica_keys = list(replica_keys)
+        self.sticky_seconds = sticky_seconds
+        self.retry_seconds = retry_seconds
+        self._down_until = {}
+
+    def init_app(self, app, db):
+        """Watch replica engines for connection errors and set the sticky cookie after writes."""
+        self.db = db
+        with app.app_context():
+            for key in self.replica_keys:
+                engine = db.engines[key]
+                if engine not in self._listening:
+                    event.listen(engine, 'handle_error', self._make_error_handler(key))
+                    self._listening.add(engine)
+        if self.replica_keys:
+            app.after_request(self._mark_writer)
+
+    def _make_error_handler(self, key):
+        def handle_error(context):
+            # Refused or dropped connections, unreachable files and the like
+            if context.is_disconnect or isinstance(context.sqlalchemy_exception, OperationalError):
+                self.mark_down(key)
+                if has_request_context():
+                    g.db_replica_failed = True
+        return handle_error
+
+    def mark_down(self, key):
+        with self._lock:
+            self._down_until[key] = time.monotonic() + self.retry_seconds
+        logger.warning(f"Read replica {key} failed, using the primary for {self.retry_seconds}s")
+
+    def healthy_replicas(self):
+        now = time.monotonic()
+        return [key for key in self.replica_keys if self._down_until.get(key, 0) <= now]
+
+    def read_bind(self, session, clause):
+        """The replica engine for this read, or None for the primary."""
+        if not has_request_context() or not g.get('db_read_replica') or session._flushing:
+            return None
+        if clause is not None and getattr(clause, 'is_dml', False):
+            return None
+        key = g.get('db_replica_key')
+        if key is None:
+            healthy = self.healthy_replicas()
+            if not healthy:
+                return None
+            key = g.db_replica_key = random.choice(healthy)
+        return session._db.engines[key]
+
+    def _mark_writer(self, response):
+        if request.method in WRITE_METHODS and response.status_code < 400:
+            response.set_cookie(STICKY_COOKIE, '1', max_age=self.sticky_seconds, httponly=True, samesite='Lax')
+        return response
+
+
+class RoutingSession(Session):
+    """Flask-SQLAlchemy session that sends reads in ``@read_replica`` views to a replica."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            replica = replica_router.read_bind(self, clause)
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def read_replica(view):
+    """Serve a read-only view from a replica when one is configured and healthy."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not replica_router.replica_keys or request.cookies.get(STICKY_COOKIE):
+            return view(*args, **kwargs)
+        g.db_read_replica = True
+        try:
+            try:
+                response = view(*args, **kwargs)
+            except DBAPIError:
+                if not g.get('db_replica_failed'):
+                    raise
+                response = None
+            if g.get('db_replica_failed'):
+                # Most views turn errors into a 500 themselves; either way, try the primary
+                logger.info(f"Retrying {request.endpoint} on the primary")
+                replica_router.db.session.rollback()
+                g.db_read_replica = False
+                g.db_replica_failed = False
+                return view(*args, **kwargs)
+            return response
+        finally:
+            # g outlives the request when an app context was already pushed (tests, CLI)
+            g.pop('db_read_replica', None)
+            g.pop('db_replica_key', None)
+            g.pop('db_replica_failed', None)
+    return wrapper
+
+
+replica_router = ReplicaRouter()
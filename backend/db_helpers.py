@@ -0,0 +1,41 @@
+# db_helpers.py
+"""
+Dialect-aware SQL helpers shared by the rollup and counter tables.
+"""
+from sqlalchemy import insert, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db
+
+
+def upsert_increment(model, keys, values, increments, session=None):
+    """Insert a row, or atomically add ``increments`` to the existing one.
+
+    ``keys`` must match a unique constraint. ``values`` are only written when
+    the row is created.
+    """
+    session = session or db.session
+    table = model.__table__
+    row = dict(keys, **values, **increments)
+    dialect = session.get_bind().dialect.name
+
+    if dialect == 'mysql':
+        stmt = mysql_insert(table).values(**row)
+        stmt = stmt.on_duplicate_key_update({c: table.c[c] + stmt.inserted[c] for c in increments})
+    elif dialect in ('sqlite', 'postgresql'):
+        dialect_insert = sqlite_insert if dialect == 'sqlite' else postgresql_insert
+        stmt = dialect_insert(table).values(**row)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={c: table.c[c] + stmt.excluded[c] for c in increments}
+        )
+    else:
+        result = session.execute(
+            update(table).filter_by(**keys).values({c: table.c[c] + v for c, v in increments.items()})
+        )
+        if result.rowcount:
+            return
+        stmt = insert(table).values(**row)
+    session.execute(stmt)
@@ -0,0 +1,130 @@
+# exports.py
+"""
+Streaming CSV / NDJSON exports.
+
+Rows are read through a server-side cursor (``stream_results`` with
+``yield_per``) as plain tuples, formatted in small chunks and optionally
+gzip-compressed on the fly, so memory use stays flat however many rows are
+exported. The same generators back the admin endpoints and the
+``flask export`` CLI commands. Payment exports include archived payments
+(see archive.py).
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import select
+
+from models import db, Payment, PaymentArchive, Resource
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+PAYMENT_COLUMNS = [
+    'id', 'order_tracking_id', 'transaction_tracking_id', 'merchant_reference', 'resource_id',
+    'user_email', 'amount', 'currency', 'status', 'payment_method', 'created_at', 'updated_at',
+    'ipn_received', 'ipn_received_at'
+]
+
+RESOURCE_COLUMNS = ['id', 'resource_type', 'class_grade', 'subject', 'title', 'description', 'cover']
+
+ROWS_PER_CHUNK = 500
+
+
+def payment_rows(start=None, end=None, status=None, resource_id=None, include_archived=True, batch_size=1000):
+    """Yield payment rows (tuples in PAYMENT_COLUMNS order) created in [start, end].
+
+    Archived payments, the older ones, come first; each table is read in id order.
+    """
+    tables = [PaymentArchive.__table__, Payment.__table__] if include_archived else [Payment.__table__]
+    for table in tables:
+        stmt = select(*[table.c[name] for name in PAYMENT_COLUMNS]).order_by(table.c.id)
+        if start:
+            stmt = stmt.where(table.c.created_at >= datetime.combine(start, datetime.min.time()))
+        if end:
+            stmt = stmt.where(table.c.created_at < datetime.combine(end + timedelta(days=1), datetime.min.time()))
+        if status:
+            stmt = stmt.where(table.c.status == status)
+        if resource_id:
+            stmt = stmt.where(table.c.resource_id == resource_id)
+        yield from db.session.execute(stmt.execution_options(stream_results=True, yield_per=batch_size))
+
+
+def resource_rows(resource_type=None, class_grade=None, subject=None, batch_size=1000):
+    """Yield resource rows (tuples in RESOURCE_COLUMNS order)."""
+    table = Resource.__table__
+    stmt = select(*[table.c[name] for name in RESOURCE_COLUMNS]).order_by(table.c.id)
+    if resource_type:
+        stmt = stmt.where(table.c.resource_type == resource_type)
+    if class_grade:
+        stmt = stmt.where(table.c.class_grade == class_grade)
+    if subject:
+        stmt = stmt.where(table.c.subject == subject)
+    yield from db.session.execute(stmt.execution_options(stream_results=True, yield_per=batch_size))
+
+
+def _plain(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def csv_chunks(rows, columns):
+    """Format rows as CSV, yielding encoded chunks of ROWS_PER_CHUNK rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    pending = 0
+    for row in rows:
+        writer.writerow([_plain(v) for v in row])
+        pending += 1
+        if pending >= ROWS_PER_CHUNK:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    yield buffer.getvalue().encode('utf-8')
+
+
+def ndjson_chunks(rows, columns):
+    """Format rows as newline-delimited JSON objects, yielding encoded chunks."""
+    lines = []
+    for row in rows:
+        lines.append(json.dumps({c: _plain(v) for c, v in zip(columns, row)}, separators=(',', ':')))
+        if len(lines) >= ROWS_PER_CHUNK:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+            lines = []
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def export_chunks(rows, columns, fmt):
+    if fmt == 'ndjson':
+        return ndjson_chunks(rows, columns)
+    return csv_chunks(rows, columns)
+
+
+def gzip_chunks(chunks, level=6):
+    """Compress a stream of byte chunks into a gzip stream."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def write_export(path, chunks):
+    """Write a chunk stream to ``path``, gzip-compressing when it ends in .gz. Returns bytes written."""
+    if path.endswith('.gz'):
+        chunks = gzip_chunks(chunks)
+    written = 0
+    with open(path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+            written += len(chunk)
+    return written
@@ -0,0 +1,52 @@
+# gunicorn.conf.py
+"""
+Gunicorn settings, picked up automatically when gunicorn starts in backend/.
+
+Workers write their Prometheus metrics to files in PROMETHEUS_MULTIPROC_DIR
+so /metrics can report the whole node (see metrics.py). The directory is
+emptied when gunicorn starts, since files left by a previous run would be
+added to this run's counters, and a worker's files are marked dead when it
+exits so its gauges stop counting.
+
+The app is imported once in the master (``preload_app``) and workers fork
+with it already loaded, which makes boots and worker restarts faster. Each
+worker still opens its own database connections (see database.py).
+``GUNICORN_PRELOAD=false`` imports the app in every worker instead.
+
+``GUNICORN_WORKER_CLASS=gevent`` serves each worker's requests from
+greenlets, so a worker can hold many checkouts that are waiting on PesaPal
+instead of one. The standard library is monkey-patched here, before the app
+is preloaded, so the locks, sockets and threads it creates at import are the
+cooperative kind. PyMySQL is pure Python and yields on its patched sockets.
+Compare the two modes with bench_serving.py.
+"""
+import glob
+import os
+import tempfile
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+if worker_class == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+    # Concurrent requests per worker, and room in the PesaPal bulkhead for them
+    worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '200'))
+    os.environ.setdefault('PESAPAL_MAX_CONCURRENT_CALLS', '100')
+
+multiproc_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), f"prometheus-{os.getuid()}")
+)
+# Needed before on_starting: the preloaded app creates its metric files on import
+os.makedirs(multiproc_dir, exist_ok=True)
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+
+def on_starting(server):
+    for path in glob.glob(os.path.join(multiproc_dir, '*.db')):
+        os.remove(path)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
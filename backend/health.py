@@ -0,0 +1,132 @@
+# health.py
+"""
+Liveness, readiness and startup warmup.
+
+``/healthz`` answers whenever the process can serve a request. A failure
+there means the worker should be restarted. ``/readyz`` answers 200 only
+when the worker should get traffic: the database answers, its schema is at
+the latest Alembic revision, and warmup has finished. Route traffic on
+``/readyz`` and restart on ``/healthz``, so a database outage takes workers
+out of rotation without restarting every one of them.
+
+Warmup runs once per process before it serves (``wsgi.py``). Under gunicorn's
+``preload_app`` that happens in the master, and workers get only what
+survives the fork: the cached PesaPal token (a module-level dict), SQLAlchemy's
+configured mappers and compiled statement cache (held on the engine, which
+the workers keep; only its connection pool is replaced), and the database's
+own page cache, which is warm whichever process read the pages. Query results
+are not kept, as there is no in-process catalog cache: the first requests
+still run their queries, just without compiling them or reading cold pages.
+The steps are registered with ``@warmup.step(name)`` and run in order.
+Each one is timed and logged. A failed step is logged and reported by
+``/readyz`` but doesn't hold readiness back, since what it preloads is also
+fetched on first use.
+"""
+import logging
+import time
+
+from sqlalchemy import text
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+
+def _describe(error):
+    # One short line: /readyz is unauthenticated, and driver errors carry the whole statement
+    first_line = (str(error).splitlines() or [''])[0]
+    return f"{type(error).__name__}: {first_line[:200]}"
+
+
+class Warmup:
+    def __init__(self):
+        self.steps = {}  # name -> function, run in registration order
+        self.enabled = True
+        self.results = {}
+        self.done = False
+
+    def init_app(self, app):
+        self.enabled = app.config['WARMUP_ENABLED']
+        self.results = {}
+        self.done = False
+
+    def step(self, name):
+        """Register the decorated function as warmup step ``name``. It may return a short summary."""
+        def register(func):
+            self.steps[name] = func
+            return func
+        return register
+
+    def run(self, app):
+        """Run every step in ``app``'s context. Returns {name: {'ok', 'ms', 'detail'}}."""
+        if not self.enabled:
+            logger.info("Warmup disabled")
+            self.done = True
+            return self.results
+        started = time.perf_counter()
+        with app.app_context():
+            for name, func in self.steps.items():
+                step_started = time.perf_counter()
+                try:
+                    detail = func()
+                    ok = True
+                except Exception as e:
+                    detail = _describe(e)
+                    ok = False
+                finally:
+                    # Don't carry a connection or transaction from one step to the next
+                    db.session.remove()
+                elapsed_ms = (time.perf_counter() - step_started) * 1000
+                self.results[name] = {'ok': ok, 'ms': round(elapsed_ms, 1), 'detail': detail}
+                if ok:
+                    logger.info(f"Warmup {name}: {elapsed_ms:.0f}ms" + (f" ({detail})" if detail else ''))
+                else:
+                    logger.warning(f"Warmup {name} failed after {elapsed_ms:.0f}ms: {detail}")
+        self.done = True
+        logger.info(f"Warmup finished in {(time.perf_counter() - started) * 1000:.0f}ms")
+        return self.results
+
+    @property
+    def ready(self):
+        return self.done or not self.enabled
+
+
+warmup = Warmup()
+
+_head_revisions = {}  # migrations directory -> its head revisions; the files don't change while running
+
+
+def head_revisions(directory):
+    """Head revision ids of the Alembic scripts in ``directory``."""
+    if directory not in _head_revisions:
+        from alembic.script import ScriptDirectory
+
+        _head_revisions[directory] = tuple(sorted(ScriptDirectory(directory).get_heads()))
+    return _head_revisions[directory]
+
+
+def readiness(migrations_dir):
+    """(ready, checks) for /readyz: database, migrations and warmup."""
+    from alembic.migration import MigrationContext
+
+    checks = {}
+    started = time.perf_counter()
+    try:
+        connection = db.session.connection()
+        connection.execute(text('SELECT 1'))
+    except Exception as e:
+        db.session.rollback()
+        checks['database'] = {'ok': False, 'error': _describe(e)}
+        checks['migrations'] = {'ok': False, 'error': 'database unavailable'}
+    else:
+        checks['database'] = {'ok': True, 'ms': round((time.perf_counter() - started) * 1000, 1)}
+        try:
+            current = tuple(sorted(MigrationContext.configure(connection).get_current_heads()))
+            head = head_revisions(migrations_dir)
+            checks['migrations'] = {'ok': current == head, 'current': list(current), 'head': list(head)}
+        except Exception as e:
+            checks['migrations'] = {'ok': False, 'error': _describe(e)}
+        finally:
+            db.session.rollback()
+    checks['warmup'] = {'ok': warmup.ready, 'steps': warmup.results}
+    return all(check['ok'] for check in checks.values()), checks
@@ -0,0 +1,191 @@
+# idempotency.py
+"""
+Idempotency-Key support for retry-safe endpoints.
+
+A client sends an ``Idempotency-Key`` header with a request. The first request
+with a given key claims it by inserting a row (the unique index on scope+key
+makes concurrent duplicates lose the race), runs the view and stores the
+response. Retries within the TTL replay the stored response instead of running
+the view again.
+
+Keys sent with a bearer token are scoped to the token's user, so two users
+can't replay (or block) each other's requests by picking the same key.
+"""
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import current_app, g, jsonify, make_response, request
+from sqlalchemy.exc import IntegrityError
+
+from models import db, IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+
+def request_fingerprint():
+    """Hash the parts of the current request that define "the same request"."""
+    digest = hashlib.sha256()
+    digest.update(request.method.encode())
+    digest.update(b'\0')
+    digest.update(request.path.encode())
+    digest.update(b'\0')
+    digest.update(request.get_data(cache=True))
+    return digest.hexdigest()
+
+
+def request_scope(scope):
+    """``scope`` narrowed to the authenticated user, if the request has one."""
+    user = g.get('current_user')
+    return f"{scope}:user:{user.id}" if user else scope
+
+
+def _replay(record):
+    response = make_response(record.response_body or '', record.status_code)
+    response.mimetype = 'application/json'
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _in_progress():
+    response = jsonify({'error': 'A request with this Idempotency-Key is already in progress'})
+    response.status_code = 409
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+def _claim(scope, key, fingerprint):
+    """Claim ``key`` for this request.
+
+    Returns ``(record, None)`` when the caller should run the view, or
+    ``(None, response)`` when a stored or error response must be returned.
+    """
+    now = datetime.utcnow()
+    lock_timeout = timedelta(seconds=current_app.config['IDEMPOTENCY_LOCK_TIMEOUT'])
+
+    record = IdempotencyKey.query.filter_by(scope=scope, key=key).first()
+
+    if record and record.expires_at <= now:
+        logger.info(f"Idempotency key expired, discarding: {scope}/{key}")
+        db.session.delete(record)
+        db.session.commit()
+        record = None
+
+    if record:
+        if record.fingerprint != fingerprint:
+            logger.warning(f"Idempotency key reused with a different payload: {scope}/{key}")
+            return None, (jsonify({'error': 'Idempotency-Key was already used with a different request'}), 422)
+
+        if record.status_code is not None:
+            logger.info(f"Replaying stored response for idempotency key: {scope}/{key}")
+            return None, _replay(record)
+
+        if record.created_at and record.created_at > now - lock_timeout:
+            return None, _in_progress()
+
+        # The worker that claimed the key died before storing a response.
+        # Take the claim over with a compare-and-set so only one retry wins.
+        taken = IdempotencyKey.query.filter_by(
+            id=record.id, created_at=record.created_at, status_code=None
+        ).update({'created_at': now}, synchronize_session=False)
+        db.session.commit()
+        if not taken:
+            return None, _in_progress()
+        logger.warning(f"Took over stale idempotency claim: {scope}/{key}")
+        return db.session.get(IdempotencyKey, record.id), None
+
+    record = IdempotencyKey(
+        scope=scope,
+        key=key,
+        fingerprint=fingerprint,
+        created_at=now,
+        expires_at=now + timedelta(seconds=current_app.config['IDEMPOTENCY_TTL'])
+    )
+    db.session.add(record)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent request with the same key inserted first
+        db.session.rollback()
+        existing = IdempotencyKey.query.filter_by(scope=scope, key=key).first()
+        if existing and existing.status_code is not None and existing.fingerprint == fingerprint:
+            return None, _replay(existing)
+        return None, _in_progress()
+    return record, None
+
+
+def _release(record):
+    """Drop a claim so the client can retry after a failure."""
+    try:
+        db.session.rollback()
+        # Through the session, so the deleted record leaves the identity map too
+        db.session.delete(record)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Failed to release idempotency key: {str(e)}")
+
+
+def idempotent(scope):
+    """Make a view replay its first response for repeated ``Idempotency-Key`` values.
+
+    Requests without the header are passed through unchanged. Server errors
+    (5xx) are not stored, so the client may retry them with the same key.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get(IDEMPOTENCY_HEADER)
+            if not key:
+                return view(*args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return jsonify({'error': f'{IDEMPOTENCY_HEADER} must be at most {MAX_KEY_LENGTH} characters'}), 400
+
+            scoped = request_scope(scope)
+            record, early_response = _claim(scoped, key, request_fingerprint())
+            if early_response is not None:
+                return early_response
+            record_id = record.id
+
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                _release(record)
+                raise
+
+            if response.status_code >= 500 or response.is_streamed:
+                _release(record)
+                return response
+
+            try:
+                db.session.rollback()
+                IdempotencyKey.query.filter_by(id=record_id).update({
+                    'status_code': response.status_code,
+                    'response_body': response.get_data(as_text=True)
+                }, synchronize_session=False)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Failed to store idempotent response for {scoped}/{key}: {str(e)}")
+            return response
+        return wrapper
+    return decorator
+
+
+def purge_expired_keys(batch_size=1000):
+    """Delete expired idempotency records in batches. Returns the number removed."""
+    removed = 0
+    while True:
+        ids = [row.id for row in IdempotencyKey.query
+               .with_entities(IdempotencyKey.id)
+               .filter(IdempotencyKey.expires_at <= datetime.utcnow())
+               .limit(batch_size)]
+        if not ids:
+            return removed
+        IdempotencyKey.query.filter(IdempotencyKey.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        removed += len(ids)
@@ -0,0 +1,391 @@
+# jobs.py
+"""
+Background jobs on a database table.
+
+Deferred and periodic work runs from the ``job`` table, on the same MySQL
+(or SQLite) database as everything else, so no broker is needed:
+
+* ``job_runner.enqueue(name, **payload)`` adds a job to the current session.
+  The caller commits, so the job exists exactly when the change that asked
+  for it does. The current trace context goes along and the job's span
+  continues it.
+* ``@job_runner.task(name, queue=..., cron=...)`` registers a function. Jobs
+  call it with their payload as keyword arguments. With ``cron`` (five
+  fields, e.g. ``'*/10 * * * *'``) workers also enqueue it on that schedule.
+  Each run has a ``unique_key``, so it is enqueued once however many workers
+  are up. ``JOB_SCHEDULES`` overrides a schedule, or turns it ``off``.
+* ``flask jobs worker`` claims and runs jobs until stopped.
+
+Claiming is a compare-and-set ``UPDATE`` on the job's status. It also takes a
+concurrency slot, and the unique ``(queue, slot)`` pair caps how many jobs of
+a queue run at once (``JOB_QUEUE_CONCURRENCY``) across every worker. This
+needs no ``SKIP LOCKED``, which SQLite lacks.
+
+A claimed job holds a lease (``JOB_LEASE_SECONDS``) that a heartbeat thread
+keeps extending while it runs. If a worker dies, its lease runs out and
+another worker takes the job over. A job that raises is retried with
+exponential backoff and jitter until it has made ``max_attempts`` attempts,
+and is then marked ``failed``. The task's own database changes commit
+together with the job's ``done`` status.
+"""
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Job
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+CRON_ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+}
+
+
+class CronSchedule:
+    """A five-field cron expression: minute, hour, day of month, month, day of week (0 or 7 = Sunday)."""
+
+    RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = CRON_ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: {expression!r}")
+        self.minutes, self.hours, self.days, self.months, weekdays = [
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self.RANGES)
+        ]
+        self.weekdays = {day % 7 for day in weekdays}
+        # Like cron: when both day fields are restricted, either one matching is enough
+        self.any_day = fields[2] == '*' or fields[4] == '*'
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(','):
+            part, _, step = part.partition('/')
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = (int(value) for value in part.split('-', 1))
+            else:
+                start = end = int(part)
+            if start < low or end > high or start > end:
+                raise ValueError(f"Cron field {field!r} is outside {low}-{high}")
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def matches(self, moment):
+        if moment.minute not in self.minutes or moment.hour not in self.hours or moment.month not in self.months:
+            return False
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays  # cron counts from Sunday
+        return (day and weekday) if self.any_day else (day or weekday)
+
+
+class Task:
+    def __init__(self, name, func, queue, max_attempts, cron):
+        self.name = name
+        self.func = func
+        self.queue = queue
+        self.max_attempts = max_attempts
+        self.cron = cron
+
+
+class JobRunner:
+    def __init__(self):
+        self.tasks = {}
+        self.lease_seconds = 60
+        self.poll_seconds = 2.0
+        self.max_attempts = 5
+        self.retry_base_seconds = 10.0
+        self.retry_max_seconds = 3600.0
+        self.queue_concurrency = {}
+        self.default_concurrency = 2
+        self.schedules = {}
+
+    def init_app(self, app):
+        config = app.config
+        self.lease_seconds = config['JOB_LEASE_SECONDS']
+        self.poll_seconds = config['JOB_POLL_SECONDS']
+        self.max_attempts = config['JOB_MAX_ATTEMPTS']
+        self.retry_base_seconds = config['JOB_RETRY_BASE_SECONDS']
+        self.retry_max_seconds = config['JOB_RETRY_MAX_SECONDS']
+        self.queue_concurrency = {queue: int(limit) for queue, limit in config['JOB_QUEUE_CONCURRENCY'].items()}
+        self.default_concurrency = config['JOB_DEFAULT_CONCURRENCY']
+        self.schedules = dict(config['JOB_SCHEDULES'])
+
+    def task(self, name, queue='default', max_attempts=None, cron=None):
+        """Register the decorated function as the task ``name``."""
+        if cron:
+            CronSchedule(cron)  # fail at import time, not in the worker
+        def register(func):
+            self.tasks[name] = Task(name, func, queue, max_attempts, cron)
+            return func
+        return register
+
+    def concurrency(self, queue):
+        return self.queue_concurrency.get(queue, self.default_concurrency)
+
+    def schedule(self, task):
+        """The task's CronSchedule, after JOB_SCHEDULES overrides, or None."""
+        expression = self.schedules.get(task.name, task.cron)
+        if not expression or expression == 'off':
+            return None
+        return CronSchedule(expression)
+
+    def enqueue(self, name, queue=None, run_at=None, unique_key=None, **payload):
+        """Add a job to the current session; it is queued when the caller commits."""
+        task = self.tasks.get(name)
+        if task is None:
+            raise ValueError(f"Unknown job: {name}")
+        job = Job(
+            name=name,
+            queue=queue or task.queue,
+            payload=json.dumps(payload),
+            status=QUEUED,
+            run_at=run_at or datetime.utcnow(),
+            max_attempts=task.max_attempts or self.max_attempts,
+            unique_key=unique_key,
+            traceparent=tracer.inject().get('traceparent'),
+        )
+        db.session.add(job)
+        return job
+
+    def claim(self, queues, worker_id):
+        """Lease the next due job from ``queues`` (in order) for ``worker_id``; None if there is none."""
+        for queue in queues:
+            job = self._claim_from(queue, worker_id)
+            if job is not None:
+                return job
+        return None
+
+    def _claim_from(self, queue, worker_id):
+        # A few tries, in case another worker wins the job or the slot
+        for _ in range(3):
+            now = datetime.utcnow()
+            # A job whose worker stopped heartbeating is taken over, slot and all
+            expired = Job.query.filter(
+                Job.queue == queue, Job.status == RUNNING, Job.lease_expires_at < now
+            ).order_by(Job.lease_expires_at).first()
+            if expired is not None:
+                job_id, slot, claimable = expired.id, expired.slot, (Job.status == RUNNING, Job.lease_expires_at < now)
+                logger.warning(f"Job {job_id} ({expired.name}) lost its worker {expired.locked_by}, taking it over")
+            else:
+                busy = {slot for slot, in db.session.query(Job.slot).filter(Job.queue == queue, Job.slot.isnot(None))}
+                free = [slot for slot in range(self.concurrency(queue)) if slot not in busy]
+                if not free:
+                    db.session.rollback()
+                    return None
+                job_id = db.session.query(Job.id).filter(
+                    Job.queue == queue, Job.status == QUEUED, Job.run_at <= now
+                ).order_by(Job.run_at, Job.id).limit(1).scalar()
+                if job_id is None:
+                    db.session.rollback()
+                    return None
+                slot, claimable = free[0], (Job.status == QUEUED,)
+            try:
+                claimed = Job.query.filter(Job.id == job_id, *claimable).update({
+                    'status': RUNNING,
+                    'slot': slot,
+                    'locked_by': worker_id,
+                    'lease_expires_at': now + timedelta(seconds=self.lease_seconds),
+                    'heartbeat_at': now,
+                    'attempts': Job.attempts + 1,
+                }, synchronize_session=False)
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                continue
+            if claimed:
+                return db.session.get(Job, job_id)
+        return None
+
+    def _heartbeat(self, app, job_id, worker_id, done):
+        with app.app_context():
+            while not done.wait(self.lease_seconds / 3):
+                now = datetime.utcnow()
+                extended = Job.query.filter_by(id=job_id, locked_by=worker_id, status=RUNNING).update(
+                    {'lease_expires_at': now + timedelta(seconds=self.lease_seconds), 'heartbeat_at': now},
+                    synchronize_session=False
+                )
+                db.session.commit()
+                if not extended:
+                    logger.warning(f"Job {job_id} lease lost by {worker_id}")
+                    return
+
+    def retry_delay(self, attempts):
+        """Seconds before attempt ``attempts + 1``: exponential, capped, with jitter."""
+        delay = min(self.retry_max_seconds, self.retry_base_seconds * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _finish(self, job_id, worker_id, changes):
+        # Only the lease holder may finish a job; one that was taken over isn't ours anymore,
+        # so the task's uncommitted writes are rolled back instead of committed with the status
+        finished = Job.query.filter_by(id=job_id, locked_by=worker_id, status=RUNNING).update(
+            {'slot': None, 'lease_expires_at': None, **changes}, synchronize_session=False
+        )
+        if not finished:
+            db.session.rollback()
+            logger.warning(f"Job {job_id} was taken over before {worker_id} finished it, discarding its changes")
+            return False
+        db.session.commit()
+        return True
+
+    def run(self, job, worker_id):
+        """Run a claimed job and record the outcome.
+
+        Returns the job's new status, or None when another worker took the job
+        over first; the task's writes are then rolled back.
+        """
+        job_id, name, attempts = job.id, job.name, job.attempts
+        task = self.tasks.get(name)
+        if task is None or attempts > job.max_attempts:
+            error = f"Unknown job: {name}" if task is None else f"Gave up after {job.max_attempts} attempts"
+            logger.error(f"Job {job_id} ({name}) failed: {error}")
+            self._finish(job_id, worker_id, {'status': FAILED, 'last_error': error, 'finished_at': datetime.utcnow()})
+            return FAILED
+
+        payload = json.loads(job.payload or '{}')
+        done = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._heartbeat, args=(current_app._get_current_object(), job_id, worker_id, done),
+            name=f"job-heartbeat-{job_id}", daemon=True
+        )
+        heartbeat.start()
+        started = time.perf_counter()
+        try:
+            with tracer.continue_trace({'traceparent': job.traceparent}, f"job {name}",
+                                       **{'job.id': job_id, 'job.queue': job.queue, 'job.attempt': attempts}):
+                task.func(**payload)
+                db.session.flush()  # so a bad write fails the attempt, not the status update
+        except Exception as e:
+            db.session.rollback()
+            error = f"{type(e).__name__}: {e}"
+            if attempts < job.max_attempts:
+                delay = self.retry_delay(attempts)
+                logger.warning(f"Job {job_id} ({name}) attempt {attempts} failed, retrying in {delay:.0f}s: {error}")
+                changes = {'status': QUEUED, 'run_at': datetime.utcnow() + timedelta(seconds=delay), 'last_error': error}
+            else:
+                logger.exception(f"Job {job_id} ({name}) failed after {attempts} attempts")
+                changes = {'status': FAILED, 'last_error': error, 'finished_at': datetime.utcnow()}
+        else:
+            # The task's uncommitted changes commit along with its status
+            changes = {'status': DONE, 'last_error': None, 'finished_at': datetime.utcnow()}
+            logger.info(f"Job {job_id} ({name}) done in {time.perf_counter() - started:.2f}s")
+        finally:
+            done.set()
+            heartbeat.join()
+        return changes['status'] if self._finish(job_id, worker_id, changes) else None
+
+    def schedule_due(self, since, until):
+        """Enqueue cron runs for every minute in (since, until]. Returns the number enqueued here."""
+        enqueued = 0
+        minute = since.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        while minute <= until:
+            for task in self.tasks.values():
+                schedule = self.schedule(task)
+                if schedule is None or not schedule.matches(minute):
+                    continue
+                self.enqueue(task.name, run_at=minute, unique_key=f"cron:{task.name}:{minute:%Y-%m-%dT%H:%M}")
+                try:
+                    db.session.commit()
+                    enqueued += 1
+                except IntegrityError:
+                    db.session.rollback()  # another worker enqueued this run
+            minute += timedelta(minutes=1)
+        return enqueued
+
+    def _work(self, app, queues, worker_id, stop, burst):
+        with app.app_context():
+            while not stop.is_set():
+                try:
+                    job = self.claim(queues, worker_id)
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Worker {worker_id} could not claim a job: {str(e)}")
+                    job = None
+                if job is not None:
+                    try:
+                        self.run(job, worker_id)
+                    except Exception as e:
+                        # The lease runs out and the job is retried by whoever takes it over
+                        db.session.rollback()
+                        logger.error(f"Worker {worker_id} could not record job {job.id}: {str(e)}")
+                elif burst:
+                    return
+                else:
+                    stop.wait(self.poll_seconds)
+
+    def work(self, queues, threads=1, stop=None, burst=False, schedule=True):
+        """Run jobs from ``queues`` on ``threads`` threads until ``stop`` is set.
+
+        With ``burst`` each thread returns once it finds nothing due. Unless
+        ``schedule`` is False, cron runs are enqueued as they come due.
+        """
+        app = current_app._get_current_object()
+        stop = stop or threading.Event()
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+        logger.info(f"Job worker {worker} started on {', '.join(queues)} with {threads} thread(s)")
+        last_tick = datetime.utcnow() - timedelta(minutes=1)
+        if schedule:
+            self.schedule_due(last_tick, datetime.utcnow())
+            last_tick = datetime.utcnow()
+        workers = [
+            threading.Thread(target=self._work, args=(app, queues, f"{worker}:{index}", stop, burst),
+                             name=f"job-worker-{index}", daemon=True)
+            for index in range(threads)
+        ]
+        for thread in workers:
+            thread.start()
+        while any(thread.is_alive() for thread in workers):
+            stop.wait(self.poll_seconds)
+            if schedule and not stop.is_set():
+                now = datetime.utcnow()
+                try:
+                    self.schedule_due(last_tick, now)
+                    last_tick = now
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Could not enqueue scheduled jobs: {str(e)}")
+        for thread in workers:
+            thread.join()
+        logger.info(f"Job worker {worker} stopped")
+
+    def purge_finished(self, older_than, batch_size=1000):
+        """Delete done and failed jobs finished before ``older_than``, in batches. Returns the number removed."""
+        removed = 0
+        while True:
+            ids = [row.id for row in Job.query.with_entities(Job.id)
+                   .filter(Job.status.in_([DONE, FAILED]), Job.finished_at < older_than)
+                   .limit(batch_size)]
+            if not ids:
+                return removed
+            Job.query.filter(Job.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+            removed += len(ids)
+
+    def status_counts(self):
+        """{(queue, status): count} over the job table."""
+        rows = db.session.query(Job.queue, Job.status, func.count()).group_by(Job.queue, Job.status)
+        return {(queue, status): count for queue, status, count in rows}
+
+
+job_runner = JobRunner()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Payment-path load test
+
+Pushes N concurrent checkouts through /api/pay, lets the PesaPal emulator
+deliver its IPNs to /api/pesapal-callback, then checks every checkout with
+/api/check-payment and reports throughput, latency percentiles and any lost
+or duplicate payments.
+
+By default everything runs in this process: the emulator and the app (on a
+throwaway SQLite database) are served from background threads, so no MySQL
+or gateway credentials are needed:
+
+    python loadtest_payments.py --checkouts 200 --concurrency 20
+
+To measure a deployed stack instead, start pesapal_emulator.py, run the app
+with PESAPAL_BASE_URL/PESAPAL_CALLBACK_URL pointing at it, and pass:
+
+    python loadtest_payments.py --app-url http://127.0.0.1:8000 --emulator-url http://127.0.0.1:8090/v3/api
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from pesapal_emulator import EmulatorSettings, PesapalEmulator
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of ``values`` (0 when empty)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_local_app(emulator_url, database_url, gateway_concurrency):
+    """Import the app configured against the emulator and serve it from a thread.
+
+    The threaded server is a single worker process, so the PesaPal bulkhead is
+    sized from ``gateway_concurrency`` rather than the per-worker default.
+    """
+    from werkzeug.serving import make_server
+
+    port = free_port()
+    os.environ.update({
+        'DATABASE_URL': database_url,
+        'PESAPAL_BASE_URL': emulator_url,
+        'PESAPAL_CALLBACK_URL': f"http://127.0.0.1:{port}/api/pesapal-callback",
+        'PESAPAL_CONSUMER_KEY': 'emulator-key',
+        'PESAPAL_CONSUMER_SECRET': 'emulator-secret',
+        'PESAPAL_MAX_CONCURRENT_CALLS': str(gateway_concurrency),
+        # Every simulated customer shares 127.0.0.1
+        'RATE_LIMIT_ENABLED': 'false',
+        'LOG_FILE': '',
+        'LOG_FORMAT': 'text',
+    })
+    from app import create_app
+    from models import Resource, db
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        resource = Resource(resource_type='book', class_grade='form1', subject='loadtest',
+                            title='Load test resource', description='Created by loadtest_payments.py')
+        db.session.add(resource)
+        db.session.commit()
+        resource_id = resource.id
+
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='app-server', daemon=True).start()
+    return f"http://127.0.0.1:{port}", resource_id
+
+
+class LoadTest:
+    def __init__(self, app_url, resource_id, retry_rate=0.1, seed=None):
+        self.api = f"{app_url.rstrip('/')}/api"
+        self.resource_id = resource_id
+        self.retry_rate = retry_rate
+        self.run_id = uuid.uuid4().hex[:8]
+        self._random = random.Random(seed)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.status_codes = Counter()
+        self.checkouts = {}  # email -> orderTrackingId returned by /api/pay
+        self.replay_mismatches = []
+
+    def _session(self):
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _pay(self, body, key):
+        started = time.perf_counter()
+        try:
+            resp = self._session().post(f"{self.api}/pay", json=body,
+                                        headers={'Idempotency-Key': key}, timeout=60)
+            status, data = resp.status_code, (resp.json() if resp.content else {})
+        except (requests.exceptions.RequestException, ValueError) as e:
+            status, data = f"error:{type(e).__name__}", {}
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.latencies.append(elapsed)
+            self.status_codes[status] += 1
+        return status, data
+
+    def checkout(self, index):
+        email = f"loadtest-{self.run_id}-{index}@example.com"
+        body = {'resource_id': self.resource_id, 'email': email, 'amount': 100,
+                'name': f"Load Test{index}", 'phone': '+254700000000'}
+        key = str(uuid.uuid4())
+        status, data = self._pay(body, key)
+        if status != 200:
+            return
+        order_id = data.get('orderTrackingId')
+        with self._lock:
+            self.checkouts[email] = order_id
+            retry = self._random.random() < self.retry_rate
+        if retry:
+            # A client retry (double-click, flaky network) must replay the same order
+            status, replay = self._pay(body, key)
+            if status == 200 and replay.get('orderTrackingId') != order_id:
+                with self._lock:
+                    self.replay_mismatches.append(email)
+
+    def run(self, checkouts, concurrency):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(self.checkout, range(checkouts)))
+        return time.perf_counter() - started
+
+    def verify(self, emulator_orders):
+        """Compare what the app recorded with what the gateway settled.
+
+        ``emulator_orders`` maps merchant reference -> list of gateway orders.
+        """
+        lost, wrong_status, duplicates = [], [], []
+        for email, order_id in self.checkouts.items():
+            gateway_orders = emulator_orders.get(order_id, [])
+            if len(gateway_orders) != 1:
+                duplicates.append(order_id)
+            resp = self._session().get(f"{self.api}/check-payment",
+                                       params={'resource_id': self.resource_id, 'email': email}, timeout=30)
+            if resp.status_code != 200:
+                lost.append(order_id)
+                continue
+            data = resp.json()
+            if data.get('order_tracking_id') != order_id:
+                duplicates.append(order_id)
+            elif gateway_orders and data.get('payment_status') != gateway_orders[0]['status']:
+                wrong_status.append((order_id, data.get('payment_status'), gateway_orders[0]['status']))
+        return lost, wrong_status, duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the checkout path against the PesaPal emulator')
+    parser.add_argument('--checkouts', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--retry-rate', type=float, default=0.1, help='Fraction of checkouts retried with the same Idempotency-Key')
+    parser.add_argument('--app-url', help='Test a running app instead of an in-process one')
+    parser.add_argument('--resource-id', type=int, help='Resource to buy (required with --app-url)')
+    parser.add_argument('--emulator-url', help='Use a running emulator (its /emulator/stats must be reachable)')
+    parser.add_argument('--database-url', help='Database for the in-process app (default: temporary SQLite file)')
+    parser.add_argument('--gateway-concurrency', type=int,
+                        help='PesaPal bulkhead size for the in-process app (default: --concurrency)')
+    parser.add_argument('--latency-ms', type=float, default=50.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--failure-rate', type=float, default=0.1)
+    parser.add_argument('--duplicate-rate', type=float, default=0.1)
+    parser.add_argument('--out-of-order-rate', type=float, default=0.1)
+    parser.add_argument('--ipn-delay-ms', type=float, default=200.0)
+    parser.add_argument('--settle-timeout', type=float, default=120.0)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    emulator = None
+    if args.emulator_url:
+        emulator_url = args.emulator_url
+    else:
+        emulator = PesapalEmulator(EmulatorSettings(
+            latency_ms=args.latency_ms,
+            error_rate=args.error_rate,
+            failure_rate=args.failure_rate,
+            duplicate_rate=args.duplicate_rate,
+            out_of_order_rate=args.out_of_order_rate,
+            ipn_delay_ms=args.ipn_delay_ms
+        ), seed=args.seed)
+        emulator_url = emulator.start()
+
+    if args.app_url:
+        if not args.resource_id:
+            parser.error('--resource-id is required with --app-url')
+        app_url, resource_id = args.app_url, args.resource_id
+    else:
+        database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'loadtest.db')}"
+        app_url, resource_id = start_local_app(emulator_url, database_url,
+                                               args.gateway_concurrency or args.concurrency)
+        # The app configures its own logging on import; keep the report readable
+        logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    test = LoadTest(app_url, resource_id, retry_rate=args.retry_rate, seed=args.seed)
+    elapsed = test.run(args.checkouts, args.concurrency)
+
+    if emulator:
+        settled = emulator.wait_for_notifications(args.settle_timeout)
+        stats = emulator.stats()
+        orders_by_reference = {
+            ref: [emulator.orders[oid] for oid in ids]
+            for ref, ids in emulator.orders_by_reference.items()
+        }
+        ipn_latencies = list(emulator.ipn_latencies)
+    else:
+        # A remote emulator only exposes counters; wait for its IPN queue to drain
+        deadline = time.monotonic() + args.settle_timeout
+        stats = requests.get(emulator_url.replace('/v3/api', '/emulator/stats'), timeout=30).json()
+        while stats['ipn_pending'] and time.monotonic() < deadline:
+            time.sleep(0.2)
+            stats = requests.get(emulator_url.replace('/v3/api', '/emulator/stats'), timeout=30).json()
+        settled = not stats['ipn_pending']
+        orders_by_reference, ipn_latencies = {}, []
+
+    lost, wrong_status, duplicates = test.verify(orders_by_reference)
+    successful = len(test.checkouts)
+    report = {
+        'checkouts': args.checkouts,
+        'concurrency': args.concurrency,
+        'successful_checkouts': successful,
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput_per_second': round(successful / elapsed, 2) if elapsed else 0.0,
+        'pay_latency_ms': {
+            'p50': round(percentile(test.latencies, 50) * 1000, 1),
+            'p95': round(percentile(test.latencies, 95) * 1000, 1),
+            'p99': round(percentile(test.latencies, 99) * 1000, 1),
+            'max': round(max(test.latencies, default=0) * 1000, 1)
+        },
+        'callback_latency_ms': {
+            'p50': round(percentile(ipn_latencies, 50) * 1000, 1),
+            'p95': round(percentile(ipn_latencies, 95) * 1000, 1),
+            'p99': round(percentile(ipn_latencies, 99) * 1000, 1)
+        },
+        'pay_status_codes': {str(k): v for k, v in test.status_codes.items()},
+        'notifications_settled': settled,
+        'lost_payments': lost,
+        'wrong_status': wrong_status,
+        'duplicate_payments': duplicates,
+        'replay_mismatches': test.replay_mismatches,
+        'emulator': stats
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"Checkouts:        {successful}/{args.checkouts} succeeded at concurrency {args.concurrency}")
+        print(f"Elapsed:          {report['elapsed_seconds']}s")
+        print(f"Throughput:       {report['throughput_per_second']} checkouts/s")
+        lat = report['pay_latency_ms']
+        print(f"/api/pay latency: p50={lat['p50']}ms p95={lat['p95']}ms p99={lat['p99']}ms max={lat['max']}ms")
+        lat = report['callback_latency_ms']
+        print(f"Callback latency: p50={lat['p50']}ms p95={lat['p95']}ms p99={lat['p99']}ms")
+        print(f"Status codes:     {report['pay_status_codes']}")
+        print(f"IPNs:             {stats['ipn_delivered']} delivered, {stats['ipn_failed_attempts']} failed attempts, "
+              f"{stats['ipn_given_up']} given up")
+        print(f"Lost payments:    {len(lost)}")
+        print(f"Wrong status:     {len(wrong_status)}")
+        print(f"Duplicates:       {len(duplicates)} (+{len(test.replay_mismatches)} replay mismatches)")
+
+    if emulator:
+        emulator.stop()
+    problems = lost or wrong_status or duplicates or test.replay_mismatches or not settled
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+# logging_config.py
+"""
+Logging pipeline.
+
+Request threads only put records on a bounded queue; a ``QueueListener``
+thread redacts, formats and writes them, so no request waits on disk I/O.
+When the queue is full new records are dropped and counted rather than
+blocking the caller.
+
+Output is one JSON object per line (``LOG_FORMAT=text`` gives the classic
+format for local use), written to stderr and to ``LOG_FILE``. Rotation is not
+safe across processes: a worker that renames the file leaves the others
+writing to the unlinked old one. So only a ``LOG_FILE`` with ``{pid}`` in it,
+one file per worker, rotates (by size or time, gzip-compressed). A shared
+file is only appended to, and reopened when logrotate moves it.
+
+``LOG_LEVEL`` sets the root level and, optionally, per-logger levels:
+``LOG_LEVEL=INFO,sqlalchemy.engine=WARNING,auth_tokens=DEBUG``.
+
+High-volume DEBUG records can be sampled: ``LOG_DEBUG_SAMPLE_RATE=0.01``
+keeps about 1 in 100, and a single call can set its own rate with
+``logger.debug(..., extra={'sample_rate': 0.1})``. Kept records carry their
+rate so totals can be re-weighted.
+"""
+import atexit
+import copy
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import shutil
+import sys
+import threading
+from datetime import datetime, timezone
+
+# Attributes every LogRecord has; anything else came from ``extra=``
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_REDACTIONS = [
+    # key=value, key: value, 'key': 'value' and "key": "value" forms
+    (re.compile(
+        r"""(?i)(["']?\b(?:password|passwd|old_password|new_password|secret|consumer_secret|consumer_key|"""
+        r"""api[_-]?key|access_token|refresh_token|token|authorization|ipn_secret)\b["']?\s*[:=]\s*["']?)"""
+        r"""((?:Bearer\s+)?[^"'\s,}&]+)"""
+    ), r'\1***'),
+    (re.compile(r'(?i)\bBearer\s+[A-Za-z0-9._~+/=-]+'), 'Bearer ***'),
+]
+
+
+def redact(text):
+    for pattern, replacement in _REDACTIONS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+class RedactingFilter(logging.Filter):
+    """Masks secrets in the rendered message and exception text."""
+
+    def filter(self, record):
+        record.msg = redact(record.getMessage())
+        record.args = None
+        if record.exc_text:
+            record.exc_text = redact(record.exc_text)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a random fraction of DEBUG records (or the rate a record asks for)."""
+
+    def __init__(self, debug_rate=1.0):
+        super().__init__()
+        self.debug_rate = debug_rate
+
+    def filter(self, record):
+        rate = getattr(record, 'sample_rate', None)
+        if rate is None:
+            if record.levelno > logging.DEBUG or self.debug_rate >= 1.0:
+                return True
+            rate = self.debug_rate
+            record.sample_rate = rate
+        return rate >= 1.0 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'pid': record.process,
+            'thread': record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = record.stack_info
+        return json.dumps(entry, default=str, separators=(',', ':'))
+
+
+class _AsyncQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues without blocking and restarts the listener in forked children."""
+
+    def __init__(self, log_queue, pipeline):
+        super().__init__(log_queue)
+        self.pipeline = pipeline
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Render in the caller thread (args may change later) but leave the
+        # exception text separate so the JSON formatter can put it in 'exc'
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self.pipeline.ensure_running()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _gzip_namer(name):
+    return name + '.gz'
+
+
+def _gzip_rotator(source, dest):
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def parse_levels(spec):
+    """'INFO,werkzeug=WARNING' -> ('INFO', {'werkzeug': 'WARNING'})"""
+    root, levels = 'INFO', {}
+    for item in (spec or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+        else:
+            root = item.upper()
+    return root, levels
+
+
+class LoggingPipeline:
+    def __init__(self):
+        self.handler = None
+        self.listener = None
+        self._config = None
+        self._pid = None
+        self._lock = threading.RLock()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # Another thread may have held the lock at fork time
+        self._lock = threading.RLock()
+
+    def configure(self, config):
+        """Replace the root logger's handlers with the queue pipeline described by ``config``."""
+        with self._lock:
+            self.stop()
+            self._config = dict(config)
+            self._build()
+            self.ensure_running()
+        return self
+
+    def _build_outputs(self):
+        config = self._config
+        if config.get('LOG_FORMAT', 'json') == 'text':
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        else:
+            formatter = JsonFormatter()
+
+        outputs = [logging.StreamHandler(sys.stderr)]
+        log_file = config.get('LOG_FILE')
+        if log_file and '{pid}' not in log_file:
+            outputs.append(logging.handlers.WatchedFileHandler(log_file, delay=True))
+        elif log_file:
+            log_file = log_file.replace('{pid}', str(os.getpid()))
+            when = config.get('LOG_ROTATE_WHEN', 'size')
+            if when == 'size':
+                file_handler = logging.handlers.RotatingFileHandler(
+                    log_file, maxBytes=config.get('LOG_MAX_BYTES', 10 * 1024 * 1024),
+                    backupCount=config.get('LOG_BACKUP_COUNT', 7), delay=True
+                )
+            else:
+                file_handler = logging.handlers.TimedRotatingFileHandler(
+                    log_file, when=when, backupCount=config.get('LOG_BACKUP_COUNT', 7), utc=True, delay=True
+                )
+            if config.get('LOG_COMPRESS', True):
+                file_handler.namer = _gzip_namer
+                file_handler.rotator = _gzip_rotator
+            outputs.append(file_handler)
+
+        redactor = RedactingFilter()
+        for output in outputs:
+            output.setFormatter(formatter)
+            output.addFilter(redactor)
+        return outputs
+
+    def _build_listener(self):
+        self.handler.queue = queue.Queue(self._config.get('LOG_QUEUE_SIZE', 10000))
+        self.listener = logging.handlers.QueueListener(
+            self.handler.queue, *self._build_outputs(), respect_handler_level=True
+        )
+
+    def _build(self):
+        self.handler = _AsyncQueueHandler(None, self)
+        self.handler.addFilter(SamplingFilter(self._config.get('LOG_DEBUG_SAMPLE_RATE', 1.0)))
+        self._build_listener()
+
+        root_level, levels = parse_levels(self._config.get('LOG_LEVEL', 'INFO'))
+        root = logging.getLogger()
+        for existing in root.handlers[:]:
+            root.removeHandler(existing)
+            existing.close()
+        root.addHandler(self.handler)
+        root.setLevel(root_level)
+        for name, level in levels.items():
+            logging.getLogger(name).setLevel(level)
+
+    def ensure_running(self):
+        if self._pid == os.getpid() or self.listener is None:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # Forked (gunicorn --preload): the inherited listener thread is
+                # gone and its queue may be mid-operation, so start afresh
+                for output in self.listener.handlers:
+                    output.close()
+                self._build_listener()
+            self.listener.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        """Flush queued records and stop the listener thread."""
+        with self._lock:
+            if self.listener is not None and self._pid == os.getpid():
+                self.listener.stop()
+                for output in self.listener.handlers:
+                    output.close()
+            self._pid = None
+
+    def stats(self):
+        return {
+            'queued': self.handler.queue.qsize() if self.handler else 0,
+            'dropped': self.handler.dropped if self.handler else 0,
+        }
+
+
+logging_pipeline = LoggingPipeline()
+atexit.register(logging_pipeline.stop)
+
+
+def configure_logging(config):
+    return logging_pipeline.configure(config)
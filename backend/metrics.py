@@ -0,0 +1,180 @@
+# metrics.py
+"""
+Prometheus metrics.
+
+Per route (the URL rule, so every ``/api/payment/<order_tracking_id>`` is one
+series): response latency, responses by status and requests in progress. Per
+request: how many SQL statements ran and how long they took. Per PesaPal
+operation: call latency by outcome, calls refused by the circuit breaker or
+bulkhead, and the breaker state.
+
+Each gunicorn worker keeps its own values. With ``PROMETHEUS_MULTIPROC_DIR``
+set (``gunicorn.conf.py`` sets it) workers write them to mmap'd files in that
+directory and ``/metrics`` adds them up, so whichever worker answers a scrape
+reports the whole node. Without it (``flask run``, scripts) ``/metrics``
+reports this process only.
+
+Latency is measured until the response is returned to the WSGI server, so for
+streamed exports it covers the time to the first byte.
+
+Scrapes must send ``METRICS_TOKEN`` as a bearer token. Without one configured
+``/metrics`` refuses every request: route names, error rates and gateway
+state are not for the public.
+"""
+import hmac
+import logging
+import os
+import time
+
+from flask import Response, g, has_request_context, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge,
+                               Histogram, generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUERY_LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 5.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+BREAKER_STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+STATEMENT_TYPES = {'SELECT', 'INSERT', 'UPDATE', 'DELETE'}
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Time to produce a response',
+    ['method', 'route'], buckets=LATENCY_BUCKETS
+)
+RESPONSES = Counter('http_requests_total', 'Responses sent', ['method', 'route', 'status'])
+IN_PROGRESS = Gauge(
+    'http_requests_in_progress', 'Requests being handled',
+    ['method', 'route'], multiprocess_mode='livesum'
+)
+REQUEST_QUERIES = Histogram(
+    'http_request_db_queries', 'SQL statements executed per request',
+    ['route'], buckets=QUERY_COUNT_BUCKETS
+)
+REQUEST_DB_TIME = Histogram(
+    'http_request_db_duration_seconds', 'Time spent executing SQL per request',
+    ['route'], buckets=LATENCY_BUCKETS
+)
+QUERY_LATENCY = Histogram(
+    'db_query_duration_seconds', 'Time per SQL statement',
+    ['statement'], buckets=QUERY_LATENCY_BUCKETS
+)
+PESAPAL_LATENCY = Histogram(
+    'pesapal_request_duration_seconds', 'PesaPal API call time',
+    ['operation', 'outcome'], buckets=LATENCY_BUCKETS
+)
+PESAPAL_REJECTED = Counter(
+    'pesapal_requests_rejected_total', 'PesaPal calls refused without being made',
+    ['operation', 'reason']
+)
+BREAKER_STATE = Gauge(
+    'pesapal_circuit_state', 'PesaPal circuit breaker state (0 closed, 1 half open, 2 open), worst live worker',
+    multiprocess_mode='livemax'
+)
+
+
+def _route():
+    # The rule, not the path, so ids in URLs don't each make a series
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _statement_type(statement):
+    verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+    return verb if verb in STATEMENT_TYPES else 'other'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    elapsed = time.perf_counter() - started
+    QUERY_LATENCY.labels(_statement_type(statement)).observe(elapsed)
+    if has_request_context():
+        g.db_queries = g.get('db_queries', 0) + 1
+        g.db_seconds = g.get('db_seconds', 0.0) + elapsed
+
+
+def _handle_error(exception_context):
+    # after_cursor_execute doesn't run for a failed statement
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('query_started'):
+        connection.info['query_started'].pop()
+
+
+class Metrics:
+    def __init__(self):
+        self.token = None
+        self._listening = False
+
+    def init_app(self, app):
+        self.token = app.config['METRICS_TOKEN']
+        if not self.token and not app.testing:
+            logger.warning("METRICS_TOKEN is not set, /metrics and /api/metrics/gateway refuse every request")
+        if not self._listening:
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+            event.listen(Engine, 'handle_error', _handle_error)
+            self._listening = True
+        # Registered before the auth and rate limit hooks so requests they
+        # reject (401, 429) are still timed and counted
+        app.before_request(self._start_request)
+        app.after_request(self._record_response)
+        app.teardown_request(self._end_request)
+
+    def _start_request(self):
+        g.metrics_started = time.perf_counter()
+        g.metrics_labels = (request.method, _route())
+        g.db_queries, g.db_seconds = 0, 0.0
+        IN_PROGRESS.labels(*g.metrics_labels).inc()
+
+    def _record_response(self, response):
+        labels = g.get('metrics_labels')
+        if labels is None:
+            return response
+        method, route = labels
+        REQUEST_LATENCY.labels(method, route).observe(time.perf_counter() - g.metrics_started)
+        RESPONSES.labels(method, route, str(response.status_code)).inc()
+        REQUEST_QUERIES.labels(route).observe(g.get('db_queries', 0))
+        REQUEST_DB_TIME.labels(route).observe(g.get('db_seconds', 0.0))
+        return response
+
+    def _end_request(self, exc):
+        labels = g.pop('metrics_labels', None)
+        if labels is not None:
+            IN_PROGRESS.labels(*labels).dec()
+
+    def observe_pesapal_call(self, operation, seconds, response=None):
+        """Record one PesaPal call that was made: its HTTP status class, or 'error' when it raised."""
+        outcome = f"{response.status_code // 100}xx" if response is not None else 'error'
+        PESAPAL_LATENCY.labels(operation, outcome).observe(seconds)
+
+    def count_pesapal_rejection(self, operation, reason):
+        PESAPAL_REJECTED.labels(operation, reason).inc()
+
+    def set_breaker_state(self, state):
+        BREAKER_STATE.set(BREAKER_STATES[state])
+
+    def authorized(self):
+        """True when the request carries ``METRICS_TOKEN`` as a bearer token; never when it is unset."""
+        if not self.token:
+            return False
+        header = request.headers.get('Authorization', '')
+        return header.lower().startswith('bearer ') and hmac.compare_digest(header[7:].strip(), self.token)
+
+    def render(self):
+        """The Prometheus text exposition for this node (or this process outside gunicorn)."""
+        if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+metrics = Metrics()
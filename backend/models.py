@@ -1,12 +1,47 @@
 # models.py
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import case, type_coerce
+from sqlalchemy.dialects import mysql
+from sqlalchemy.orm import validates
+from password_hashing import password_hasher
+from database import RoutingSession
 from datetime import datetime
 import logging # Import logging here
 
 logger = logging.getLogger(__name__) # Get a logger instance for this module
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# Stored codes for Payment.status. PENDING, the working set, sorts first.
+PAYMENT_STATUS_CODES = {'PENDING': 0, 'COMPLETED': 1, 'FAILED': 2, 'CANCELLED': 3}
+
+class PaymentStatus(db.TypeDecorator):
+    """Payment status names in Python, SMALLINT codes (PAYMENT_STATUS_CODES) in the database.
+
+    Filters such as ``Payment.status == 'COMPLETED'`` are translated too;
+    SQL that copies the column elsewhere must use ``payment_status_name``.
+    """
+    impl = db.SmallInteger
+    cache_ok = True
+    names = {code: name for name, code in PAYMENT_STATUS_CODES.items()}
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        try:
+            return PAYMENT_STATUS_CODES[value]
+        except KeyError:
+            raise ValueError(f"Unknown payment status: {value!r}")
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else self.names[value]
+
+def payment_status_name(column):
+    """SQL expression turning a status code column back into its name."""
+    return case(
+        {code: name for name, code in PAYMENT_STATUS_CODES.items()},
+        value=type_coerce(column, db.SmallInteger), else_='PENDING'
+    )
 
 class Resource(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -28,30 +63,82 @@ class Resource(db.Model):
             'cover': self.cover
         }
 
+def normalize_identifier(value):
+    """Canonical form of a username or email for lookups and uniqueness checks"""
+    return (value or '').strip().lower()
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(512), nullable=False)
+    identifiers = db.relationship('UserIdentifier', backref='user', cascade='all, delete-orphan')
+
+    @validates('username', 'email')
+    def _sync_identifier(self, kind, value):
+        # Keep one normalized login identifier per value in step with the columns.
+        # A username that is the user's own email address shares the email's row.
+        normalized = normalize_identifier(value)
+        current = getattr(self, kind)
+        if current is not None and normalize_identifier(current) == normalized:
+            # Unchanged. This also leaves alone a user whose identifier the
+            # user_identifier backfill skipped (see `flask identifier-conflicts`)
+            return value
+        other = 'email' if kind == 'username' else 'username'
+        other_value = getattr(self, other)
+        other_value = None if other_value is None else normalize_identifier(other_value)
+        rows = {i.value: i for i in self.identifiers}
+        old = rows.get(normalize_identifier(current)) if current is not None else None
+        if old is not None:
+            if old.value == other_value:
+                old.kind = other  # still the other column's
+            else:
+                self.identifiers.remove(old)
+        if normalized == other_value and normalized in rows:
+            rows[normalized].kind = 'email'
+        else:
+            self.identifiers.append(UserIdentifier(kind='email' if normalized == other_value else kind, value=normalized))
+        return value
+
+    def missing_identifiers(self):
+        """Normalized username and email values (by kind) that have no identifier row of this user"""
+        own = {i.value for i in self.identifiers}
+        values = {'username': normalize_identifier(self.username), 'email': normalize_identifier(self.email)}
+        return {kind: value for kind, value in values.items() if value not in own}
+
+    @classmethod
+    def find_by_login(cls, identifier, kind=None):
+        """The user whose username or email (or only ``kind``) matches ``identifier``, ignoring case"""
+        query = cls.query.join(UserIdentifier).filter(UserIdentifier.value == normalize_identifier(identifier))
+        if kind:
+            query = query.filter(UserIdentifier.kind == kind)
+        return query.first()
 
     def set_password(self, password):
-        # --- DEBUGGING LINE 1 (Registration) ---
-        logger.info(f"DEBUG (models.py set_password): Received password (length={len(password)}). First 5 chars: '{password[:5]}'")
-        self.password_hash = generate_password_hash(password)
-        # --- DEBUGGING LINE 2 (Registration) ---
-        logger.info(f"DEBUG (models.py set_password): Generated hash: '{self.password_hash[:40]}...' (length={len(self.password_hash)})") # Log a snippet
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        # --- DEBUGGING LINE 3 (Login) ---
-        logger.info(f"DEBUG (models.py check_password): Checking for user '{self.username}' (ID: {self.id})")
-        logger.info(f"DEBUG (models.py check_password): Provided password (length={len(password)}). First 5 chars: '{password[:5]}'")
-        logger.info(f"DEBUG (models.py check_password): Stored hash (length={len(self.password_hash)}). First 40 chars: '{self.password_hash[:40]}...'")
-
-        is_valid = check_password_hash(self.password_hash, password)
-        # --- DEBUGGING LINE 4 (Login) ---
-        logger.info(f"DEBUG (models.py check_password): check_password_hash result: {is_valid}")
+        is_valid = password_hasher.verify(self.password_hash, password)
+        logger.debug(f"Password check for user {self.id}: {is_valid}")
         return is_valid
 
+    def password_needs_rehash(self):
+        """True when the stored hash uses an outdated algorithm or cost"""
+        return password_hasher.needs_rehash(self.password_hash)
+
+class UserIdentifier(db.Model):
+    """Normalized usernames and emails; one unique index serves login and duplicate checks"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    kind = db.Column(db.String(10), nullable=False)  # username, email (also when the username is the email)
+    value = db.Column(db.String(120), nullable=False, unique=True)
+
+    @classmethod
+    def taken(cls, *identifiers):
+        """Normalized values among ``identifiers`` that already belong to a user"""
+        values = {normalize_identifier(i) for i in identifiers}
+        return {row.value for row in cls.query.with_entities(cls.value).filter(cls.value.in_(values))}
+
 class Payment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     order_tracking_id = db.Column(db.String(100), unique=True, nullable=False, index=True)
@@ -61,7 +148,7 @@ class Payment(db.Model):
     user_email = db.Column(db.String(120), nullable=False)
     amount = db.Column(db.Float, nullable=False)
     currency = db.Column(db.String(3), default='KES')
-    status = db.Column(db.String(20), default='PENDING')  # PENDING, COMPLETED, FAILED, CANCELLED
+    status = db.Column(PaymentStatus, nullable=False, default='PENDING')  # PENDING, COMPLETED, FAILED, CANCELLED
     payment_method = db.Column(db.String(50), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -71,6 +158,14 @@ class Payment(db.Model):
     # Relationship
     resource = db.relationship('Resource', backref='payments')
 
+    __table_args__ = (
+        # check-payment: a buyer's latest payment for a resource, found without sorting
+        db.Index('ix_payment_resource_email_created', 'resource_id', 'user_email', 'created_at'),
+        # Archiving: each status's rows form one contiguous range, oldest first; with the
+        # primary key every index carries, id scans never touch the table
+        db.Index('ix_payment_status_created', 'status', 'created_at'),
+    )
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -88,3 +183,158 @@ class Payment(db.Model):
             'ipn_received': self.ipn_received,
             'ipn_received_at': self.ipn_received_at.isoformat() if self.ipn_received_at else None
         }
+
+class PaymentArchive(db.Model):
+    """Settled or abandoned payments moved out of ``payment`` by archive.py, with the same columns"""
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # the id it had in payment
+    order_tracking_id = db.Column(db.String(100), unique=True, nullable=False)
+    transaction_tracking_id = db.Column(db.String(100), nullable=True)
+    merchant_reference = db.Column(db.String(100), nullable=True)
+    resource_id = db.Column(db.Integer, nullable=False)  # no FK: history outlives deleted resources
+    user_email = db.Column(db.String(120), nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    currency = db.Column(db.String(3), default='KES')
+    status = db.Column(PaymentStatus, nullable=False)
+    payment_method = db.Column(db.String(50), nullable=True)
+    created_at = db.Column(db.DateTime, index=True)  # exports and rollup rebuilds read it by date
+    updated_at = db.Column(db.DateTime)
+    ipn_received = db.Column(db.Boolean, default=False)
+    ipn_received_at = db.Column(db.DateTime, nullable=True)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class IdempotencyKey(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(100), nullable=False)  # endpoint the key belongs to, plus the user if authenticated
+    key = db.Column(db.String(255), nullable=False)
+    fingerprint = db.Column(db.String(64), nullable=False)  # sha256 of method, path and body
+    status_code = db.Column(db.Integer, nullable=True)  # NULL while the original request is in flight
+    response_body = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('scope', 'key', name='uq_idempotency_key_scope_key'),
+    )
+
+class SalesRollup(db.Model):
+    """Daily payment totals per resource and status, maintained incrementally"""
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    resource_id = db.Column(db.Integer, nullable=False)  # no FK: history outlives deleted resources
+    subject = db.Column(db.String(100), nullable=True)
+    class_grade = db.Column(db.String(20), nullable=True)
+    status = db.Column(db.String(20), nullable=False)
+    payment_count = db.Column(db.Integer, nullable=False, default=0)
+    amount_total = db.Column(db.Float, nullable=False, default=0)
+    distinct_buyers = db.Column(db.Integer, nullable=False, default=0)
+    buyer_sketch = db.Column(db.LargeBinary, nullable=True)  # HyperLogLog registers, merged across rows by reports
+
+    __table_args__ = (
+        db.UniqueConstraint('day', 'resource_id', 'status', name='uq_sales_rollup_day_resource_status'),
+    )
+
+    def to_dict(self):
+        return {
+            'day': self.day.isoformat() if self.day else None,
+            'resource_id': self.resource_id,
+            'subject': self.subject,
+            'class_grade': self.class_grade,
+            'status': self.status,
+            'payment_count': self.payment_count,
+            'amount_total': self.amount_total,
+            'distinct_buyers': self.distinct_buyers
+        }
+
+class SalesRollupBuyer(db.Model):
+    """Payments per buyer within a rollup bucket, used to keep distinct_buyers exact"""
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    resource_id = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    user_email = db.Column(db.String(120), nullable=False)
+    payment_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('day', 'resource_id', 'status', 'user_email', name='uq_sales_rollup_buyer_bucket_email'),
+    )
+
+class RevokedToken(db.Model):
+    """A revoked session token (token_id) or every token issued to a user before revoked_at (user_id)"""
+    id = db.Column(db.Integer, primary_key=True)
+    token_id = db.Column(db.String(64), nullable=True, index=True, unique=True)  # unique: a refresh token is redeemed once
+    user_id = db.Column(db.Integer, nullable=True, index=True)
+    # Microseconds kept on MySQL too: tokens issued right after a revocation must compare as newer
+    revoked_at = db.Column(db.DateTime().with_variant(mysql.DATETIME(fsp=6), 'mysql'), nullable=False,
+                           default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)  # safe to delete after this
+
+class Job(db.Model):
+    """A background job (see jobs.py); the row is the queue entry, the lease and the result"""
+    id = db.Column(db.Integer, primary_key=True)
+    queue = db.Column(db.String(50), nullable=False, default='default')
+    name = db.Column(db.String(100), nullable=False)  # registered task
+    payload = db.Column(db.Text, nullable=False, default='{}')  # JSON keyword arguments
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # not claimed before this
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    # Concurrency slot held while running; the unique (queue, slot) pair caps running jobs per queue
+    slot = db.Column(db.Integer, nullable=True)
+    locked_by = db.Column(db.String(100), nullable=True)  # worker id
+    lease_expires_at = db.Column(db.DateTime, nullable=True)  # extended by heartbeats; expired = worker gone
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    unique_key = db.Column(db.String(200), nullable=True, unique=True)  # deduplicates, e.g. one per cron run
+    traceparent = db.Column(db.String(55), nullable=True)  # trace of the request that enqueued it
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        # Claiming: due jobs of one queue, oldest first
+        db.Index('ix_job_queue_status_run_at', 'queue', 'status', 'run_at'),
+        db.UniqueConstraint('queue', 'slot', name='uq_job_queue_slot'),
+    )
+
+class OutboxMessage(db.Model):
+    """Mail or a webhook call to send (see outbox.py), written in the transaction that called for it"""
+    id = db.Column(db.Integer, primary_key=True)
+    channel = db.Column(db.String(20), nullable=False)  # mail, webhook
+    recipient = db.Column(db.String(500), nullable=False)  # address or URL
+    subject = db.Column(db.String(200), nullable=False)  # mail subject or webhook event
+    body = db.Column(db.Text, nullable=False)  # plain text mail, or the webhook's JSON
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # Not sent before this; a sender that claims the message pushes it forward while it works
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    claimed_by = db.Column(db.String(32), nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_outbox_message_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+
+class MigrationCheckpoint(db.Model):
+    """Progress of a batched backfill (see online_migration.py), so an interrupted migration resumes"""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False, unique=True)
+    table_name = db.Column(db.String(100), nullable=False)
+    last_key = db.Column(db.BigInteger, nullable=True)  # highest primary key done; NULL before the first batch
+    rows_done = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+class StatCounter(db.Model):
+    """Running totals for the admin dashboard, kept current by the write paths (see counters.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(30), nullable=False)  # resources, resource_type, class_grade, subject, users, payments
+    key = db.Column(db.String(100), nullable=False)
+    shard = db.Column(db.SmallInteger, nullable=False, default=0, server_default='0')  # a counter is the sum of its shards
+    count = db.Column(db.Integer, nullable=False, default=0)
+    amount = db.Column(db.Float, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('scope', 'key', 'shard', name='uq_stat_counter_scope_key_shard'),
+    )
@@ -0,0 +1,188 @@
+# online_migration.py
+"""
+Online schema changes for Alembic revisions.
+
+A data migration written as one ``UPDATE`` locks every row it touches until
+it finishes, and an index build can block writes to the table the whole
+time. Neither is acceptable on a large table the app is still serving.
+Revisions in ``migrations/versions`` use these helpers instead:
+
+* ``backfill`` runs an ``UPDATE`` in primary-key order, one batch at a time
+  (``MIGRATION_BATCH_SIZE`` rows, ``MIGRATION_PAUSE_SECONDS`` apart). Each
+  batch commits on its own, so only that batch's rows are ever locked.
+  Progress goes to a ``migration_checkpoint`` row named after the backfill,
+  so an interrupted ``flask db upgrade`` resumes after the last batch that
+  finished, and ``forget_backfill`` deletes it on downgrade. Every
+  ``progress_seconds`` the rows done, percentage, rate and ETA are logged,
+  and ``flask backfills`` shows the checkpoints.
+* ``create_index`` and ``drop_index`` use ``CONCURRENTLY`` on PostgreSQL
+  and ``ALGORITHM=INPLACE, LOCK=NONE`` on MySQL. SQLite has no online build
+  and gets a plain ``CREATE INDEX``. Both skip work that is already done,
+  so a revision that was interrupted can simply run again.
+
+For example::
+
+    from online_migration import backfill, create_index
+
+    def upgrade():
+        backfill('payment_amount_cents', 'payment',
+                 {'amount_cents': sa.text('CAST(amount * 100 AS INTEGER)')},
+                 where=sa.text('amount_cents IS NULL'))
+        create_index('ix_payment_amount_cents', 'payment', ['amount_cents'])
+
+A batch and its checkpoint commit separately, so after a crash the last batch
+may run again. Write backfills so that running one twice is harmless, e.g.
+by filtering on ``new_column IS NULL``. ``backfill`` commits the work that
+came before it in the same revision. Keep the expand step (the nullable
+column) in its own revision, the backfill in the next, and the contract step
+(``NOT NULL``, dropping the old column) in the one after.
+"""
+import logging
+import time
+from datetime import datetime
+
+import sqlalchemy as sa
+from flask import current_app
+
+from models import MigrationCheckpoint
+
+logger = logging.getLogger(__name__)
+
+
+def backfill(name, table, values, where=None, key='id', batch_size=None, pause_seconds=None, progress_seconds=10):
+    """Run ``UPDATE table SET values [WHERE where]`` in keyset-paged batches.
+
+    ``values`` maps column names to values or SQL expressions, and ``key``
+    is the table's integer primary key. A backfill that has already finished
+    under ``name`` is skipped. Returns the rows updated under ``name`` so far.
+    """
+    from alembic import op
+
+    config = current_app.config
+    batch_size = batch_size or config['MIGRATION_BATCH_SIZE']
+    pause_seconds = config['MIGRATION_PAUSE_SECONDS'] if pause_seconds is None else pause_seconds
+    with op.get_context().autocommit_block():
+        return _backfill(op.get_bind(), name, table, values, where, key, batch_size, pause_seconds, progress_seconds)
+
+
+def forget_backfill(name):
+    """Delete the checkpoint of backfill ``name``, so that it runs again; for the revision's ``downgrade``."""
+    from alembic import op
+
+    checkpoints = MigrationCheckpoint.__table__
+    op.execute(sa.delete(checkpoints).where(checkpoints.c.name == name))
+
+
+def _backfill(connection, name, table, values, where, key, batch_size, pause_seconds, progress_seconds):
+    checkpoints = MigrationCheckpoint.__table__
+    state = connection.execute(sa.select(checkpoints).where(checkpoints.c.name == name)).first()
+    if state is not None and state.finished_at is not None:
+        logger.info(f"Backfill {name} finished on {state.finished_at:%Y-%m-%d %H:%M}, skipping")
+        return state.rows_done
+    if state is None:
+        now = datetime.utcnow()
+        connection.execute(sa.insert(checkpoints).values(
+            name=name, table_name=table, rows_done=0, started_at=now, updated_at=now
+        ))
+        last_key, rows_done = None, 0
+    else:
+        last_key, rows_done = state.last_key, state.rows_done
+        logger.info(f"Resuming backfill {name} after {key}={last_key} ({rows_done} rows done)")
+
+    target = sa.table(table, sa.column(key), *[sa.column(column) for column in values])
+    target_key = target.c[key]
+    first, last = connection.execute(sa.select(sa.func.min(target_key), sa.func.max(target_key))).one()
+    started = time.monotonic()
+    reported = started
+    updated_here = 0
+    while True:
+        page = sa.select(target_key).order_by(target_key).limit(batch_size)
+        if last_key is not None:
+            page = page.where(target_key > last_key)
+        keys = connection.execute(page).scalars().all()
+        if not keys:
+            break
+        # The page's key range, so the UPDATE only locks the rows it pages over
+        stmt = sa.update(target).where(target_key >= keys[0], target_key <= keys[-1]).values(values)
+        if where is not None:
+            stmt = stmt.where(where)
+        updated = connection.execute(stmt).rowcount
+        last_key = keys[-1]
+        rows_done += updated
+        updated_here += updated
+        connection.execute(sa.update(checkpoints).where(checkpoints.c.name == name).values(
+            last_key=last_key, rows_done=rows_done, updated_at=datetime.utcnow()
+        ))
+        if time.monotonic() - reported >= progress_seconds:
+            reported = time.monotonic()
+            _report(name, last_key, first, last, updated_here, reported - started)
+        if len(keys) < batch_size:
+            break
+        if pause_seconds:
+            time.sleep(pause_seconds)
+
+    connection.execute(sa.update(checkpoints).where(checkpoints.c.name == name).values(
+        rows_done=rows_done, updated_at=datetime.utcnow(), finished_at=datetime.utcnow()
+    ))
+    logger.info(f"Backfill {name} done: {rows_done} rows updated in {time.monotonic() - started:.1f}s")
+    return rows_done
+
+
+def _report(name, last_key, first, last, updated, elapsed):
+    # Share of the key range covered; keys are paged in order, so this is cheap and close enough
+    done = (last_key - first + 1) / max(last - first + 1, 1)
+    eta = elapsed * (1 - done) / done if done else 0
+    logger.info(f"Backfill {name}: {done:.0%} of keys, {updated} rows updated, "
+                f"{updated / elapsed if elapsed else 0:.0f} rows/s, ETA {eta:.0f}s")
+
+
+def _index_names(bind, table):
+    return {index['name'] for index in sa.inspect(bind).get_indexes(table)}
+
+
+def create_index(name, table, columns, unique=False):
+    """Create an index without blocking writes where the dialect allows it.
+
+    Returns False, and does nothing, when an index called ``name`` already exists.
+    """
+    from alembic import op
+
+    bind = op.get_bind()
+    if name in _index_names(bind, table):
+        logger.info(f"Index {name} already exists on {table}")
+        return False
+    dialect = bind.dialect.name
+    logger.info(f"Building index {name} on {table} ({', '.join(columns)})")
+    if dialect == 'postgresql':
+        # CONCURRENTLY can't run inside a transaction
+        with op.get_context().autocommit_block():
+            op.create_index(name, table, columns, unique=unique, postgresql_concurrently=True)
+    elif dialect == 'mysql':
+        quote = bind.dialect.identifier_preparer.quote
+        op.execute(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX {quote(name)} ON {quote(table)} "
+            f"({', '.join(quote(column) for column in columns)}) ALGORITHM=INPLACE LOCK=NONE"
+        )
+    else:
+        op.create_index(name, table, columns, unique=unique)
+    return True
+
+
+def drop_index(name, table):
+    """Drop an index without blocking writes where the dialect allows it. Returns False if it doesn't exist."""
+    from alembic import op
+
+    bind = op.get_bind()
+    if name not in _index_names(bind, table):
+        logger.info(f"Index {name} does not exist on {table}")
+        return False
+    dialect = bind.dialect.name
+    if dialect == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
+    elif dialect == 'mysql':
+        quote = bind.dialect.identifier_preparer.quote
+        op.execute(f"DROP INDEX {quote(name)} ON {quote(table)} ALGORITHM=INPLACE LOCK=NONE")
+    else:
+        op.drop_index(name, table_name=table)
+    return True
@@ -0,0 +1,380 @@
+# outbox.py
+"""
+Transactional outbox for mail and webhooks.
+
+Receipts, password reset mail and webhook calls must go out exactly when the
+change behind them commits. Sending from the request would put SMTP or HTTP
+latency in front of the response and could send mail for a transaction that
+then rolls back. Instead ``outbox.send_mail()`` and ``outbox.send_webhook()``
+add an ``outbox_message`` row to the current session, and the caller's commit
+saves it together with the change. They also queue a ``deliver-outbox`` job.
+That job runs every minute as well, in case a nudge is lost.
+
+``outbox.deliver()`` claims due messages ``OUTBOX_BATCH_SIZE`` at a time.
+Each channel opens its transport once per run and sends the whole batch over
+it, so there is one SMTP login per batch, not one per message. A failed
+message is retried with exponential backoff (``OUTBOX_RETRY_BASE_SECONDS``,
+doubling) until ``OUTBOX_MAX_ATTEMPTS``. Permanent failures, such as a
+refused recipient or a 4xx from a webhook, fail right away.
+
+Delivery is at least once: a sender that dies mid-batch leaves its claim to
+expire (``OUTBOX_CLAIM_SECONDS``) and the batch is sent again. Mail carries a
+``Message-ID`` and webhooks an ``X-Webhook-Id`` made from the message id, so
+receivers can drop repeats.
+
+Transports are picked by name (``OUTBOX_MAIL_TRANSPORT``,
+``OUTBOX_WEBHOOK_TRANSPORT``) from ``TRANSPORTS``:
+
+* ``smtp`` sends mail through ``SMTP_HOST`` (``smtp_sink.py`` is a local stand-in).
+* ``webhook`` POSTs signed JSON with one ``requests`` session per run.
+* ``file`` writes each message to ``OUTBOX_FILE_DIR``, for development. Mail
+  there includes live password reset links, so the directory and files are
+  private to the app's user, and the transport is only used when chosen.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import uuid
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import func
+
+from jobs import job_runner
+from models import db, OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+MAIL = 'mail'
+WEBHOOK = 'webhook'
+
+PENDING = 'pending'
+SENT = 'sent'
+FAILED = 'failed'
+
+
+class PermanentDeliveryError(Exception):
+    """Raised by a transport when retrying the message cannot help."""
+
+
+class SMTPTransport:
+    """Mail over one SMTP connection per batch, reconnecting if the server drops it."""
+
+    def __init__(self, config):
+        self.host = config['SMTP_HOST']
+        self.port = config['SMTP_PORT']
+        self.username = config['SMTP_USERNAME']
+        self.password = config['SMTP_PASSWORD']
+        self.security = config['SMTP_SECURITY']
+        self.timeout = config['SMTP_TIMEOUT']
+        self.sender = config['MAIL_FROM']
+        self.connection = None
+
+    def open(self):
+        import smtplib
+
+        if self.security == 'ssl':
+            connection = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.security == 'starttls':
+                connection.starttls()
+            if self.username:
+                connection.login(self.username, self.password)
+        except Exception:
+            connection.close()
+            raise
+        self.connection = connection
+
+    def send(self, message):
+        import smtplib
+        from email.message import EmailMessage
+        from email.utils import formatdate, parseaddr
+
+        mail = EmailMessage()
+        mail['From'] = self.sender
+        mail['To'] = message.recipient
+        mail['Subject'] = message.subject
+        mail['Date'] = formatdate(localtime=False)
+        mail['Message-ID'] = f"<outbox-{message.id}@{parseaddr(self.sender)[1].rpartition('@')[2] or 'localhost'}>"
+        mail.set_content(message.body)
+        for attempt in range(2):
+            if self.connection is None:
+                self.open()
+            try:
+                self.connection.send_message(mail)
+                return
+            except smtplib.SMTPServerDisconnected:
+                # Idle connections get dropped; reconnect once
+                self.connection = None
+                if attempt:
+                    raise
+            except smtplib.SMTPRecipientsRefused as e:
+                raise PermanentDeliveryError(f"Recipient refused: {e.recipients}")
+            except smtplib.SMTPResponseException as e:
+                if 500 <= e.smtp_code < 600:
+                    raise PermanentDeliveryError(f"{e.smtp_code} {e.smtp_error!r}")
+                raise
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except Exception:
+                self.connection.close()
+            self.connection = None
+
+
+class WebhookTransport:
+    """Signed JSON POSTs over one keep-alive ``requests`` session per batch."""
+
+    def __init__(self, config):
+        self.secret = config['WEBHOOK_SECRET']
+        self.timeout = config['WEBHOOK_TIMEOUT']
+        self.session = None
+
+    def open(self):
+        import requests
+
+        self.session = requests.Session()
+
+    def send(self, message):
+        headers = {
+            'Content-Type': 'application/json',
+            'X-Webhook-Id': str(message.id),
+            'X-Webhook-Event': message.subject,
+        }
+        if self.secret:
+            signature = hmac.new(self.secret.encode(), message.body.encode(), hashlib.sha256).hexdigest()
+            headers['X-Webhook-Signature'] = f"sha256={signature}"
+        response = self.session.post(message.recipient, data=message.body.encode(), headers=headers,
+                                     timeout=self.timeout)
+        # Timeouts and rate limits are worth retrying; other client errors are not
+        if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+            raise PermanentDeliveryError(f"HTTP {response.status_code} from {message.recipient}")
+        response.raise_for_status()
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+
+class FileTransport:
+    """Writes each message to OUTBOX_FILE_DIR instead of sending it."""
+
+    def __init__(self, config):
+        self.directory = config['OUTBOX_FILE_DIR']
+        self.sender = config['MAIL_FROM']
+
+    def open(self):
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        os.chmod(self.directory, 0o700)  # also when it already existed; fails unless it's ours
+
+    def send(self, message):
+        if message.channel == MAIL:
+            name = f"{message.id:08d}.eml"
+            content = (f"From: {self.sender}\nTo: {message.recipient}\nSubject: {message.subject}\n\n"
+                       f"{message.body}\n")
+        else:
+            name = f"{message.id:08d}.json"
+            content = json.dumps({'url': message.recipient, 'event': message.subject,
+                                  'body': json.loads(message.body)}, indent=2)
+        path = os.path.join(self.directory, name)
+        with open(os.open(f"{path}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(f"{path}.tmp", path)
+
+    def close(self):
+        pass
+
+
+TRANSPORTS = {
+    'smtp': SMTPTransport,
+    'webhook': WebhookTransport,
+    'file': FileTransport,
+}
+
+
+class Outbox:
+    def __init__(self):
+        self.transport_names = {MAIL: 'smtp', WEBHOOK: 'webhook'}
+        self.batch_size = 100
+        self.claim_seconds = 300
+        self.max_attempts = 10
+        self.retry_base_seconds = 30.0
+        self.retry_max_seconds = 21600.0
+        self.webhook_urls = []
+
+    def init_app(self, app):
+        config = app.config
+        self.transport_names = {MAIL: config['OUTBOX_MAIL_TRANSPORT'], WEBHOOK: config['OUTBOX_WEBHOOK_TRANSPORT']}
+        for name in self.transport_names.values():
+            if name not in TRANSPORTS:
+                raise ValueError(f"Unknown outbox transport: {name}")
+        self.batch_size = config['OUTBOX_BATCH_SIZE']
+        self.claim_seconds = config['OUTBOX_CLAIM_SECONDS']
+        self.max_attempts = config['OUTBOX_MAX_ATTEMPTS']
+        self.retry_base_seconds = config['OUTBOX_RETRY_BASE_SECONDS']
+        self.retry_max_seconds = config['OUTBOX_RETRY_MAX_SECONDS']
+        self.webhook_urls = list(config['WEBHOOK_URLS'])
+
+    def _add(self, channel, recipient, subject, body):
+        message = OutboxMessage(channel=channel, recipient=recipient, subject=subject, body=body,
+                                status=PENDING, next_attempt_at=datetime.utcnow())
+        db.session.add(message)
+        return message
+
+    def _nudge(self):
+        # One delivery job per transaction, however many messages it queues
+        session = db.session()
+        transaction = session.get_transaction()
+        if transaction is None or session.info.get('outbox_nudged') is not transaction:
+            job_runner.enqueue('deliver-outbox')
+            session.info['outbox_nudged'] = session.get_transaction()
+
+    def send_mail(self, to, subject, body):
+        """Queue a plain text mail in the current session; it is sent after the caller commits."""
+        message = self._add(MAIL, to, subject, body)
+        self._nudge()
+        return message
+
+    def send_webhook(self, event, data):
+        """Queue ``event`` for every WEBHOOK_URLS receiver in the current session. Returns the messages."""
+        messages = []
+        for url in self.webhook_urls:
+            message = self._add(WEBHOOK, url, event, '')
+            db.session.flush()  # the id goes into the body
+            message.body = json.dumps({'id': message.id, 'event': event,
+                                       'created_at': message.created_at.isoformat() + 'Z', 'data': data})
+            messages.append(message)
+        if messages:
+            self._nudge()
+        return messages
+
+    def retry_delay(self, attempts):
+        """Seconds before attempt ``attempts + 1``: exponential, capped, with jitter."""
+        delay = min(self.retry_max_seconds, self.retry_base_seconds * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _claim(self, sender_id, batch_size):
+        now = datetime.utcnow()
+        ids = [message_id for message_id, in db.session.query(OutboxMessage.id).filter(
+            OutboxMessage.status == PENDING, OutboxMessage.next_attempt_at <= now
+        ).order_by(OutboxMessage.next_attempt_at, OutboxMessage.id).limit(batch_size)]
+        if not ids:
+            db.session.rollback()
+            return []
+        # Messages another sender claimed since the SELECT no longer match
+        OutboxMessage.query.filter(
+            OutboxMessage.id.in_(ids), OutboxMessage.status == PENDING, OutboxMessage.next_attempt_at <= now
+        ).update({
+            'claimed_by': sender_id,
+            'next_attempt_at': now + timedelta(seconds=self.claim_seconds),
+        }, synchronize_session=False)
+        db.session.commit()
+        return OutboxMessage.query.filter(
+            OutboxMessage.id.in_(ids), OutboxMessage.claimed_by == sender_id
+        ).order_by(OutboxMessage.id).all()
+
+    def deliver(self, batch_size=None, max_batches=None):
+        """Send due messages until none are left (or ``max_batches``). Returns {'sent', 'retried', 'failed'} counts."""
+        batch_size = batch_size or self.batch_size
+        sender_id = uuid.uuid4().hex
+        config = current_app.config
+        transports = {}
+        unavailable = {}  # channel -> why its transport could not be opened
+        counts = {'sent': 0, 'retried': 0, 'failed': 0}
+        batches = 0
+        try:
+            while max_batches is None or batches < max_batches:
+                messages = self._claim(sender_id, batch_size)
+                if not messages:
+                    break
+                batches += 1
+                for message in messages:
+                    message.attempts += 1
+                    try:
+                        if message.channel in unavailable:
+                            raise unavailable[message.channel]
+                        transport = transports.get(message.channel)
+                        if transport is None:
+                            transport = TRANSPORTS[self.transport_names[message.channel]](config)
+                            try:
+                                transport.open()
+                            except Exception as e:
+                                # Don't wait out a connect timeout for every message in the batch
+                                unavailable[message.channel] = e
+                                raise
+                            transports[message.channel] = transport
+                        transport.send(message)
+                    except Exception as e:
+                        error = f"{type(e).__name__}: {e}"
+                        if isinstance(e, PermanentDeliveryError) or message.attempts >= self.max_attempts:
+                            logger.error(f"Outbox message {message.id} ({message.channel} to {message.recipient}) "
+                                         f"failed after {message.attempts} attempts: {error}")
+                            message.status = FAILED
+                            counts['failed'] += 1
+                        else:
+                            delay = self.retry_delay(message.attempts)
+                            logger.warning(f"Outbox message {message.id} attempt {message.attempts} failed, "
+                                           f"retrying in {delay:.0f}s: {error}")
+                            message.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+                            counts['retried'] += 1
+                        message.last_error = error
+                    else:
+                        message.status = SENT
+                        message.sent_at = datetime.utcnow()
+                        message.last_error = None
+                        counts['sent'] += 1
+                    message.claimed_by = None
+                # One commit per batch; a crash before it resends the batch (see module docstring)
+                db.session.commit()
+                if len(messages) < batch_size:
+                    break
+        finally:
+            for channel, transport in transports.items():
+                try:
+                    transport.close()
+                except Exception as e:
+                    logger.warning(f"Could not close the {channel} transport: {str(e)}")
+        if batches:
+            logger.info(f"Outbox delivered in {batches} batches: {counts}")
+        return counts
+
+    def purge_finished(self, older_than, batch_size=1000):
+        """Delete sent and failed messages created before ``older_than``, in batches. Returns the number removed."""
+        removed = 0
+        while True:
+            ids = [row.id for row in OutboxMessage.query.with_entities(OutboxMessage.id)
+                   .filter(OutboxMessage.status.in_([SENT, FAILED]), OutboxMessage.created_at < older_than)
+                   .limit(batch_size)]
+            if not ids:
+                return removed
+            OutboxMessage.query.filter(OutboxMessage.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+            removed += len(ids)
+
+    def status_counts(self):
+        """{(channel, status): count} over the outbox."""
+        rows = db.session.query(OutboxMessage.channel, OutboxMessage.status, func.count()).group_by(
+            OutboxMessage.channel, OutboxMessage.status
+        )
+        return {(channel, status): count for channel, status, count in rows}
+
+
+outbox = Outbox()
+
+
+@job_runner.task('deliver-outbox', queue='outbox', cron='* * * * *')
+def deliver_outbox_job():
+    outbox.deliver()
+
+
+@job_runner.task('purge-outbox', cron='50 3 * * *')
+def purge_outbox_job():
+    outbox.purge_finished(datetime.utcnow() - timedelta(days=current_app.config['OUTBOX_KEEP_DAYS']))
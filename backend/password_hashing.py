@@ -0,0 +1,142 @@
+# password_hashing.py
+"""
+Password hashing service.
+
+Werkzeug's KDFs (scrypt, pbkdf2) are deliberately slow. Running them inline
+lets a burst of logins pin every worker on CPU, so hashing and verification
+run in a small process pool instead. A semaphore bounds how many calls may be
+running or waiting at once; beyond that, callers get ``HashingBusyError``
+straight away instead of queueing behind the burst.
+
+Pool processes are started with ``forkserver`` by default, so they never
+inherit the app's threads, locks or database connections. Like any
+multiprocessing code, scripts that use the hasher need an
+``if __name__ == '__main__':`` guard. This module only imports the standard
+library and Werkzeug so pool processes start quickly.
+"""
+import atexit
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+logger = logging.getLogger(__name__)
+
+
+class HashingBusyError(Exception):
+    """Raised when the hashing queue is full."""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _method_prefix(password_hash):
+    """The algorithm and cost part of a Werkzeug hash, e.g. 'scrypt:32768:8:1'."""
+    return password_hash.split('$', 1)[0]
+
+
+def resolve_method(method):
+    """``method`` with Werkzeug's default costs filled in, as stored in its hashes.
+
+    Mirrors ``werkzeug.security._hash_internal`` so the prefix is known
+    without running the KDF: 'scrypt' -> 'scrypt:32768:8:1'.
+    """
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        if not args:
+            args = [2 ** 15, 8, 1]
+        elif len(args) != 3:
+            raise ValueError("'scrypt' takes 3 arguments.")
+        n, r, p = map(int, args)
+        return f"scrypt:{n}:{r}:{p}"
+    if name == 'pbkdf2':
+        if len(args) > 2:
+            raise ValueError("'pbkdf2' takes 2 arguments.")
+        hash_name = args[0] if args else 'sha256'
+        iterations = int(args[1]) if len(args) == 2 else DEFAULT_PBKDF2_ITERATIONS
+        return f"pbkdf2:{hash_name}:{iterations}"
+    raise ValueError(f"Invalid hash method '{method}'.")
+
+
+class PasswordHasher:
+    def __init__(self, method='scrypt', workers=1, max_queue=8, acquire_timeout=0.0, start_method=None):
+        self.configure(method, workers, max_queue, acquire_timeout, start_method)
+        self._executor = None
+        self._executor_pid = None
+        self._executor_lock = threading.Lock()
+        atexit.register(self.shutdown)
+
+    def configure(self, method, workers, max_queue, acquire_timeout=0.0, start_method=None):
+        """Apply settings. ``workers=0`` hashes inline in the calling thread."""
+        if not start_method:
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.start_method = start_method
+        self.method = method
+        self.workers = workers
+        self.max_queue = max_queue
+        self.acquire_timeout = acquire_timeout
+        # Calls allowed in flight: one per pool process plus the queue
+        self._slots = threading.BoundedSemaphore(max(1, workers) + max_queue)
+        # Resolved up front, so an unknown method fails at startup rather than at login
+        self.method_prefix = resolve_method(method)
+        if getattr(self, '_executor', None) is not None:
+            self.shutdown()
+
+    def init_app(self, app):
+        self.configure(
+            app.config['PASSWORD_HASH_METHOD'],
+            app.config['PASSWORD_HASH_WORKERS'],
+            app.config['PASSWORD_HASH_MAX_QUEUE'],
+            app.config['PASSWORD_HASH_ACQUIRE_TIMEOUT'],
+            app.config['PASSWORD_HASH_START_METHOD']
+        )
+
+    def _get_executor(self):
+        # A pool inherited across fork (gunicorn workers) is unusable; make a new one
+        with self._executor_lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(self.start_method)
+                )
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _run(self, func, *args, **kwargs):
+        if self.acquire_timeout:
+            acquired = self._slots.acquire(timeout=self.acquire_timeout)
+        else:
+            acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            logger.warning("Password hashing queue is full, rejecting request")
+            raise HashingBusyError("Too many password operations in progress")
+        try:
+            if self.workers <= 0:
+                return func(*args, **kwargs)
+            return self._get_executor().submit(func, *args, **kwargs).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, method=self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True when ``password_hash`` was made with a different algorithm or cost."""
+        return _method_prefix(password_hash) != self.method_prefix
+
+    def shutdown(self):
+        with self._executor_lock:
+            if self._executor is not None and self._executor_pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._executor_pid = None
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the PesaPal v3 API
+
+Implements just enough of PesaPal for the checkout flow to run offline:
+Auth/RequestToken, URLSetup/RegisterIPN, Transactions/SubmitOrderRequest and
+Transactions/GetTransactionStatus, plus IPN notifications posted back to the
+order's callback_url. Latency, error rate, duplicate and out-of-order
+notifications are configurable so the payment path can be load tested.
+
+Usage:
+    python pesapal_emulator.py --port 8090 --latency-ms 150 --error-rate 0.02
+
+Then point the app at it:
+    PESAPAL_BASE_URL=http://127.0.0.1:8090/v3/api
+    PESAPAL_CALLBACK_URL=http://127.0.0.1:5000/api/pesapal-callback
+"""
+import argparse
+import logging
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+import requests
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+logger = logging.getLogger(__name__)
+
+# PesaPal GetTransactionStatus status codes
+STATUS_CODES = {'INVALID': 0, 'COMPLETED': 1, 'FAILED': 2, 'REVERSED': 3}
+
+
+@dataclass
+class EmulatorSettings:
+    latency_ms: float = 50.0  # added to every API call
+    latency_jitter_ms: float = 25.0
+    error_rate: float = 0.0  # fraction of API calls answered with a 500
+    failure_rate: float = 0.1  # fraction of orders that end FAILED instead of COMPLETED
+    ipn_delay_ms: float = 200.0  # delay before the first IPN for an order
+    duplicate_rate: float = 0.1  # fraction of orders whose final IPN is sent twice
+    out_of_order_rate: float = 0.1  # fraction of orders with a stale FAILED IPN after COMPLETED
+    ipn_retries: int = 5  # delivery attempts per notification
+    ipn_url: str = None  # overrides the callback_url sent with each order
+    ipn_workers: int = 16
+
+
+class PesapalEmulator:
+    def __init__(self, settings=None, seed=None):
+        self.settings = settings or EmulatorSettings()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self.orders = {}  # PesaPal order_tracking_id -> order
+        self.orders_by_reference = {}  # merchant reference -> [order_tracking_id, ...]
+        self.ipn_latencies = []  # seconds per delivered notification
+        self.counters = {
+            'token_requests': 0,
+            'orders_submitted': 0,
+            'status_queries': 0,
+            'injected_errors': 0,
+            'ipn_sent': 0,
+            'ipn_delivered': 0,
+            'ipn_failed_attempts': 0,
+            'ipn_given_up': 0,
+        }
+        self._ipn_pending = 0
+        self._ipn_pool = ThreadPoolExecutor(max_workers=self.settings.ipn_workers,
+                                            thread_name_prefix='pesapal-ipn')
+        self._http = threading.local()  # one requests.Session per IPN thread
+        self.app = self._build_app()
+
+    # ------------------------------------------------------------------ helpers
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def _chance(self, rate):
+        with self._lock:
+            return self._random.random() < rate
+
+    def _simulate_latency(self):
+        s = self.settings
+        with self._lock:
+            delay = s.latency_ms + self._random.uniform(-s.latency_jitter_ms, s.latency_jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+    def _injected_error(self):
+        if self.settings.error_rate and self._chance(self.settings.error_rate):
+            self._count('injected_errors')
+            return jsonify({
+                'error': {'error_type': 'api_error', 'code': 'internal_error',
+                          'message': 'Injected emulator failure'},
+                'status': '500'
+            }), 500
+        return None
+
+    def _authorized(self):
+        header = request.headers.get('Authorization', '')
+        token = header[len('Bearer '):] if header.startswith('Bearer ') else None
+        with self._lock:
+            expires = self._tokens.get(token)
+        return expires is not None and expires > datetime.utcnow()
+
+    # ---------------------------------------------------------------- IPN flow
+
+    def _plan_notifications(self, order):
+        """Return the IPN statuses to send for ``order``, in delivery order."""
+        final = order['status']
+        notifications = [final]
+        if final == 'COMPLETED' and self._chance(self.settings.out_of_order_rate):
+            # An earlier failed attempt whose notification arrives late
+            notifications.append('FAILED')
+        if self._chance(self.settings.duplicate_rate):
+            notifications.insert(1, final)
+        return notifications
+
+    def _deliver(self, order, status, delay):
+        time.sleep(delay)
+        payload = {
+            # Fields the app's callback reads
+            'order_tracking_id': order['merchant_reference'],
+            'transaction_tracking_id': order['order_tracking_id'],
+            'payment_status': status,
+            # Fields real PesaPal IPNs carry
+            'OrderTrackingId': order['order_tracking_id'],
+            'OrderMerchantReference': order['merchant_reference'],
+            'OrderNotificationType': 'IPNCHANGE'
+        }
+        url = self.settings.ipn_url or order['callback_url']
+        try:
+            for attempt in range(self.settings.ipn_retries):
+                started = time.perf_counter()
+                try:
+                    if not hasattr(self._http, 'session'):
+                        self._http.session = requests.Session()
+                    resp = self._http.session.post(url, json=payload, timeout=30)
+                    ok = resp.status_code == 200
+                except requests.exceptions.RequestException as e:
+                    logger.warning(f"IPN delivery error for {order['merchant_reference']}: {e}")
+                    ok = False
+                if ok:
+                    with self._lock:
+                        self.counters['ipn_delivered'] += 1
+                        self.ipn_latencies.append(time.perf_counter() - started)
+                    return
+                self._count('ipn_failed_attempts')
+                time.sleep(min(0.1 * 2 ** attempt, 2.0))
+            self._count('ipn_given_up')
+            logger.error(f"Gave up delivering {status} IPN for {order['merchant_reference']}")
+        finally:
+            with self._lock:
+                self._ipn_pending -= 1
+
+    def _schedule_notifications(self, order):
+        delay = self.settings.ipn_delay_ms / 1000.0
+        for index, status in enumerate(self._plan_notifications(order)):
+            with self._lock:
+                self._ipn_pending += 1
+                self.counters['ipn_sent'] += 1
+            # Space notifications out so their arrival order is the planned order
+            self._ipn_pool.submit(self._deliver, order, status, delay + index * 0.05)
+
+    def wait_for_notifications(self, timeout=60.0):
+        """Block until every scheduled IPN is delivered or abandoned."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if self._ipn_pending == 0:
+                    return True
+            time.sleep(0.05)
+        return False
+
+    # ------------------------------------------------------------------ routes
+
+    def _build_app(self):
+        app = Flask(__name__)
+
+        @app.route('/v3/api/Auth/RequestToken', methods=['POST'])
+        def request_token():
+            self._simulate_latency()
+            self._count('token_requests')
+            error = self._injected_error()
+            if error:
+                return error
+            data = request.get_json(silent=True) or {}
+            if not data.get('consumer_key') or not data.get('consumer_secret'):
+                return jsonify({
+                    'token': None,
+                    'error': {'error_type': 'api_error', 'code': 'invalid_consumer_key_or_secret_provided',
+                              'message': 'Invalid consumer_key or consumer_secret provided'},
+                    'status': '500'
+                }), 500
+            token = uuid.uuid4().hex
+            expires = datetime.utcnow() + timedelta(minutes=5)
+            with self._lock:
+                self._tokens[token] = expires
+            return jsonify({
+                'token': token,
+                'expiryDate': expires.isoformat() + 'Z',
+                'error': None,
+                'status': '200',
+                'message': 'Request processed successfully'
+            })
+
+        @app.route('/v3/api/URLSetup/RegisterIPN', methods=['POST'])
+        def register_ipn():
+            self._simulate_latency()
+            if not self._authorized():
+                return jsonify({'error': {'code': 'invalid_token'}, 'status': '401'}), 401
+            data = request.get_json(silent=True) or {}
+            return jsonify({
+                'url': data.get('url'),
+                'created_date': datetime.utcnow().isoformat(),
+                'ipn_id': str(uuid.uuid4()),
+                'notification_type': 0,
+                'ipn_notification_type_description': data.get('ipn_notification_type', 'POST'),
+                'ipn_status': 1,
+                'ipn_status_description': 'Active',
+                'error': None,
+                'status': '200'
+            })
+
+        @app.route('/v3/api/Transactions/SubmitOrderRequest', methods=['POST'])
+        def submit_order():
+            self._simulate_latency()
+            error = self._injected_error()
+            if error:
+                return error
+            if not self._authorized():
+                return jsonify({'error': {'code': 'invalid_token'}, 'status': '401'}), 401
+            data = request.get_json(silent=True) or {}
+            missing = [f for f in ('id', 'amount', 'callback_url', 'notification_id') if not data.get(f)]
+            if missing:
+                return jsonify({
+                    'error': {'error_type': 'api_error', 'code': 'missing_fields',
+                              'message': f"Missing fields: {', '.join(missing)}"},
+                    'status': '400'
+                }), 400
+
+            order_tracking_id = str(uuid.uuid4())
+            order = {
+                'order_tracking_id': order_tracking_id,
+                'merchant_reference': data['id'],
+                'amount': data['amount'],
+                'currency': data.get('currency', 'KES'),
+                'callback_url': data['callback_url'],
+                'email': (data.get('billing_address') or {}).get('email_address'),
+                'status': 'FAILED' if self._chance(self.settings.failure_rate) else 'COMPLETED',
+                'created_date': datetime.utcnow().isoformat()
+            }
+            with self._lock:
+                self.orders[order_tracking_id] = order
+                self.orders_by_reference.setdefault(data['id'], []).append(order_tracking_id)
+                self.counters['orders_submitted'] += 1
+            self._schedule_notifications(order)
+
+            return jsonify({
+                'order_tracking_id': order_tracking_id,
+                'merchant_reference': data['id'],
+                'redirect_url': f"{request.host_url}iframe/PesapalIframe3/Index?OrderTrackingId={order_tracking_id}",
+                'error': None,
+                'status': '200'
+            })
+
+        @app.route('/v3/api/Transactions/GetTransactionStatus', methods=['GET'])
+        def transaction_status():
+            self._simulate_latency()
+            self._count('status_queries')
+            error = self._injected_error()
+            if error:
+                return error
+            if not self._authorized():
+                return jsonify({'error': {'code': 'invalid_token'}, 'status': '401'}), 401
+            with self._lock:
+                order = self.orders.get(request.args.get('orderTrackingId'))
+            if not order:
+                return jsonify({
+                    'payment_status_description': 'INVALID',
+                    'status_code': STATUS_CODES['INVALID'],
+                    'error': {'code': 'order_not_found'},
+                    'status': '500'
+                }), 500
+            return jsonify({
+                'payment_method': 'MpesaKE',
+                'amount': order['amount'],
+                'created_date': order['created_date'],
+                'confirmation_code': order['order_tracking_id'][:10].upper(),
+                'payment_status_description': order['status'].capitalize(),
+                'description': None,
+                'message': 'Request processed successfully',
+                'payment_account': None,
+                'call_back_url': order['callback_url'],
+                'status_code': STATUS_CODES.get(order['status'], 0),
+                'merchant_reference': order['merchant_reference'],
+                'currency': order['currency'],
+                'error': None,
+                'status': '200'
+            })
+
+        @app.route('/emulator/stats', methods=['GET'])
+        def emulator_stats():
+            return jsonify(self.stats())
+
+        return app
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, ipn_pending=self._ipn_pending, orders=len(self.orders))
+
+    # ----------------------------------------------------------------- serving
+
+    def start(self, host='127.0.0.1', port=0):
+        """Serve the emulator from a background thread. Returns the API base URL."""
+        self._server = make_server(host, port, self.app, threaded=True)
+        thread = threading.Thread(target=self._server.serve_forever, name='pesapal-emulator', daemon=True)
+        thread.start()
+        return f"http://{host}:{self._server.server_port}/v3/api"
+
+    def stop(self):
+        if getattr(self, '_server', None):
+            self._server.shutdown()
+        self._ipn_pool.shutdown(wait=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local PesaPal v3 API emulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency-ms', type=float, default=50.0)
+    parser.add_argument('--latency-jitter-ms', type=float, default=25.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--failure-rate', type=float, default=0.1)
+    parser.add_argument('--ipn-delay-ms', type=float, default=200.0)
+    parser.add_argument('--duplicate-rate', type=float, default=0.1)
+    parser.add_argument('--out-of-order-rate', type=float, default=0.1)
+    parser.add_argument('--ipn-url', help='Send IPNs here instead of each order\'s callback_url')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    settings = EmulatorSettings(
+        latency_ms=args.latency_ms,
+        latency_jitter_ms=args.latency_jitter_ms,
+        error_rate=args.error_rate,
+        failure_rate=args.failure_rate,
+        ipn_delay_ms=args.ipn_delay_ms,
+        duplicate_rate=args.duplicate_rate,
+        out_of_order_rate=args.out_of_order_rate,
+        ipn_url=args.ipn_url
+    )
+    emulator = PesapalEmulator(settings, seed=args.seed)
+    print(f"PesaPal emulator listening on http://{args.host}:{args.port}/v3/api")
+    emulator.app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+# profiling.py
+"""
+On-demand profiling of a running worker.
+
+``cpu_profiler`` samples the stacks of every thread in this process with
+``sys._current_frames()`` from a background thread, for a bounded time, and
+writes the result in the collapsed ("folded") format that flamegraph.pl,
+speedscope and similar tools read: one line per distinct stack,
+``root;caller;leaf count``. Sampling only reads frames, so requests carry on
+at full speed apart from the sampler's own share of the GIL.
+
+Under gevent the sampler still needs an OS thread of its own: a greenlet
+sampler could only run while every other greenlet is parked, so it would
+never see one working. It starts on the unpatched ``_thread`` functions, and
+the worker thread's frame is then whichever greenlet is running. Parked
+greenlets are waiting, not using CPU, so they are left out like idle threads;
+the hub waiting for I/O counts as idle too.
+
+``memory_profiler`` wraps ``tracemalloc``: start tracing, run the suspect
+workload, then diff a snapshot against the baseline to see which source
+lines allocated the memory still held. Tracing slows every allocation, so it
+stops itself after ``MEMORY_PROFILE_MAX_SECONDS``.
+
+Neither does anything until asked: no threads, no hooks, no tracing. Both
+work on the worker that handles the request, so responses carry its pid.
+Profiles are written to ``PROFILE_DIR``, where any worker can serve them.
+"""
+import logging
+import os
+import re
+import sys
+import _thread
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Innermost Python frames of threads that are blocked rather than working
+IDLE_FUNCTIONS = {'wait', 'select', 'poll', 'accept', 'sleep', '_wait_for_tstate_lock', 'readinto', 'recv_into'}
+# The gevent hub's frame while its event loop waits for I/O
+IDLE_FRAMES = {'gevent.hub:Hub.run'}
+PROFILE_NAME = re.compile(r'^cpu-\d+-\d{8}T\d{6}\.folded$')
+
+
+class ProfilerBusyError(Exception):
+    """Raised when a profile is already running in this worker."""
+
+
+def _os_thread_functions():
+    """``start_new_thread``, ``get_ident`` and ``sleep`` for real OS threads, even once gevent patched them."""
+    if 'gevent.monkey' in sys.modules:
+        from gevent import monkey
+        if monkey.is_module_patched('threading'):
+            start_new_thread, get_ident = monkey.get_original('_thread', ['start_new_thread', 'get_ident'])
+            return start_new_thread, get_ident, monkey.get_original('time', 'sleep')
+    return _thread.start_new_thread, _thread.get_ident, time.sleep
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{frame.f_globals.get('__name__', '?')}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def collapse_stack(frame):
+    """'module:func;module:func' from the outermost frame to ``frame``."""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    def __init__(self, directory=None, max_seconds=60, interval=0.01):
+        self.directory = directory
+        self.max_seconds = max_seconds
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._running = False
+        self.last_profile = None
+
+    def init_app(self, app):
+        self.directory = app.config['PROFILE_DIR']
+        self.max_seconds = app.config['PROFILER_MAX_SECONDS']
+        self.interval = app.config['PROFILER_INTERVAL_MS'] / 1000.0
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self, seconds, interval=None, include_idle=False):
+        """Sample for ``seconds`` (capped at ``max_seconds``) in a background OS thread.
+
+        Returns the path the profile will be written to.
+        """
+        seconds = max(0.1, min(float(seconds), self.max_seconds))
+        interval = max(0.001, interval or self.interval)
+        with self._lock:
+            if self.running:
+                raise ProfilerBusyError(f"A CPU profile is already running in worker {os.getpid()}")
+            os.makedirs(self.directory, exist_ok=True)
+            stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+            path = os.path.join(self.directory, f"cpu-{os.getpid()}-{stamp}.folded")
+            start_new_thread, get_ident, sleep = _os_thread_functions()
+            self._running = True
+            try:
+                start_new_thread(self._run, (path, seconds, interval, include_idle, get_ident, sleep))
+            except BaseException:
+                self._running = False
+                raise
+        logger.info(f"CPU profile started for {seconds}s every {interval * 1000:.1f}ms: {path}")
+        return path
+
+    def join(self, timeout=None):
+        # Polls with the (possibly patched) time.sleep, so a waiting greenlet lets the others run
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.running and (deadline is None or time.monotonic() < deadline):
+            time.sleep(0.05)
+
+    def _run(self, path, seconds, interval, include_idle, get_ident, sleep):
+        try:
+            me = get_ident()
+            stacks = Counter()
+            samples = 0
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == me:
+                        continue
+                    if not include_idle and (frame.f_code.co_name in IDLE_FUNCTIONS
+                                             or _frame_name(frame) in IDLE_FRAMES):
+                        continue
+                    stacks[collapse_stack(frame)] += 1
+                samples += 1
+                sleep(interval)
+
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            os.replace(tmp_path, path)
+            self.last_profile = path
+            logger.info(f"CPU profile finished: {samples} samples, {len(stacks)} distinct stacks in {path}")
+        except Exception:
+            logger.exception(f"CPU profile failed: {path}")
+        finally:
+            self._running = False
+
+    def profiles(self):
+        """Finished profiles in the profile directory, newest first."""
+        if not self.directory or not os.path.isdir(self.directory):
+            return []
+        names = [name for name in os.listdir(self.directory) if PROFILE_NAME.match(name)]
+        return sorted(names, key=lambda name: name.split('-', 2)[2], reverse=True)
+
+    def profile_path(self, name):
+        """Path of a finished profile, or None for unknown (or unsafe) names."""
+        if not PROFILE_NAME.match(name):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+
+class MemoryProfiler:
+    def __init__(self, max_seconds=600, frames=10):
+        self.max_seconds = max_seconds
+        self.frames = frames
+        self._lock = threading.Lock()
+        self._baseline = None
+        self._started_at = None
+        self._timer = None
+
+    def init_app(self, app):
+        self.max_seconds = app.config['MEMORY_PROFILE_MAX_SECONDS']
+        self.frames = app.config['MEMORY_PROFILE_FRAMES']
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def start(self, frames=None):
+        """Start tracing and take the baseline snapshot."""
+        with self._lock:
+            if self._baseline is not None:
+                raise ProfilerBusyError(f"Memory tracing is already running in worker {os.getpid()}")
+            tracemalloc.start(frames or self.frames)
+            self._baseline = self._snapshot()
+            self._started_at = time.time()
+            self._timer = threading.Timer(self.max_seconds, self.stop)
+            self._timer.daemon = True
+            self._timer.start()
+        logger.info(f"Memory tracing started in worker {os.getpid()} for at most {self.max_seconds}s")
+        return self.status()
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+
+    def diff(self, limit=25, group_by='lineno', reset=False):
+        """Top allocation changes since the baseline; ``reset`` makes this snapshot the new baseline."""
+        with self._lock:
+            if self._baseline is None:
+                return None
+            snapshot = self._snapshot()
+            stats = snapshot.compare_to(self._baseline, group_by)
+            if reset:
+                self._baseline = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            **self.status(),
+            'traced_bytes': current,
+            'peak_traced_bytes': peak,
+            'top': [{
+                'location': str(stat.traceback[-1]) if stat.traceback else '?',
+                'traceback': stat.traceback.format() if group_by == 'traceback' else None,
+                'size_diff': stat.size_diff,
+                'size': stat.size,
+                'count_diff': stat.count_diff,
+                'count': stat.count,
+            } for stat in stats[:limit]]
+        }
+
+    def status(self):
+        return {
+            'pid': os.getpid(),
+            'tracing': self.tracing,
+            'started_at': self._started_at,
+            'stops_at': self._started_at + self.max_seconds if self._started_at else None,
+        }
+
+    def stop(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            if self._baseline is not None:
+                tracemalloc.stop()
+                logger.info(f"Memory tracing stopped in worker {os.getpid()}")
+            self._baseline = None
+            self._started_at = None
+            self._timer = None
+
+
+cpu_profiler = SamplingProfiler()
+memory_profiler = MemoryProfiler()
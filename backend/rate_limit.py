@@ -0,0 +1,318 @@
+# rate_limit.py
+"""
+Request rate limiting.
+
+Each policy is a token bucket (``limit`` requests per ``period`` seconds, with
+bursts up to ``burst``) implemented with GCRA: per key we only store the
+"theoretical arrival time" of the next request, so a check is one read and
+one write of a float and a rejection knows exactly when to retry.
+
+Two backends hold the buckets:
+
+``memory``
+    A dict in this process. Each gunicorn worker counts separately.
+``shared``
+    A fixed-size hash table in a memory-mapped file (``/dev/shm`` when
+    available), guarded by ``flock``, so every worker on the node shares
+    the same buckets. The file is only ever created and grown, never
+    shrunk or rewritten, because shrinking a file other workers have mapped
+    kills them with SIGBUS; one with the wrong size is left alone and this
+    process falls back to its own buckets.
+
+Policies are chosen per view function name (``RATE_LIMITS``); anything not listed gets
+the default ``RATE_LIMIT_REQUESTS`` per ``RATE_LIMIT_WINDOW``. Buckets are
+keyed by the client IP, or by user id when the policy asks for it and the
+request carries a valid access token. Behind a proxy the client IP comes from
+``X-Forwarded-For``, which needs ``RATE_LIMIT_TRUSTED_PROXIES``; without it
+every client shares the proxy's buckets.
+"""
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+
+from flask import Response, g, json, request
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+@dataclass(frozen=True)
+class RateLimitPolicy:
+    name: str
+    limit: int
+    period: float
+    burst: int = None
+    key: str = 'ip'  # 'ip' or 'user' (user id when authenticated, else IP)
+
+    @property
+    def interval(self):
+        """Seconds between requests at the sustained rate."""
+        return self.period / self.limit
+
+    @property
+    def window(self):
+        """How far ahead of now the bucket may be booked: one interval per burst slot."""
+        return self.interval * (self.burst or self.limit)
+
+    @classmethod
+    def parse(cls, name, spec, key='ip'):
+        """Build a policy from '10/minute', '5/3600' or '10/minute burst 3'."""
+        spec = spec.strip()
+        burst = None
+        if ' burst ' in spec:
+            spec, burst = spec.split(' burst ', 1)
+            burst = int(burst)
+        limit, period = spec.split('/', 1)
+        period = period.strip()
+        period = PERIODS[period.rstrip('s')] if period.rstrip('s') in PERIODS else float(period)
+        return cls(name, int(limit), period, burst, key)
+
+
+def _gcra(tat, now, interval, window):
+    """Returns (allowed, new_tat, retry_after) for one request."""
+    tat = max(tat, now)
+    new_tat = tat + interval
+    if new_tat - now > window:
+        return False, tat, new_tat - window - now
+    return True, new_tat, 0.0
+
+
+class MemoryBackend:
+    """Buckets in a dict, private to this process."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._tats = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key, interval, window, now):
+        with self._lock:
+            allowed, tat, retry_after = _gcra(self._tats.get(key, now), now, interval, window)
+            self._tats[key] = tat
+            if len(self._tats) > self.max_keys:
+                # Buckets whose arrival time has passed are full again; forget them
+                self._tats = {k: v for k, v in self._tats.items() if v > now}
+            return allowed, tat, retry_after
+
+    def reset(self):
+        with self._lock:
+            self._tats.clear()
+
+
+class SharedMemoryBackend:
+    """Buckets in an mmap'd open-addressing table shared by processes on this host.
+
+    Each slot is a 64-bit key hash and a float arrival time. Slots whose time
+    has passed are free for reuse; when every probed slot is live the one
+    expiring soonest is taken over, so the table degrades by forgetting the
+    least-restricted clients rather than by failing.
+    """
+    MAGIC = b'RLIMIT01'
+    SLOT = struct.Struct('<Qd')
+    HEADER = struct.Struct('<8sQ')
+    PROBES = 8
+
+    def __init__(self, path=None, slots=65536):
+        if fcntl is None:
+            raise RuntimeError('The shared rate limit backend needs fcntl (POSIX)')
+        if path is None:
+            # Named by size, so workers configured with other slot counts use another file
+            base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            path = os.path.join(base, f"ratelimit-{os.getuid()}-{slots}.bin")
+        self.path = path
+        self.slots = slots
+        self._size = self.HEADER.size + slots * self.SLOT.size
+        self._map = None
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._open()  # a file we can't use raises here, while init_app can still fall back
+
+    def _open(self):
+        # flock excludes other open files, not other threads or forked copies
+        # of this one, so each process opens its own descriptor
+        if self._pid == os.getpid():
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                mapped = self._map_file(fd)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd, self._map, self._pid = fd, mapped, os.getpid()
+
+    def _map_file(self, fd):
+        size = os.fstat(fd).st_size
+        if size == 0:
+            os.ftruncate(fd, self._size)  # a new file, zero-filled; grown only, never shrunk
+        elif size != self._size:
+            raise RuntimeError(f"{self.path} is {size} bytes, not the {self._size} of {self.slots} "
+                               f"rate limit slots; set RATE_LIMIT_SHARED_PATH or RATE_LIMIT_SHARED_SLOTS to match")
+        mapped = mmap.mmap(fd, self._size)
+        magic, slots = self.HEADER.unpack_from(mapped, 0)
+        if magic == bytes(len(self.MAGIC)):
+            self.HEADER.pack_into(mapped, 0, self.MAGIC, self.slots)
+        elif (magic, slots) != (self.MAGIC, self.slots):
+            mapped.close()
+            raise RuntimeError(f"{self.path} is not a rate limit table for {self.slots} slots")
+        return mapped
+
+    def _key_hash(self, key):
+        # 0 marks an empty slot
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+
+    def hit(self, key, interval, window, now):
+        key_hash = self._key_hash(key)
+        start = key_hash % self.slots
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                target, tat = None, now
+                soonest, soonest_tat = None, None
+                for probe in range(self.PROBES):
+                    offset = self.HEADER.size + ((start + probe) % self.slots) * self.SLOT.size
+                    slot_hash, slot_tat = self.SLOT.unpack_from(self._map, offset)
+                    if slot_hash == key_hash:
+                        target, tat = offset, slot_tat
+                        break
+                    if target is None and (slot_hash == 0 or slot_tat <= now):
+                        target = offset
+                    if soonest_tat is None or slot_tat < soonest_tat:
+                        soonest, soonest_tat = offset, slot_tat
+                if target is None:
+                    target = soonest
+                allowed, tat, retry_after = _gcra(tat, now, interval, window)
+                self.SLOT.pack_into(self._map, target, key_hash, tat)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return allowed, tat, retry_after
+
+    def reset(self):
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                self._map[self.HEADER.size:] = bytes(self._size - self.HEADER.size)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class RateLimiter:
+    def __init__(self):
+        self.enabled = False
+        self.backend = MemoryBackend()
+        self.default_policy = None
+        self.policies = {}
+        self.exempt = set()
+        self.trusted_proxies = 0
+        self.counts = Counter()
+        self._warned_unused_forwarded = False
+
+    def init_app(self, app):
+        self.enabled = app.config['RATE_LIMIT_ENABLED']
+        self.trusted_proxies = app.config['RATE_LIMIT_TRUSTED_PROXIES']
+        self.default_policy = RateLimitPolicy(
+            'default', app.config['RATE_LIMIT_REQUESTS'], app.config['RATE_LIMIT_WINDOW']
+        )
+        self.policies = {}
+        for endpoint, spec in app.config['RATE_LIMITS'].items():
+            key = 'ip'
+            if spec.startswith('user:'):
+                key, spec = 'user', spec[len('user:'):]
+            self.policies[endpoint] = RateLimitPolicy.parse(endpoint, spec, key)
+        self.exempt = set(app.config['RATE_LIMIT_EXEMPT'])
+
+        backend = app.config['RATE_LIMIT_BACKEND']
+        if backend == 'shared':
+            try:
+                self.backend = SharedMemoryBackend(
+                    app.config['RATE_LIMIT_SHARED_PATH'], app.config['RATE_LIMIT_SHARED_SLOTS']
+                )
+            except RuntimeError as e:
+                logger.warning(f"{e}; falling back to per-process rate limits")
+                self.backend = MemoryBackend()
+        else:
+            self.backend = MemoryBackend()
+        # Registered after the session token hook so user-keyed policies can see g.current_user
+        app.before_request(self._check_request)
+
+    def client_ip(self):
+        if self.trusted_proxies:
+            forwarded = [ip.strip() for ip in request.headers.get('X-Forwarded-For', '').split(',') if ip.strip()]
+            if len(forwarded) >= self.trusted_proxies:
+                return forwarded[-self.trusted_proxies]
+        elif not self._warned_unused_forwarded and 'X-Forwarded-For' in request.headers:
+            self._warned_unused_forwarded = True
+            logger.warning("Requests arrive through a proxy (X-Forwarded-For) but RATE_LIMIT_TRUSTED_PROXIES is 0: "
+                           "every client behind it shares the proxy's rate limits")
+        return request.remote_addr or 'unknown'
+
+    def policy_for(self, endpoint):
+        if endpoint is None or endpoint == 'static':
+            return None
+        # Policies are keyed by view name, without the blueprint prefix ('api.login' -> 'login')
+        endpoint = endpoint.rpartition('.')[2]
+        if endpoint in self.exempt:
+            return None
+        return self.policies.get(endpoint, self.default_policy)
+
+    def hit(self, policy, identity, now=None):
+        """Count one request against ``policy`` for ``identity``; returns (allowed, tat, retry_after)."""
+        now = time.time() if now is None else now
+        return self.backend.hit(f"{policy.name}:{identity}", policy.interval, policy.window, now)
+
+    def _check_request(self):
+        if not self.enabled or request.method == 'OPTIONS':
+            return None
+        policy = self.policy_for(request.endpoint)
+        if policy is None:
+            return None
+        user = g.get('current_user')
+        identity = f"user:{user.id}" if policy.key == 'user' and user else f"ip:{self.client_ip()}"
+        now = time.time()
+        allowed, tat, retry_after = self.hit(policy, identity, now)
+        self.counts[(policy.name, allowed)] += 1
+        if allowed:
+            return None
+
+        retry = max(1, int(retry_after + 0.999))
+        response = Response(
+            json.dumps({'success': False, 'error': 'Too many requests, please try again later'}),
+            status=429, mimetype='application/json'
+        )
+        response.headers['Retry-After'] = str(retry)
+        response.headers['RateLimit-Limit'] = str(policy.burst or policy.limit)
+        response.headers['RateLimit-Remaining'] = '0'
+        response.headers['RateLimit-Reset'] = str(retry)
+        return response
+
+    def snapshot(self):
+        return {
+            'enabled': self.enabled,
+            'backend': type(self.backend).__name__,
+            'policies': {
+                name: {'allowed': self.counts[(name, True)], 'rejected': self.counts[(name, False)]}
+                for name in sorted({name for name, _ in self.counts})
+            }
+        }
+
+
+rate_limiter = RateLimiter()
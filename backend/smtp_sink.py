@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for an SMTP server
+
+Accepts mail over plain SMTP (no TLS, any or no login) and keeps it in memory
+instead of delivering it, so the outbox can be exercised offline. Recipients
+can be refused and connections dropped on purpose to test retries.
+
+Usage:
+    python smtp_sink.py --port 1025
+
+Then point the app at it:
+    SMTP_HOST=127.0.0.1 SMTP_PORT=1025 SMTP_SECURITY=none
+"""
+import argparse
+import email
+import email.policy
+import logging
+import socketserver
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPSink:
+    def __init__(self):
+        self.messages = []  # email.message.EmailMessage, in arrival order
+        self.connections = 0
+        self.refused_recipients = set()  # answered with 550
+        self.drop_after = None  # close the connection after this many messages on it
+        self.on_message = None  # called with each message as it arrives
+        self._lock = threading.Lock()
+
+    def _handler(self):
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(f"{line}\r\n".encode())
+
+            def handle(self):
+                with sink._lock:
+                    sink.connections += 1
+                self.reply('220 smtp-sink ready')
+                sender, recipients, received = None, [], 0
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command, _, argument = line.decode('utf-8', 'replace').strip().partition(' ')
+                    command = command.upper()
+                    if command in ('EHLO', 'HELO'):
+                        self.reply('250-smtp-sink' if command == 'EHLO' else '250 smtp-sink')
+                        if command == 'EHLO':
+                            self.reply('250-8BITMIME')
+                            self.reply('250 AUTH PLAIN')
+                    elif command == 'AUTH':
+                        self.reply('235 Authentication successful')
+                    elif command == 'MAIL':
+                        sender, recipients = argument.partition(':')[2].strip('<> '), []
+                        self.reply('250 OK')
+                    elif command == 'RCPT':
+                        recipient = argument.partition(':')[2].split()[0].strip('<>')
+                        if recipient in sink.refused_recipients:
+                            self.reply('550 No such user')
+                        else:
+                            recipients.append(recipient)
+                            self.reply('250 OK')
+                    elif command == 'DATA':
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        data = []
+                        while True:
+                            line = self.rfile.readline()
+                            if not line or line in (b'.\r\n', b'.\n'):
+                                break
+                            data.append(line[1:] if line.startswith(b'..') else line)
+                        message = email.message_from_bytes(b''.join(data), policy=email.policy.default)
+                        with sink._lock:
+                            sink.messages.append(message)
+                        if sink.on_message:
+                            sink.on_message(message)
+                        logger.info(f"Mail from {sender} to {', '.join(recipients)}: {message['Subject']}")
+                        self.reply('250 OK: queued')
+                        received += 1
+                        if sink.drop_after is not None and received >= sink.drop_after:
+                            return
+                    elif command in ('RSET', 'NOOP'):
+                        sender, recipients = None, []
+                        self.reply('250 OK')
+                    elif command == 'QUIT':
+                        self.reply('221 Bye')
+                        return
+                    else:
+                        self.reply('502 Command not implemented')
+
+        return Handler
+
+    def start(self, host='127.0.0.1', port=0):
+        """Serve from a background thread. Returns the port."""
+        self._server = socketserver.ThreadingTCPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        thread = threading.Thread(target=self._server.serve_forever, name='smtp-sink', daemon=True)
+        thread.start()
+        return self._server.server_address[1]
+
+    def stop(self):
+        if getattr(self, '_server', None):
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local SMTP server that prints mail instead of sending it')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1025)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    sink = SMTPSink()
+    sink.on_message = lambda message: print(
+        f"From: {message['From']}\nTo: {message['To']}\nSubject: {message['Subject']}\n\n"
+        f"{message.get_content()}\n{'-' * 72}", flush=True
+    )
+    sink.start(args.host, args.port)
+    print(f"SMTP sink listening on {args.host}:{args.port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        sink.stop()
+
+
+if __name__ == '__main__':
+    main()
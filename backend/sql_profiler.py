@@ -0,0 +1,200 @@
+# sql_profiler.py
+"""
+Per-request SQL profiler.
+
+Off by default (``SQL_PROFILER_ENABLED``). When on, every statement run while
+handling a request is recorded in normalized form (literals and ``IN`` lists
+collapsed to ``?``) with its duration. At the end of the request:
+
+* statements of the same shape run ``SQL_N_PLUS_ONE_THRESHOLD`` times or more
+  are logged as a suspected N+1 pattern;
+* statements slower than ``SQL_SLOW_QUERY_MS`` are logged with their
+  ``EXPLAIN`` output (run through the request's session once the response
+  is built, so only requests with slow queries pay for it);
+* with ``SQL_SERVER_TIMING`` the response gets a ``Server-Timing`` header
+  with the query count and SQL time, which browser dev tools display.
+
+``count_queries`` and ``assert_max_queries`` work whether or not the profiler
+is enabled, for keeping endpoints within a query budget in tests::
+
+    with assert_max_queries(4):
+        client.get('/api/resources?type=book')
+"""
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+_COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\bIN\s*\((?:\s*\?\s*,)+\s*\?\s*\)', re.IGNORECASE)
+_PLACEHOLDER = re.compile(r'%\(\w+\)s|%s|:\w+')
+_SPACE = re.compile(r'\s+')
+
+
+def normalize_statement(statement):
+    """Collapse literals, placeholders and IN lists so statements of the same shape compare equal."""
+    statement = _COMMENT.sub('', statement)
+    statement = _STRING.sub('?', statement)
+    statement = _PLACEHOLDER.sub('?', statement)
+    statement = _NUMBER.sub('?', statement)
+    statement = _IN_LIST.sub('IN (?)', statement)
+    return _SPACE.sub(' ', statement).strip()
+
+
+class QueryLog:
+    """Statements executed in one request (or inside ``count_queries``)."""
+
+    def __init__(self):
+        self.queries = []  # (statement, parameters, seconds)
+
+    def add(self, statement, parameters, seconds):
+        self.queries.append((statement, parameters, seconds))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total_seconds(self):
+        return sum(seconds for _, _, seconds in self.queries)
+
+    def repeated(self, threshold):
+        """Normalized statements run at least ``threshold`` times, most frequent first."""
+        counts = Counter(normalize_statement(statement) for statement, _, _ in self.queries)
+        return [(statement, count) for statement, count in counts.most_common() if count >= threshold]
+
+    def slower_than(self, seconds):
+        return [query for query in self.queries if query[2] >= seconds]
+
+    def __str__(self):
+        return '\n'.join(f"{seconds * 1000:8.2f}ms  {normalize_statement(statement)}"
+                         for statement, _, seconds in self.queries)
+
+
+# QueryLogs from count_queries() blocks that are currently open
+_collectors = []
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('profiler_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['profiler_started'].pop()
+    if context is not None and context.execution_options.get('sql_profiler_explain'):
+        return
+    for collector in _collectors:
+        collector.add(statement, parameters, elapsed)
+    if sql_profiler.enabled and has_request_context():
+        profile = g.get('sql_profile')
+        if profile is not None:
+            profile.add(statement, None if executemany else parameters, elapsed)
+
+
+def _handle_error(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('profiler_started'):
+        connection.info['profiler_started'].pop()
+
+
+def _listen():
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+
+class SQLProfiler:
+    def __init__(self):
+        self.enabled = False
+        self.slow_seconds = 0.2
+        self.n_plus_one_threshold = 5
+        self.explain = True
+        self.server_timing = False
+        self.db = None
+
+    def init_app(self, app, db):
+        self.enabled = app.config['SQL_PROFILER_ENABLED']
+        self.slow_seconds = app.config['SQL_SLOW_QUERY_MS'] / 1000.0
+        self.n_plus_one_threshold = app.config['SQL_N_PLUS_ONE_THRESHOLD']
+        self.explain = app.config['SQL_PROFILER_EXPLAIN']
+        self.server_timing = app.config['SQL_SERVER_TIMING']
+        self.db = db
+        if self.enabled:
+            _listen()
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+    def _start_request(self):
+        if self.enabled:
+            g.sql_profile = QueryLog()
+
+    def _finish_request(self, response):
+        profile = g.pop('sql_profile', None)
+        if profile is None:
+            return response
+        endpoint = request.endpoint or request.path
+        for statement, count in profile.repeated(self.n_plus_one_threshold):
+            logger.warning(
+                f"Possible N+1 in {endpoint}: {count} queries of the same shape",
+                extra={'endpoint': endpoint, 'repeats': count, 'statement': statement}
+            )
+        for statement, parameters, seconds in profile.slower_than(self.slow_seconds):
+            logger.warning(
+                f"Slow query in {endpoint}: {seconds * 1000:.1f}ms",
+                extra={'endpoint': endpoint, 'duration_ms': round(seconds * 1000, 2),
+                       'statement': normalize_statement(statement),
+                       'plan': self.explain_plan(statement, parameters) if self.explain else None}
+            )
+        if self.server_timing:
+            response.headers.add(
+                'Server-Timing', f'db;dur={profile.total_seconds * 1000:.2f};desc="{profile.count} queries"'
+            )
+        return response
+
+    def explain_plan(self, statement, parameters):
+        """EXPLAIN output for a SELECT as a list of row tuples (strings), or None."""
+        if parameters is None or not statement.lstrip().upper().startswith('SELECT'):
+            return None
+        prefix = 'EXPLAIN QUERY PLAN ' if self.db.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+        try:
+            rows = self.db.session.connection().exec_driver_sql(
+                prefix + statement, parameters, execution_options={'sql_profiler_explain': True}
+            ).fetchall()
+        except Exception as e:
+            logger.debug(f"Could not EXPLAIN slow query: {str(e)}")
+            return None
+        return [tuple(str(value) for value in row) for row in rows]
+
+
+@contextmanager
+def count_queries():
+    """Collect every statement executed (in any thread) while the block runs."""
+    _listen()
+    log = QueryLog()
+    _collectors.append(log)
+    try:
+        yield log
+    finally:
+        _collectors.remove(log)
+
+
+@contextmanager
+def assert_max_queries(limit):
+    """Fail with the list of statements when the block runs more than ``limit`` queries."""
+    with count_queries() as log:
+        yield log
+    if log.count > limit:
+        raise AssertionError(f"Expected at most {limit} queries, ran {log.count}:\n{log}")
+
+
+sql_profiler = SQLProfiler()
@@ -4,23 +4,26 @@ Startup script for Render deployment
 This script initializes the database and creates necessary tables
 """
 
-from app import app, db
-from models import Resource, User, Payment
+import os
+import sys
+
+from app import create_app, create_schema, ensure_admin_user
 
 def init_database():
     """Initialize the database with all tables"""
+    password = os.environ.get('ADMIN_PASSWORD')
+    if not password:
+        sys.exit("Set ADMIN_PASSWORD to the password for the admin account")
+    app = create_app()
     with app.app_context():
         print("Creating database tables...")
-        db.create_all()
-        print("Database tables created successfully!")
+        if create_schema():
+            print("Database tables created and stamped with the latest migration!")
+        else:
+            print("Missing tables created; run `flask db upgrade` to migrate existing ones")
         
         # Create admin user if it doesn't exist
-        admin = User.query.filter_by(username='admin').first()
-        if not admin:
-            admin = User(username='admin', email='admin@somafy.co.ke')
-            admin.set_password('admin123')
-            db.session.add(admin)
-            db.session.commit()
+        if ensure_admin_user('admin', 'admin@somafy.co.ke', password):
             print("Admin user created!")
         else:
             print("Admin user already exists!")
@@ -0,0 +1,403 @@
+# tracing.py
+"""
+Request tracing with W3C trace context.
+
+Every request runs in a server span. If the request carries a valid
+``traceparent`` header, the span joins that trace; otherwise it starts a new
+one. The span is held in a ``ContextVar`` while it is active:
+
+* every log record made under it gets ``trace_id`` and ``span_id`` fields;
+* every SQL statement gets a ``/*traceparent='...'*/`` comment
+  (sqlcommenter style) so the database's own slow query log points back at
+  the request (``TRACE_SQL_COMMENTS``, on by default only when spans are
+  exported: the comment makes each statement text unique, which defeats
+  statement digests and caches keyed on the text);
+* ``tracer.span()`` times a step as a child span, and outbound PesaPal calls
+  run in client spans that send ``traceparent`` on;
+* ``inject()`` and ``continue_trace()`` carry the context through anything
+  that can hold a dict, such as a background job's payload.
+
+Responses carry the trace id in ``X-Trace-Id``.
+
+Finished spans of sampled traces (``TRACE_SAMPLE_RATE``) go on a bounded
+queue and a background thread exports them in batches, dropping spans
+rather than blocking when the queue is full. ``TRACE_EXPORT=file`` appends
+JSON lines to ``TRACE_FILE``; ``otlp`` posts OTLP/HTTP JSON to
+``TRACE_COLLECTOR_URL``, e.g. a local OpenTelemetry collector's
+``/v1/traces``. With the default ``none`` ids still reach logs, but no spans
+are exported.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+SERVER = 'server'
+CLIENT = 'client'
+INTERNAL = 'internal'
+CONSUMER = 'consumer'
+OTLP_KINDS = {INTERNAL: 1, SERVER: 2, CLIENT: 3, CONSUMER: 5}
+
+TRACEPARENT = re.compile(r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def _new_id(bits):
+    # Non-cryptographic but fast; all zeros is invalid in trace context
+    return f"{random.getrandbits(bits) or 1:0{bits // 4}x}"
+
+
+def parse_traceparent(header):
+    """(trace_id, parent_span_id, sampled) from a ``traceparent`` header, or None if it is not valid."""
+    match = TRACEPARENT.match((header or '').strip().lower())
+    if not match:
+        return None
+    version, trace_id, span_id, flags = match.groups()
+    if version == 'ff' or trace_id == '0' * 32 or span_id == '0' * 16:
+        return None
+    return trace_id, span_id, bool(int(flags, 16) & 1)
+
+
+class Span:
+    __slots__ = ('name', 'kind', 'trace_id', 'span_id', 'parent_id', 'sampled',
+                 'start_ns', 'end_ns', 'attributes', 'error')
+
+    def __init__(self, name, kind, trace_id, parent_id, sampled, attributes=None):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    @property
+    def duration_ms(self):
+        end = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end - self.start_ns) / 1e6
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_error(self, error):
+        self.error = f"{type(error).__name__}: {error}"
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'start_ns': self.start_ns,
+            'end_ns': self.end_ns,
+            'duration_ms': round(self.duration_ms, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def otlp_payload(spans, service_name):
+    """OTLP/HTTP JSON body for a batch of finished spans."""
+    return {'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': service_name}}]},
+        'scopeSpans': [{
+            'scope': {'name': __name__},
+            'spans': [{
+                'traceId': span.trace_id,
+                'spanId': span.span_id,
+                **({'parentSpanId': span.parent_id} if span.parent_id else {}),
+                'name': span.name,
+                'kind': OTLP_KINDS[span.kind],
+                'startTimeUnixNano': str(span.start_ns),
+                'endTimeUnixNano': str(span.end_ns),
+                'attributes': [{'key': k, 'value': _otlp_value(v)} for k, v in span.attributes.items()],
+                'status': {'code': 2, 'message': span.error} if span.error else {'code': 0},
+            } for span in spans]
+        }]
+    }]}
+
+
+class FileSink:
+    """Appends spans as JSON lines. ``{pid}`` in the path gives each worker its own file."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, spans):
+        with open(self.path.replace('{pid}', str(os.getpid())), 'a') as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), default=str, separators=(',', ':')) + '\n')
+
+
+class OtlpHttpSink:
+    """Posts spans to an OTLP/HTTP collector as JSON."""
+
+    def __init__(self, url, service_name, timeout=5.0):
+        self.url = url
+        self.service_name = service_name
+        self.timeout = timeout
+
+    def __call__(self, spans):
+        import requests  # only needed when exporting over OTLP
+
+        resp = requests.post(self.url, json=otlp_payload(spans, self.service_name), timeout=self.timeout)
+        resp.raise_for_status()
+
+
+class SpanExporter:
+    """Hands finished spans to a sink in batches from a background thread."""
+
+    def __init__(self, sink, queue_size=10000, batch_size=256, flush_seconds=2.0):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.queue_size = queue_size
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def _ensure_running(self):
+        # Threads don't survive fork: each worker starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.queue_size)
+            self._thread = threading.Thread(target=self._run, name='span-exporter', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def export(self, span):
+        self._ensure_running()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        spans_queue = self._queue
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                try:
+                    span = spans_queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if span is None:
+                    stopping = True
+                    break
+                batch.append(span)
+            if not batch:
+                continue
+            try:
+                self.sink(batch)
+                self.exported += len(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                logger.warning(f"Could not export {len(batch)} spans: {str(e)}")
+
+    def stop(self, timeout=5.0):
+        """Export what is queued and stop the thread."""
+        if self._pid != os.getpid():
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._pid = None
+
+    def stats(self):
+        return {'exported': self.exported, 'dropped': self.dropped, 'failed': self.failed}
+
+
+def _log_record_factory(factory):
+    def make_record(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        span = _current_span.get()
+        if span is not None:
+            record.trace_id = span.trace_id
+            record.span_id = span.span_id
+        return record
+    make_record.traces = True
+    return make_record
+
+
+def _comment_statement(conn, cursor, statement, parameters, context, executemany):
+    span = _current_span.get()
+    if span is not None and tracer.sql_comments:
+        statement = f"{statement} /*traceparent='{span.traceparent}'*/"
+    return statement, parameters
+
+
+class Tracer:
+    def __init__(self):
+        self.sample_rate = 1.0
+        self.sql_comments = False
+        self.exporter = None
+
+    def init_app(self, app):
+        self.sample_rate = app.config['TRACE_SAMPLE_RATE']
+        export = app.config['TRACE_EXPORT']
+        comments = app.config['TRACE_SQL_COMMENTS']
+        self.sql_comments = export != 'none' if comments is None else comments
+        if self.exporter is not None:
+            self.exporter.stop()
+            self.exporter = None
+        if export == 'file':
+            self.exporter = SpanExporter(FileSink(app.config['TRACE_FILE']), app.config['TRACE_QUEUE_SIZE'])
+        elif export == 'otlp':
+            self.exporter = SpanExporter(
+                OtlpHttpSink(app.config['TRACE_COLLECTOR_URL'], app.config['TRACE_SERVICE_NAME']),
+                app.config['TRACE_QUEUE_SIZE']
+            )
+        elif export != 'none':
+            raise ValueError(f"Unknown TRACE_EXPORT: {export}")
+
+        if not getattr(logging.getLogRecordFactory(), 'traces', False):
+            logging.setLogRecordFactory(_log_record_factory(logging.getLogRecordFactory()))
+        if not event.contains(Engine, 'before_cursor_execute', _comment_statement):
+            event.listen(Engine, 'before_cursor_execute', _comment_statement, retval=True)
+        # Registered first so the auth and rate limit hooks already log with the trace id
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._end_request)
+
+    def current_span(self):
+        return _current_span.get()
+
+    def start_span(self, name, kind=INTERNAL, parent=None, attributes=None):
+        """A span under ``parent`` (default: the current span) or a new trace. Not made current."""
+        parent = parent if parent is not None else _current_span.get()
+        if parent is not None:
+            return Span(name, kind, parent.trace_id, parent.span_id, parent.sampled, attributes)
+        return Span(name, kind, _new_id(128), None, random.random() < self.sample_rate, attributes)
+
+    def _start_remote(self, name, kind, traceparent, attributes=None):
+        parsed = parse_traceparent(traceparent)
+        if parsed is None:
+            return self.start_span(name, kind, attributes=attributes)
+        trace_id, parent_id, sampled = parsed
+        return Span(name, kind, trace_id, parent_id, sampled, attributes)
+
+    def end_span(self, span):
+        span.end_ns = time.time_ns()
+        if span.sampled and self.exporter is not None:
+            self.exporter.export(span)
+
+    @contextmanager
+    def activate(self, span):
+        """Make ``span`` current for the block, then end it."""
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.record_error(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            self.end_span(span)
+
+    def span(self, name, kind=INTERNAL, **attributes):
+        """Time the block as a child of the current span."""
+        return self.activate(self.start_span(name, kind, attributes=attributes))
+
+    def continue_trace(self, carrier, name, kind=CONSUMER, **attributes):
+        """Run the block in a span continuing the trace that ``inject()`` put in ``carrier``."""
+        return self.activate(self._start_remote(name, kind, (carrier or {}).get('traceparent'), attributes))
+
+    def inject(self, carrier=None):
+        """Copy of ``carrier`` (headers or a job payload) with the current ``traceparent`` added."""
+        carrier = dict(carrier or {})
+        span = _current_span.get()
+        if span is not None:
+            carrier['traceparent'] = span.traceparent
+        return carrier
+
+    def set_attribute(self, key, value):
+        """Tag the current span, if any."""
+        span = _current_span.get()
+        if span is not None:
+            span.set_attribute(key, value)
+
+    def _start_request(self):
+        rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        span = self._start_remote(
+            f"{request.method} {rule}", SERVER, request.headers.get('traceparent'),
+            {'http.method': request.method, 'http.route': rule}
+        )
+        g.trace_span = span
+        g.trace_token = _current_span.set(span)
+
+    def _finish_request(self, response):
+        span = g.get('trace_span')
+        if span is not None:
+            span.set_attribute('http.status_code', response.status_code)
+            if response.status_code >= 500 and span.error is None:
+                span.error = f"HTTP {response.status_code}"
+            response.headers['X-Trace-Id'] = span.trace_id
+        return response
+
+    def _end_request(self, exc):
+        span = g.pop('trace_span', None)
+        if span is None:
+            return
+        if exc is not None:
+            span.record_error(exc)
+        try:
+            _current_span.reset(g.pop('trace_token'))
+        except ValueError:
+            # Torn down in a different context than it started in
+            _current_span.set(None)
+        self.end_span(span)
+
+    def stop(self):
+        if self.exporter is not None:
+            self.exporter.stop()
+
+
+tracer = Tracer()
+atexit.register(tracer.stop)
@@ -1,42 +1,26 @@
 #!/usr/bin/env python3
 """
 Database schema update script
-This script will update your database tables to match the current models
+Applies pending Alembic migrations (migrations/versions), like
+`flask --app app db upgrade`. Nothing is dropped, and revisions that touch
+large tables go through online_migration.py, so this is safe to run against
+the live database. An interrupted run can simply be started again.
 """
 
-from app import app, db
-from models import Resource, User, Payment
+from app import create_app, init_migrate
 import logging
 
 logger = logging.getLogger(__name__)
 
-def update_database_schema():
-    """Update database schema to match current models"""
+def update_database_schema(revision='head'):
+    """Upgrade the database schema to ``revision``"""
+    app = create_app()
+    init_migrate(app)
     with app.app_context():
-        try:
-            logger.info("Starting database schema update...")
-            
-            # Drop all tables and recreate them
-            logger.info("Dropping all tables...")
-            db.drop_all()
-            
-            logger.info("Creating all tables...")
-            db.create_all()
-            
-            # Create admin user
-            logger.info("Creating admin user...")
-            admin = User(username='admin', email='admin@somafy.co.ke')
-            admin.set_password('admin123')
-            db.session.add(admin)
-            db.session.commit()
-            
-            logger.info("Database schema update completed successfully!")
-            logger.info("Admin user created: username=admin, password=admin123")
-            
-        except Exception as e:
-            logger.error(f"Error updating database schema: {str(e)}")
-            db.session.rollback()
-            raise
+        from flask_migrate import upgrade
+        logger.info(f"Upgrading database schema to {revision}...")
+        upgrade(revision=revision)
+        logger.info("Database schema update completed successfully!")
 
 if __name__ == '__main__':
-    update_database_schema() 
\ No newline at end of file
+    update_database_schema()
@@ -1,7 +1,10 @@
-from app import app, db
-from models import Resource, User, Payment
+from app import create_app
+from health import warmup
+
+# Built once per process; with gunicorn's preload_app, once in the master before forking
+app = create_app()
+# Before the first request, so /readyz only passes once the caches are warm
+warmup.run(app)
 
 if __name__ == "__main__":
-    with app.app_context():
-        db.create_all()
-    app.run() 
\ No newline at end of file
+    app.run()
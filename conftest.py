@@ -0,0 +1,50 @@
+"""Fixtures for the in-process tests: the app on an in-memory SQLite database."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'backend'))
+
+
+@pytest.fixture
+def app():
+    from app import create_app
+    from config import TestConfig
+    from models import db
+
+    app = create_app(TestConfig)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def resource(app):
+    from models import Resource, db
+
+    resource = Resource(resource_type='book', class_grade='Form 1', subject='Mathematics',
+                        title='Form 1 Mathematics', description='Revision book')
+    db.session.add(resource)
+    db.session.commit()
+    return resource
+
+
+@pytest.fixture
+def smtp_sink(app):
+    """A local SMTP server the outbox sends mail to (see backend/smtp_sink.py)."""
+    from outbox import outbox
+    from smtp_sink import SMTPSink
+
+    sink = SMTPSink()
+    app.config.update(SMTP_HOST='127.0.0.1', SMTP_PORT=sink.start(), SMTP_SECURITY='none')
+    outbox.transport_names['mail'] = 'smtp'
+    yield sink
+    sink.stop()
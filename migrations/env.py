@@ -93,6 +93,9 @@ def run_migrations_online():
     conf_args = current_app.extensions['migrate'].configure_args
     if conf_args.get("process_revision_directives") is None:
         conf_args["process_revision_directives"] = process_revision_directives
+    # Commit after each revision, so an interrupted upgrade keeps the revisions
+    # that finished (and online_migration.backfill's commits line up with them)
+    conf_args.setdefault("transaction_per_migration", True)
 
     connectable = get_engine()
 
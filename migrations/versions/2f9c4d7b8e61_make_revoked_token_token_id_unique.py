@@ -0,0 +1,34 @@
+"""Make revoked_token.token_id unique
+
+Revision ID: 2f9c4d7b8e61
+Revises: 7a26a656b5e8
+Create Date: 2026-10-20 09:41:05.118240
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2f9c4d7b8e61'
+down_revision = '7a26a656b5e8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # A token revoked twice (logout in two workers) has two rows; keep the first.
+    # The derived table lets MySQL read the table it deletes from.
+    op.execute(
+        'DELETE FROM revoked_token WHERE token_id IS NOT NULL AND id NOT IN '
+        '(SELECT id FROM (SELECT MIN(id) AS id FROM revoked_token WHERE token_id IS NOT NULL GROUP BY token_id) AS keep)'
+    )
+    with op.batch_alter_table('revoked_token', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_revoked_token_token_id'))
+        batch_op.create_index(batch_op.f('ix_revoked_token_token_id'), ['token_id'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('revoked_token', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_revoked_token_token_id'))
+        batch_op.create_index(batch_op.f('ix_revoked_token_token_id'), ['token_id'], unique=False)
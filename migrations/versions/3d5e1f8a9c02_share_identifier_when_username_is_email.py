@@ -0,0 +1,41 @@
+"""Share the identifier row when a username is the user's own email
+
+Revision ID: 3d5e1f8a9c02
+Revises: 2f9c4d7b8e61
+Create Date: 2026-10-20 10:26:47.902315
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3d5e1f8a9c02'
+down_revision = '2f9c4d7b8e61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The 8f3b6d0c2e47 backfill gave such users only their username's row, so a
+    # password reset, which looks the address up as an email, didn't find them.
+    # Only those few rows change; the rest of the table is untouched
+    bind = op.get_bind()
+    user_identifier = sa.table('user_identifier',
+        sa.column('id', sa.Integer), sa.column('user_id', sa.Integer),
+        sa.column('kind', sa.String), sa.column('value', sa.String))
+    user = sa.table('user', sa.column('id', sa.Integer), sa.column('email', sa.String))
+    rows = bind.execute(
+        sa.select(user_identifier.c.id, user_identifier.c.value, user.c.email)
+        .join(user, user.c.id == user_identifier.c.user_id)
+        .where(user_identifier.c.kind == 'username')
+    )
+    shared = [row.id for row in rows if (row.email or '').strip().lower() == row.value]
+    if shared:
+        bind.execute(user_identifier.update().where(user_identifier.c.id.in_(shared)).values(kind='email'))
+        print(f"user_identifier: {len(shared)} usernames that are the user's own email now serve as the email")
+
+
+def downgrade():
+    # Harmless to keep: the rows still belong to the same users
+    pass
@@ -0,0 +1,52 @@
+"""Shard stat_counter rows and drop the version and payment total rows
+
+Revision ID: 5a0f3b9d7e21
+Revises: 3d5e1f8a9c02
+Create Date: 2026-10-21 09:12:40.551803
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a0f3b9d7e21'
+down_revision = '3d5e1f8a9c02'
+branch_labels = None
+depends_on = None
+
+counter = sa.table('stat_counter', sa.column('scope'), sa.column('key'), sa.column('shard'),
+                   sa.column('count'), sa.column('amount'))
+
+
+def upgrade():
+    # Written by every change, they made one row lock that all writers queued on
+    op.execute(counter.delete().where(sa.or_(
+        counter.c.scope == 'version', sa.and_(counter.c.scope == 'payments', counter.c.key == 'total')
+    )))
+    # stat_counter holds a few hundred rows at most, so rebuilding it is quick everywhere
+    with op.batch_alter_table('stat_counter') as batch_op:
+        batch_op.add_column(sa.Column('shard', sa.SmallInteger(), nullable=False, server_default='0'))
+        batch_op.drop_constraint('uq_stat_counter_scope_key', type_='unique')
+        batch_op.create_unique_constraint('uq_stat_counter_scope_key_shard', ['scope', 'key', 'shard'])
+
+
+def downgrade():
+    bind = op.get_bind()
+    totals = bind.execute(
+        sa.select(counter.c.scope, counter.c.key, sa.func.sum(counter.c.count), sa.func.sum(counter.c.amount))
+        .group_by(counter.c.scope, counter.c.key)
+    ).all()
+    op.execute(counter.delete())
+    with op.batch_alter_table('stat_counter') as batch_op:
+        batch_op.drop_constraint('uq_stat_counter_scope_key_shard', type_='unique')
+        batch_op.drop_column('shard')
+        batch_op.create_unique_constraint('uq_stat_counter_scope_key', ['scope', 'key'])
+
+    rows = [{'scope': scope, 'key': key, 'count': count, 'amount': float(amount)} for scope, key, count, amount in totals]
+    payments = [row for row in rows if row['scope'] == 'payments']
+    rows.append({'scope': 'payments', 'key': 'total', 'count': sum(row['count'] for row in payments),
+                 'amount': sum(row['amount'] for row in payments)})
+    rows.append({'scope': 'version', 'key': 'stats', 'count': 1, 'amount': 0})
+    op.bulk_insert(sa.table('stat_counter', sa.column('scope'), sa.column('key'), sa.column('count'),
+                            sa.column('amount')), rows)
@@ -0,0 +1,36 @@
+"""Keep microseconds in revoked_token.revoked_at
+
+Revision ID: 7a26a656b5e8
+Revises: b58e2f0c7d14
+Create Date: 2026-10-20 09:14:22.530917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = '7a26a656b5e8'
+down_revision = 'b58e2f0c7d14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # MySQL's DATETIME drops fractions of a second; SQLite and PostgreSQL keep microseconds already
+    if op.get_bind().dialect.name != 'mysql':
+        return
+    op.alter_column('revoked_token', 'revoked_at',
+               existing_type=mysql.DATETIME(),
+               type_=mysql.DATETIME(fsp=6),
+               existing_nullable=False)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'mysql':
+        return
+    op.alter_column('revoked_token', 'revoked_at',
+               existing_type=mysql.DATETIME(fsp=6),
+               type_=mysql.DATETIME(),
+               existing_nullable=False)
@@ -0,0 +1,26 @@
+"""Add sales_rollup.buyer_sketch for mergeable distinct buyer counts
+
+Revision ID: 8c3e6a2f1d94
+Revises: 5a0f3b9d7e21
+Create Date: 2026-10-21 14:37:05.209418
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c3e6a2f1d94'
+down_revision = '5a0f3b9d7e21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('sales_rollup', sa.Column('buyer_sketch', sa.LargeBinary(), nullable=True))
+    # Fill the sketches of existing rows: run `flask rollups rebuild` after upgrading
+
+
+def downgrade():
+    with op.batch_alter_table('sales_rollup') as batch_op:
+        batch_op.drop_column('buyer_sketch')
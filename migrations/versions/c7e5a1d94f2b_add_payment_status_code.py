@@ -0,0 +1,42 @@
+"""Add payment.status_code for the small-int payment status
+
+Revision ID: c7e5a1d94f2b
+Revises: 4b9e0d73a5c1
+Create Date: 2026-10-19 14:02:11.418305
+
+Payment status moves from a string to a small int in three revisions, so no
+step holds locks on the whole table: this one adds the nullable column,
+d4a8c2f61e93 fills it in batches and f1b7e3a05c68 swaps it in for ``status``.
+Run the first two while the old release serves. f1b7e3a05c68 needs the app
+stopped, because no release writes both columns (see the README).
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7e5a1d94f2b'
+down_revision = '4b9e0d73a5c1'
+branch_labels = None
+depends_on = None
+
+# A copy of models.PAYMENT_STATUS_CODES as of this revision
+STATUS_CODES = {'PENDING': 0, 'COMPLETED': 1, 'FAILED': 2, 'CANCELLED': 3}
+
+
+def upgrade():
+    payment = sa.table('payment', sa.column('status', sa.String(20)))
+    unknown = op.get_bind().execute(
+        sa.select(payment.c.status, sa.func.count())
+        .where(payment.c.status.is_not(None), payment.c.status.not_in(list(STATUS_CODES)))
+        .group_by(payment.c.status)
+    ).all()
+    if unknown:
+        raise RuntimeError(f"payment.status has values without a code, fix them first: {dict(unknown)}")
+
+    op.add_column('payment', sa.Column('status_code', sa.SmallInteger(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('payment') as batch_op:
+        batch_op.drop_column('status_code')
@@ -0,0 +1,33 @@
+"""Backfill payment.status_code and index payments by buyer
+
+Revision ID: d4a8c2f61e93
+Revises: c7e5a1d94f2b
+Create Date: 2026-10-20 10:32:47.216054
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from online_migration import backfill, create_index, drop_index, forget_backfill
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a8c2f61e93'
+down_revision = 'c7e5a1d94f2b'
+branch_labels = None
+depends_on = None
+
+# A copy of models.PAYMENT_STATUS_CODES as of this revision
+STATUS_CODES = {'PENDING': 0, 'COMPLETED': 1, 'FAILED': 2, 'CANCELLED': 3}
+
+
+def upgrade():
+    backfill('payment_status_code', 'payment',
+             {'status_code': sa.case(STATUS_CODES, value=sa.column('status'), else_=STATUS_CODES['PENDING'])},
+             where=sa.text('status_code IS NULL'))
+    create_index('ix_payment_resource_email_created', 'payment', ['resource_id', 'user_email', 'created_at'])
+
+
+def downgrade():
+    drop_index('ix_payment_resource_email_created', 'payment')
+    forget_backfill('payment_status_code')
@@ -0,0 +1,55 @@
+"""Replace payment.status with the small-int status_code
+
+Revision ID: f1b7e3a05c68
+Revises: d4a8c2f61e93
+Create Date: 2026-10-20 10:51:03.884127
+
+Run with the app stopped. Releases before this revision write only the
+string column and releases after it read ``status`` as the small int, so
+neither can serve while the columns are swapped.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from online_migration import backfill, create_index, drop_index, forget_backfill
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1b7e3a05c68'
+down_revision = 'd4a8c2f61e93'
+branch_labels = None
+depends_on = None
+
+# A copy of models.PAYMENT_STATUS_CODES as of this revision
+STATUS_CODES = {'PENDING': 0, 'COMPLETED': 1, 'FAILED': 2, 'CANCELLED': 3}
+
+
+def upgrade():
+    # Payments created while d4a8c2f61e93 ran
+    backfill('payment_status_code_final', 'payment',
+             {'status_code': sa.case(STATUS_CODES, value=sa.column('status'), else_=STATUS_CODES['PENDING'])},
+             where=sa.text('status_code IS NULL'))
+
+    # Outside SQLite these are plain ALTERs: dropping and renaming a column only
+    # change metadata on PostgreSQL and MySQL 8, and MySQL applies NOT NULL in
+    # place without blocking writes
+    with op.batch_alter_table('payment') as batch_op:
+        batch_op.drop_column('status')
+        batch_op.alter_column('status_code', new_column_name='status',
+                              existing_type=sa.SmallInteger(), nullable=False)
+    create_index('ix_payment_status_created', 'payment', ['status', 'created_at'])
+
+
+def downgrade():
+    drop_index('ix_payment_status_created', 'payment')
+    with op.batch_alter_table('payment') as batch_op:
+        batch_op.alter_column('status', new_column_name='status_code',
+                              existing_type=sa.SmallInteger(), nullable=True)
+    with op.batch_alter_table('payment') as batch_op:
+        batch_op.add_column(sa.Column('status', sa.String(length=20), nullable=True))
+
+    backfill('payment_status_name', 'payment',
+             {'status': sa.case({code: name for name, code in STATUS_CODES.items()}, value=sa.column('status_code'))},
+             where=sa.text('status IS NULL'))
+    forget_backfill('payment_status_name')
+    forget_backfill('payment_status_code_final')
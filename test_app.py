@@ -0,0 +1,1245 @@
+"""
+In-process API tests: the Flask test client against an in-memory SQLite
+database (see conftest.py). Unlike the other test_*.py scripts these need no
+running server or MySQL:
+
+    python -m pytest test_app.py
+"""
+import csv
+import gzip
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import warnings
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.exc import SAWarning
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS
+
+from sql_profiler import assert_max_queries, count_queries, sql_profiler
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend')
+# Cold start: importing app.py and building the app, in a fresh interpreter
+STARTUP_BUDGET_SECONDS = float(os.environ.get('STARTUP_BUDGET_SECONDS', '1.5'))
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+from config import TestConfig
+app.create_app(TestConfig)
+print(json.dumps({'import': imported - started, 'create_app': time.perf_counter() - imported,
+                  'modules': sorted(sys.modules)}))
+"""
+
+# A CPU profile in a gevent-patched process, while a greenlet does the work
+GEVENT_PROFILE_SCRIPT = """
+from gevent import monkey
+monkey.patch_all()
+import sys, tempfile, time
+import gevent
+from profiling import SamplingProfiler
+
+def crunch():
+    deadline = time.monotonic() + 0.6
+    while time.monotonic() < deadline:
+        sum(range(1000))
+
+profiler = SamplingProfiler(tempfile.mkdtemp(), interval=0.005)
+path = profiler.start(0.3)
+gevent.spawn(crunch).join()
+profiler.join()
+sys.stdout.write(open(path).read())
+"""
+
+
+def register_and_login(client, username='reader', password='Str0ng!pass'):
+    client.post('/api/register', json={'username': username, 'email': f'{username}@example.com',
+                                       'password': password})
+    response = client.post('/api/login', json={'username': username, 'password': password})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_index(client):
+    assert client.get('/').status_code == 200
+
+
+def test_resources_within_query_budget(client, resource):
+    with assert_max_queries(4):
+        response = client.get('/api/resources')
+    assert response.status_code == 200
+    titles = [item['title'] for items in response.get_json().values() for item in items]
+    assert resource.title in titles
+
+
+def test_login_and_refresh(client):
+    from auth_tokens import session_tokens
+
+    tokens = register_and_login(client)
+    response = client.post('/api/token/refresh', json={'refresh_token': tokens['refresh_token']})
+    assert response.status_code == 200
+    assert response.get_json()['refresh_token'] != tokens['refresh_token']
+    # A replay is refused by a worker that hasn't seen the revocation yet
+    session_tokens.revocations.clear()
+    replay = client.post('/api/token/refresh', json={'refresh_token': tokens['refresh_token']})
+    assert (replay.status_code, replay.get_json()['error']) == (401, 'Token revoked')
+
+    fresh = response.get_json()
+    logout = {'json': {'refresh_token': fresh['refresh_token']},
+              'headers': {'Authorization': f"Bearer {fresh['access_token']}"}}
+    assert client.post('/api/logout', **logout).status_code == 200
+    session_tokens.revocations.clear()
+    assert client.post('/api/logout', **logout).status_code == 200  # logged out already elsewhere
+
+
+def change_password(client, access_token, old_password, new_password):
+    return client.post('/api/change_password', json={'old_password': old_password, 'new_password': new_password},
+                       headers={'Authorization': f"Bearer {access_token}"})
+
+
+def freeze_token_clock(monkeypatch):
+    """Revocations and the tokens issued with them land in the same microsecond."""
+    import auth_tokens
+
+    now = auth_tokens._now_micros()
+    monkeypatch.setattr(auth_tokens, '_now_micros', lambda: now)
+
+
+def test_password_change_returns_working_tokens(client, monkeypatch):
+    from auth_tokens import session_tokens
+
+    tokens = register_and_login(client)
+    freeze_token_clock(monkeypatch)
+    response = change_password(client, tokens['access_token'], 'Str0ng!pass', 'N3w!password')
+    assert response.status_code == 200
+    session_tokens.revocations.clear()  # as another worker would, reading the cut-off from the database
+    assert change_password(client, response.get_json()['access_token'], 'N3w!password', 'Th1rd!pass').status_code == 200
+    stale = change_password(client, tokens['access_token'], 'Th1rd!pass', 'F0urth!pass')
+    assert (stale.status_code, stale.get_json()['error']) == (401, 'Token revoked')
+
+
+def test_wrong_password_is_rejected(client):
+    register_and_login(client)
+    response = client.post('/api/login', json={'username': 'reader', 'password': 'wrong'})
+    assert response.status_code == 401
+
+
+def test_admin_endpoints_require_admin(client):
+    tokens = register_and_login(client)
+    assert client.get('/api/admin/stats').status_code == 401
+    response = client.get('/api/admin/stats', headers={'Authorization': f"Bearer {tokens['access_token']}"})
+    assert response.status_code == 403
+
+
+def test_login_ignores_case_and_duplicates_are_refused(client):
+    def register(username, email):
+        return client.post('/api/register', json={'username': username, 'email': email, 'password': 'Str0ng!pass'})
+
+    assert register('Reader', 'Reader@Example.com').get_json()['success']
+    for identifier in ('reader', ' READER ', 'reader@example.COM'):
+        response = client.post('/api/login', json={'username': identifier, 'password': 'Str0ng!pass'})
+        assert response.status_code == 200 and response.get_json()['user']['username'] == 'Reader'
+    assert register('READER', 'other@example.com').get_json()['error'] == 'Username or email already exists'
+    assert register('other', 'reader@example.com ').get_json()['error'] == 'Username or email already exists'
+    assert register('reader@example.com', 'third@example.com').get_json()['error'] == 'Username or email already exists'
+
+
+def test_username_may_be_the_users_own_email(client):
+    from models import User, UserIdentifier, db
+
+    assert client.post('/api/register', json={'username': 'Sam@Example.com', 'email': 'sam@example.com',
+                                              'password': 'Str0ng!pass'}).get_json()['success']
+    user = User.find_by_login('sam@example.com', kind='email')  # as a password reset looks it up
+    assert [(i.kind, i.value) for i in user.identifiers] == [('email', 'sam@example.com')]
+    user.username = 'sam'
+    db.session.commit()
+    assert sorted((i.kind, i.value) for i in user.identifiers) == [('email', 'sam@example.com'), ('username', 'sam')]
+    user.email = 'SAM'
+    db.session.commit()
+    assert [(i.kind, i.value) for i in user.identifiers] == [('email', 'sam')]
+    assert UserIdentifier.query.count() == 1
+
+
+def test_identifier_conflicts_are_reported(app):
+    from app import identifier_conflicts_command
+    from models import User, UserIdentifier, db
+
+    db.session.add(User(username='bob', email='bob@example.com', password_hash='x'))
+    db.session.commit()
+    # An account from before identifiers, whose username the backfill skipped: it differs only by case
+    db.session.execute(User.__table__.insert().values(id=2, username='Bob', email='robert@example.com', password_hash='x'))
+    db.session.add(UserIdentifier(user_id=2, kind='email', value='robert@example.com'))
+    db.session.commit()
+    skipped = db.session.get(User, 2)
+    skipped.username = 'Bob'  # unchanged; must not try to claim bob's identifier
+    db.session.commit()
+
+    runner = app.test_cli_runner()
+    output = runner.invoke(identifier_conflicts_command).output
+    assert "User 2 (Bob): username 'bob' is held by user 1" in output
+    db.session.delete(db.session.get(User, 1))
+    db.session.commit()
+    assert '0 conflicts, 1 identifiers added' in runner.invoke(identifier_conflicts_command, ['--fix']).output
+    assert User.find_by_login('BOB').id == 2
+
+
+def test_revocations_committed_out_of_id_order_are_loaded(app):
+    from auth_tokens import RevocationCache
+    from models import RevokedToken, db
+
+    cache = RevocationCache(refresh_seconds=0)
+    expires = datetime.utcnow() + timedelta(hours=1)
+    db.session.add(RevokedToken(id=5, token_id='later-id', expires_at=expires))
+    db.session.commit()
+    cache._refresh_if_stale()
+    assert cache._last_id == 5
+    # Given id 3 before id 5 was, but committed after this worker reloaded
+    db.session.add(RevokedToken(id=3, token_id='earlier-id', expires_at=expires))
+    db.session.commit()
+    cache._refresh_if_stale()
+    assert set(cache._token_ids) == {'later-id', 'earlier-id'} and cache._last_id == 5
+
+
+def test_default_secret_key_is_refused():
+    from app import create_app
+    from config import TestConfig
+
+    for secret in (None, 'dev'):
+        with pytest.raises(RuntimeError, match='SECRET_KEY'):
+            create_app(TestConfig, TESTING=False, SECRET_KEY=secret)
+
+
+def admin_headers(client):
+    from app import ensure_admin_user
+
+    ensure_admin_user('admin', 'admin@example.com', 'Adm1n!pass')
+    tokens = client.post('/api/login', json={'username': 'admin', 'password': 'Adm1n!pass'}).get_json()
+    return {'Authorization': f"Bearer {tokens['access_token']}"}
+
+
+def test_password_hashing_pool_and_busy_rejection():
+    from password_hashing import HashingBusyError, PasswordHasher
+
+    hasher = PasswordHasher('pbkdf2:sha256:1000', workers=1, max_queue=0)
+    try:
+        password_hash = hasher.hash('Str0ng!pass')
+        assert hasher._executor is not None
+        assert password_hash.startswith('pbkdf2:sha256:1000$')
+        assert hasher.verify(password_hash, 'Str0ng!pass') and not hasher.verify(password_hash, 'wrong')
+        # The only slot is taken: the next call is turned away without waiting
+        hasher._slots.acquire()
+        started = time.perf_counter()
+        with pytest.raises(HashingBusyError):
+            hasher.hash('Str0ng!pass')
+        assert time.perf_counter() - started < 0.1
+        hasher._slots.release()
+    finally:
+        hasher.shutdown()
+
+
+def test_busy_hasher_answers_503(client, monkeypatch):
+    from password_hashing import password_hasher
+
+    register_and_login(client)
+    monkeypatch.setattr(password_hasher, '_slots', threading.BoundedSemaphore(1))
+    password_hasher._slots.acquire()
+    response = client.post('/api/login', json={'username': 'reader', 'password': 'Str0ng!pass'})
+    assert (response.status_code, response.headers['Retry-After']) == (503, '1')
+
+
+def test_login_rehashes_after_method_change(client):
+    from models import User
+    from password_hashing import password_hasher
+
+    register_and_login(client)
+    assert User.query.one().password_hash.startswith('pbkdf2:sha256:1000$')
+    password_hasher.configure('pbkdf2:sha256:2000', workers=0, max_queue=8)
+    assert password_hasher.method_prefix == 'pbkdf2:sha256:2000'
+    register_and_login(client)
+    assert User.query.one().password_hash.startswith('pbkdf2:sha256:2000$')
+    # Hashes made with Werkzeug's default costs match the short method name
+    password_hasher.configure('pbkdf2', workers=0, max_queue=8)
+    assert not password_hasher.needs_rehash(f"pbkdf2:sha256:{DEFAULT_PBKDF2_ITERATIONS}$salt$hash")
+
+
+def test_admin_names_are_reserved(client):
+    for username in ('admin', ' Admin '):
+        response = client.post('/api/register', json={'username': username, 'email': 'mallory@example.com',
+                                                      'password': 'Str0ng!pass'})
+        assert (response.status_code, response.get_json()['error']) == (400, 'Username is reserved')
+    assert client.get('/api/admin/stats', headers=admin_headers(client)).status_code == 200
+
+
+def test_gcra_allows_bursts_then_paces():
+    from rate_limit import MemoryBackend, RateLimitPolicy
+
+    policy = RateLimitPolicy.parse('login', '10/minute burst 5')
+    assert (policy.interval, policy.window) == (6, 30)
+    backend = MemoryBackend()
+    results = [backend.hit('login:ip:1', policy.interval, policy.window, now=0)[0] for _ in range(6)]
+    assert results == [True] * 5 + [False]
+    allowed, _, retry_after = backend.hit('login:ip:1', policy.interval, policy.window, now=1)
+    assert (allowed, retry_after) == (False, 5)
+    assert backend.hit('login:ip:1', policy.interval, policy.window, now=6)[0]
+    assert backend.hit('login:ip:2', policy.interval, policy.window, now=6)[0]  # its own bucket
+
+
+def test_rate_limits_by_ip_and_user(client, monkeypatch):
+    from rate_limit import rate_limiter
+
+    bearer = {name: {'Authorization': f"Bearer {register_and_login(client, name)['access_token']}"}
+              for name in ('alice', 'bob')}
+    monkeypatch.setattr(rate_limiter, 'enabled', True)
+
+    def login(ip):
+        return client.post('/api/login', json={'username': 'alice', 'password': 'wrong'},
+                           environ_base={'REMOTE_ADDR': ip})
+    assert [login('10.0.0.1').status_code for _ in range(5)] == [401] * 5
+    limited = login('10.0.0.1')
+    assert (limited.status_code, limited.headers['Retry-After'], limited.headers['RateLimit-Limit']) == (429, '6', '5')
+    assert login('10.0.0.2').status_code == 401
+
+    # Behind one proxy the client is the address the proxy appended
+    monkeypatch.setattr(rate_limiter, 'trusted_proxies', 1)
+    via_proxy = client.post('/api/login', json={'username': 'alice', 'password': 'wrong'},
+                            headers={'X-Forwarded-For': '203.0.113.9, 10.0.0.1'})
+    assert via_proxy.status_code == 429
+    with client.application.test_request_context(headers={'X-Forwarded-For': 'spoofed, 203.0.113.7'}):
+        assert rate_limiter.client_ip() == '203.0.113.7'
+
+    # change_password is keyed by user, so one user's bucket doesn't limit another on the same IP
+    def change(name):
+        return client.post('/api/change_password', json={'old_password': 'wrong', 'new_password': 'N3w!password'},
+                           headers=bearer[name]).status_code
+    assert [change('alice') for _ in range(6)] == [401] * 5 + [429]
+    assert change('bob') == 401
+    assert all(client.get('/healthz').status_code == 200 for _ in range(10))  # exempt
+
+
+def test_shared_rate_limit_table(tmp_path):
+    from rate_limit import SharedMemoryBackend
+
+    path = str(tmp_path / 'ratelimit.bin')
+    first, second = SharedMemoryBackend(path, slots=64), SharedMemoryBackend(path, slots=64)
+    assert [backend.hit('pay:user:1', 1, 2, now=0)[0] for backend in (first, second, first)] == [True, True, False]
+    size = os.path.getsize(path)
+    # Another slot count must not resize a table that running workers have mapped
+    with pytest.raises(RuntimeError):
+        SharedMemoryBackend(path, slots=128)
+    assert os.path.getsize(path) == size
+    assert not second.hit('pay:user:1', 1, 2, now=0)[0]
+
+
+def test_read_replica_routing(tmp_path):
+    from app import create_app
+    from config import TestConfig
+    from database import STICKY_COOKIE, replica_router
+    from models import Resource, db
+
+    app = create_app(TestConfig, SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / 'primary.db'}",
+                     SQLALCHEMY_REPLICA_URIS=[f"sqlite:///{tmp_path / 'replica.db'}"])
+    client = app.test_client()
+    with app.app_context():
+        replica = db.engines['replica_0']
+        db.create_all()
+        db.metadata.create_all(replica)
+        for engine, title in ((db.engine, 'On the primary'), (replica, 'On the replica')):
+            with engine.begin() as connection:
+                connection.execute(Resource.__table__.insert().values(
+                    resource_type='book', class_grade='Form 1', subject='Mathematics', title=title, description=''))
+
+        def titles():
+            response = client.get('/api/resources', query_string={'class': 'Form 1'})
+            assert response.status_code == 200
+            return [row['title'] for row in response.get_json()['all']]
+
+        assert titles() == ['On the replica']
+        # A write goes to the primary and keeps the writer's reads there for a while
+        register_and_login(client)
+        assert client.get_cookie(STICKY_COOKIE) is not None
+        assert titles() == ['On the primary']
+
+        client.delete_cookie(STICKY_COOKIE)
+        with replica.begin() as connection:
+            connection.exec_driver_sql('DROP TABLE resource')
+        # The replica's error is retried on the primary, and the replica sits out
+        assert titles() == ['On the primary']
+        assert replica_router.healthy_replicas() == []
+        db.session.remove()
+        # db is shared by every app in the process; later apps have no replica bind
+        db.metadatas.pop('replica_0')
+
+
+def test_test_mode_payment_unlocks_download(client, resource):
+    from models import OutboxMessage
+
+    response = client.post('/api/pay', json={'resource_id': resource.id, 'email': 'buyer@example.com',
+                                             'amount': 100, 'name': 'Buyer', 'phone': '0712345678'})
+    assert response.status_code == 200
+    order = response.get_json()['orderTrackingId']
+    [receipt] = OutboxMessage.query.all()
+    assert (receipt.recipient, receipt.subject) == ('buyer@example.com', 'Your receipt for Form 1 Mathematics')
+
+    status = client.get('/api/check-payment', query_string={'resource_id': resource.id, 'email': 'buyer@example.com'})
+    assert status.get_json()['payment_status'] == 'COMPLETED'
+    download = client.get(f'/api/download/{resource.id}',
+                          query_string={'email': 'buyer@example.com', 'orderTrackingId': order})
+    assert download.status_code == 200
+
+
+def test_pay_replays_by_idempotency_key(client, resource, monkeypatch):
+    from idempotency import request_fingerprint
+    from models import IdempotencyKey, Payment, db
+
+    order = {'resource_id': resource.id, 'email': 'buyer@example.com', 'amount': 100, 'name': 'Buyer',
+             'phone': '0712345678'}
+    first = client.post('/api/pay', json=order, headers={'Idempotency-Key': 'pay-1'})
+    replay = client.post('/api/pay', json=order, headers={'Idempotency-Key': 'pay-1'})
+    assert replay.headers['Idempotent-Replayed'] == 'true'
+    assert replay.get_json() == first.get_json()
+    assert Payment.query.count() == 1
+    mismatch = client.post('/api/pay', json=dict(order, amount=200), headers={'Idempotency-Key': 'pay-1'})
+    assert mismatch.status_code == 422
+
+    # Claimed by the same request, still running
+    with client.application.test_request_context('/api/pay', method='POST', json=order):
+        fingerprint = request_fingerprint()
+    db.session.add(IdempotencyKey(scope='pay', key='pay-2', fingerprint=fingerprint, created_at=datetime.utcnow(),
+                                  expires_at=datetime.utcnow() + timedelta(hours=1)))
+    db.session.commit()
+    in_flight = client.post('/api/pay', json=order, headers={'Idempotency-Key': 'pay-2'})
+    assert (in_flight.status_code, in_flight.headers['Retry-After']) == (409, '1')
+
+    # A server error releases the key, so the retry runs the view again
+    def fail(*args, **kwargs):
+        raise RuntimeError('database went away')
+    monkeypatch.setattr('app.create_payment_record', fail)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', SAWarning)
+        assert client.post('/api/pay', json=order, headers={'Idempotency-Key': 'pay-3'}).status_code == 500
+        assert IdempotencyKey.query.filter_by(key='pay-3').count() == 0
+        monkeypatch.undo()
+        retry = client.post('/api/pay', json=order, headers={'Idempotency-Key': 'pay-3'})
+    assert retry.status_code == 200 and 'Idempotent-Replayed' not in retry.headers
+    assert Payment.query.count() == 2
+
+
+def test_idempotency_keys_are_scoped_to_the_user(client, resource):
+    from models import IdempotencyKey, Payment
+
+    order = {'resource_id': resource.id, 'email': 'buyer@example.com', 'amount': 100, 'name': 'Buyer',
+             'phone': '0712345678'}
+    reader = {'Authorization': f"Bearer {register_and_login(client)['access_token']}", 'Idempotency-Key': 'pay-1'}
+    writer = {'Authorization': f"Bearer {register_and_login(client, 'writer')['access_token']}",
+              'Idempotency-Key': 'pay-1'}
+    first = client.post('/api/pay', json=order, headers=reader)
+    other = client.post('/api/pay', json=order, headers=writer)
+    assert 'Idempotent-Replayed' not in other.headers
+    assert other.get_json()['orderTrackingId'] != first.get_json()['orderTrackingId']
+    assert client.post('/api/pay', json=order, headers=reader).headers['Idempotent-Replayed'] == 'true'
+    assert Payment.query.count() == 2
+    assert {row.scope for row in IdempotencyKey.query} == {'pay:user:1', 'pay:user:2'}
+
+
+def test_callback_replays_by_idempotency_key(client, resource, monkeypatch):
+    from models import IdempotencyKey, OutboxMessage, Payment
+
+    add_payments(resource, 1)
+    notification = {'order_tracking_id': 'ORDER0', 'transaction_tracking_id': 'TX1', 'payment_status': 'COMPLETED'}
+    headers = {'Idempotency-Key': 'ipn-1'}
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('outbox unavailable')
+    monkeypatch.setattr('app.queue_payment_receipt', fail)
+    assert client.post('/api/pesapal-callback', json=notification, headers=headers).status_code == 500
+    assert IdempotencyKey.query.count() == 0
+    assert Payment.query.one().status == 'PENDING'  # rolled back with the failed request
+    monkeypatch.undo()
+
+    response = client.post('/api/pesapal-callback', json=notification, headers=headers)
+    assert response.get_json()['message'] == 'Callback processed'
+    replay = client.post('/api/pesapal-callback', json=notification, headers=headers)
+    assert replay.headers['Idempotent-Replayed'] == 'true'
+    assert replay.get_json()['message'] == 'Callback processed'
+    assert Payment.query.one().status == 'COMPLETED'
+    assert OutboxMessage.query.count() == 1  # one receipt
+
+
+def test_circuit_breaker_opens_and_closes_on_trials():
+    from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+
+    now = [0.0]
+    breaker = CircuitBreaker('gateway', window_size=4, min_calls=4, failure_rate_threshold=0.5,
+                             slow_call_seconds=5, open_seconds=30, clock=lambda: now[0])
+    for failed in (False, True, False):
+        breaker.record(failed, 0.1, breaker.before_call())
+    assert breaker.state == CLOSED  # fewer than min_calls
+    breaker.record(True, 0.1, breaker.before_call())
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_call()
+    assert error.value.retry_after == 30
+
+    now[0] = 30
+    trial = breaker.before_call()
+    assert trial == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()  # one trial at a time
+    breaker.record(False, 6, trial)  # slow counts as failed
+    assert breaker.state == OPEN
+
+    now[0] = 60
+    breaker.record(False, 0.1, breaker.before_call())
+    assert breaker.state == CLOSED
+    assert breaker.snapshot()['rejected_calls'] == 2
+
+
+def test_circuit_breaker_ignores_calls_from_an_earlier_state():
+    from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+    now = [0.0]
+    breaker = CircuitBreaker('gateway', window_size=2, min_calls=2, open_seconds=30, clock=lambda: now[0])
+    slow_call = breaker.before_call()  # starts while closed
+    for _ in range(2):
+        breaker.record(True, 0.1, breaker.before_call())
+    now[0] = 30
+    assert breaker.state == HALF_OPEN
+    trial = breaker.before_call()
+    # The closed-state call finishing now is not a trial and must not close the circuit
+    breaker.record(False, 0.1, slow_call)
+    assert breaker.state == HALF_OPEN
+    breaker.record(True, 0.1, trial)
+    assert breaker.state == OPEN
+    breaker.record(False, 0.1, trial)  # a late duplicate changes nothing either
+    assert breaker.state == OPEN
+    now[0] = 60
+    breaker.record(False, 0.1, breaker.before_call())
+    assert breaker.state == CLOSED
+
+
+def test_bulkhead_caps_concurrent_calls():
+    from circuit_breaker import Bulkhead, BulkheadFullError
+
+    bulkhead = Bulkhead('gateway', 2)
+    with bulkhead, bulkhead:
+        assert bulkhead.snapshot()['in_flight'] == 2
+        with pytest.raises(BulkheadFullError):
+            with bulkhead:
+                pass
+    with bulkhead:
+        pass
+    assert bulkhead.snapshot() == {'name': 'gateway', 'max_concurrent': 2, 'in_flight': 0, 'rejected_calls': 1}
+
+
+def test_gateway_metrics_require_metrics_token(client):
+    from metrics import metrics
+
+    assert client.get('/api/metrics/gateway').status_code == 401  # no METRICS_TOKEN configured
+    assert client.get('/metrics').status_code == 401
+    metrics.token = 'scrape-secret'
+    try:
+        assert client.get('/api/metrics/gateway').status_code == 401
+        response = client.get('/api/metrics/gateway', headers={'Authorization': 'Bearer scrape-secret'})
+        assert response.get_json()['pesapal']['breaker']['state'] == 'closed'
+    finally:
+        metrics.token = None
+
+
+def sample_value(text, name, **labels):
+    """The value of one sample in a Prometheus text exposition, or 0 if absent."""
+    from prometheus_client.parser import text_string_to_metric_families
+
+    for family in text_string_to_metric_families(text):
+        for sample in family.samples:
+            if sample.name == name and all(sample.labels.get(k) == v for k, v in labels.items()):
+                return sample.value
+    return 0
+
+
+def test_metrics_scrape_counts_requests(client, monkeypatch):
+    from metrics import metrics
+
+    monkeypatch.setattr(metrics, 'token', 'scrape-secret')
+    scrape = {'Authorization': 'Bearer scrape-secret'}
+    route = {'method': 'GET', 'route': '/api/users'}
+    before = client.get('/metrics', headers=scrape).get_data(as_text=True)
+    assert client.get('/api/users').status_code == 200
+    after = client.get('/metrics', headers=scrape).get_data(as_text=True)
+
+    assert sample_value(after, 'http_requests_total', status='200', **route) == \
+        sample_value(before, 'http_requests_total', status='200', **route) + 1
+    assert sample_value(after, 'http_request_duration_seconds_count', **route) == \
+        sample_value(before, 'http_request_duration_seconds_count', **route) + 1
+    assert sample_value(after, 'http_request_duration_seconds_bucket', le='+Inf', **route) == \
+        sample_value(after, 'http_request_duration_seconds_count', **route)
+    assert sample_value(after, 'http_request_db_queries_count', route='/api/users') >= 1
+
+
+def test_traces_propagate_and_export(tmp_path, monkeypatch):
+    import requests
+    from app import create_app, pesapal_post
+    from config import TestConfig
+    from models import db
+    from tracing import tracer
+
+    create_app(TestConfig)
+    assert not tracer.sql_comments  # nothing is exported, so statements stay uncommented
+    trace_file = tmp_path / 'traces.jsonl'
+    app = create_app(TestConfig, TRACE_EXPORT='file', TRACE_FILE=str(trace_file))
+    assert tracer.sql_comments
+    sent = []
+
+    def post(url, **kwargs):
+        sent.append(kwargs['headers'])
+        return SimpleNamespace(status_code=200)
+    monkeypatch.setattr(requests, 'post', post)
+
+    trace_id, parent_id = 'ab' * 16, 'cd' * 8
+    try:
+        with app.app_context():
+            db.create_all()
+            response = app.test_client().get('/api/users', headers={'traceparent': f"00-{trace_id}-{parent_id}-01"})
+            assert response.headers['X-Trace-Id'] == trace_id
+            with app.test_request_context(), tracer.span('checkout') as checkout:
+                pesapal_post('https://pesapal.test/api/Transactions/SubmitOrderRequest', json={})
+            db.session.remove()
+        tracer.stop()
+    finally:
+        tracer.exporter = None
+
+    spans = [json.loads(line) for line in trace_file.read_text().splitlines()]
+    [server] = [span for span in spans if span['kind'] == 'server']
+    assert (server['name'], server['trace_id'], server['parent_id']) == ('GET /api/users', trace_id, parent_id)
+    [outbound] = [span for span in spans if span['kind'] == 'client']
+    assert (outbound['trace_id'], outbound['parent_id']) == (checkout.trace_id, checkout.span_id)
+    assert sent == [{'traceparent': f"00-{checkout.trace_id}-{outbound['span_id']}-01"}]
+
+
+def payment_plans(log):
+    """EXPLAIN QUERY PLAN details for each statement in ``log`` that reads the payment table."""
+    return [' / '.join(row[-1] for row in sql_profiler.explain_plan(statement, parameters))
+            for statement, parameters, _ in log.queries
+            if statement.lstrip().upper().startswith('SELECT') and 'FROM payment' in statement]
+
+
+def add_payments(resource, count=20):
+    from models import Payment, db
+
+    statuses = ['PENDING', 'COMPLETED', 'FAILED', 'CANCELLED']
+    for i in range(count):
+        db.session.add(Payment(order_tracking_id=f"ORDER{i}", resource_id=resource.id, user_email=f"buyer{i % 5}@example.com",
+                               amount=100, status=statuses[i % 4], created_at=datetime(2026, 1, 1) + timedelta(hours=i)))
+    db.session.commit()
+
+
+def test_status_is_stored_as_small_int(app, resource):
+    from models import Payment, db
+
+    add_payments(resource, 4)
+    assert db.session.execute(db.text("SELECT status FROM payment WHERE order_tracking_id = 'ORDER1'")).scalar() == 1
+    assert Payment.query.filter_by(order_tracking_id='ORDER1').one().status == 'COMPLETED'
+    assert Payment.query.filter(Payment.status.in_(['FAILED', 'CANCELLED'])).count() == 2
+
+
+def test_check_payment_seeks_latest_without_sorting(client, resource):
+    add_payments(resource)
+    with count_queries() as log:
+        response = client.get('/api/check-payment', query_string={'resource_id': resource.id, 'email': 'buyer1@example.com'})
+    assert response.get_json()['order_tracking_id'] == 'ORDER16'
+    [plan] = payment_plans(log)
+    assert 'USING INDEX ix_payment_resource_email_created (resource_id=? AND user_email=?)' in plan
+    assert 'TEMP B-TREE' not in plan
+
+
+def test_download_looks_up_order_by_index(client, resource):
+    add_payments(resource)
+    with count_queries() as log:
+        client.get(f'/api/download/{resource.id}', query_string={'email': 'buyer1@example.com', 'orderTrackingId': 'ORDER1'})
+    assert 'USING INDEX ix_payment_order_tracking_id (order_tracking_id=?)' in payment_plans(log)[0]
+
+
+def test_archive_scan_is_index_only(app, resource):
+    from archive import _archivable_ids
+
+    add_payments(resource)
+    with count_queries() as log:
+        rows = _archivable_ids('PENDING', datetime(2026, 1, 1, 10), None, 500)
+    assert len(rows) == 3  # hours 0, 4 and 8
+    [plan] = payment_plans(log)
+    assert 'USING COVERING INDEX ix_payment_status_created (status=? AND created_at<?)' in plan
+    assert 'TEMP B-TREE' not in plan
+
+
+def test_admin_stats_follow_writes(client, resource):
+    from app import create_payment_record
+    from counters import dashboard_stats, rebuild_counters
+    from models import Resource, StatCounter, db
+
+    headers = admin_headers(client)
+    register_and_login(client)
+    create_payment_record('ORDER1', resource.id, 'a@example.com', 100)
+    create_payment_record('ORDER2', resource.id, 'b@example.com', 50)
+    notification = {'order_tracking_id': 'ORDER1', 'transaction_tracking_id': 'TX1', 'payment_status': 'COMPLETED'}
+    assert client.post('/api/pesapal-callback', json=notification).status_code == 200
+    extra = Resource(resource_type='paper', class_grade='Form 4', subject='Physics', title='Gone', description='x')
+    db.session.add(extra)
+    db.session.commit()
+    db.session.delete(extra)
+    db.session.commit()
+
+    response = client.get('/api/admin/stats', headers=headers)
+    stats = response.get_json()
+    assert stats['users'] == {'total': 2}
+    assert (stats['resources']['total'], stats['resources']['by_type']) == (1, {'book': 1})
+    assert stats['payments'] == {'total': 2, 'amount': 150.0, 'by_status': {
+        'COMPLETED': {'count': 1, 'amount': 100.0}, 'PENDING': {'count': 1, 'amount': 50.0}}}
+    assert StatCounter.query.filter_by(scope='version').count() == 0  # nothing every write touches
+
+    revalidate = {**headers, 'If-None-Match': response.headers['ETag']}
+    assert client.get('/api/admin/stats', headers=revalidate).status_code == 304
+    register_and_login(client, 'second')
+    assert client.get('/api/admin/stats', headers=revalidate).status_code == 200
+
+    # Counters are spread over shards; a rebuild puts the same totals in one
+    expected = dashboard_stats()
+    rebuild_counters()
+    assert dashboard_stats() == expected
+    assert StatCounter.query.filter(StatCounter.shard != 0).count() == 0
+
+
+def test_sales_report_counts_repeat_buyers_once(app, resource):
+    from models import Payment, db
+    from rollups import record_payment_change, sales_report
+
+    for i, (email, day) in enumerate([('a@example.com', 1), ('a@example.com', 2), ('b@example.com', 2)]):
+        payment = Payment(order_tracking_id=f"ORDER{i}", resource_id=resource.id, user_email=email, amount=100,
+                          status='COMPLETED', created_at=datetime(2026, 1, day))
+        db.session.add(payment)
+        db.session.flush()
+        record_payment_change(payment, new_status='COMPLETED')
+    db.session.commit()
+
+    start, end = datetime(2026, 1, 1).date(), datetime(2026, 1, 2).date()
+    assert [row['buyers'] for row in sales_report(start, end)] == [1, 2]
+    [row] = sales_report(start, end, group_by=('subject', 'status'))
+    assert (row['payments'], row['buyers']) == (3, 2)
+    assert sales_report(start, end, group_by=(), status='FAILED') == [{'payments': 0, 'amount': 0.0, 'buyers': 0}]
+
+
+def test_sales_report_merges_buyer_sketches(app, resource):
+    from models import Payment, db
+    from rollups import rebuild_rollups, record_payment_change, sales_report
+
+    payments = []
+    for i in range(900):
+        payment = Payment(order_tracking_id=f"ORDER{i}", resource_id=resource.id, user_email=f"buyer{i % 300}@example.com",
+                          amount=100, status='COMPLETED', created_at=datetime(2026, 1, 1 + i // 300))
+        db.session.add(payment)
+        db.session.flush()
+        record_payment_change(payment, new_status='COMPLETED')
+        payments.append(payment)
+    db.session.commit()
+
+    start, end = datetime(2026, 1, 1).date(), datetime(2026, 1, 3).date()
+    [row] = sales_report(start, end, group_by=())
+    assert row['payments'] == 900
+    assert abs(row['buyers'] - 300) <= 30
+
+    # A buyer whose only payment in a bucket changes status leaves that bucket's sketch
+    payments[0].status = 'FAILED'
+    record_payment_change(payments[0], old_status='COMPLETED', new_status='FAILED')
+    db.session.commit()
+    [failed] = sales_report(start, end, group_by=(), status='FAILED')
+    assert failed['buyers'] == 1
+    report = sales_report(start, end, group_by=('day', 'status'))
+    rebuild_rollups(start, end)
+    assert sales_report(start, end, group_by=('day', 'status')) == report
+
+
+def test_archiving_keeps_history_readable(app, resource):
+    from archive import archive_payments
+    from counters import dashboard_stats, rebuild_counters
+    from exports import payment_rows
+    from models import Payment, PaymentArchive
+    from rollups import rebuild_rollups, sales_report
+
+    add_payments(resource)
+    rebuild_rollups()
+    rebuild_counters()
+    day = datetime(2026, 1, 1).date()
+    report, stats = sales_report(day, day, group_by=('status',)), dashboard_stats()
+
+    cutoff = datetime(2026, 1, 1, 10)
+    cutoffs = {'FAILED': cutoff, 'CANCELLED': cutoff, 'PENDING': cutoff}
+    assert archive_payments(cutoffs, batch_size=2, max_batches=1) == {'FAILED': 2, 'CANCELLED': 0, 'PENDING': 0}
+    # The next run carries on; COMPLETED payments and recent ones stay put
+    assert archive_payments(cutoffs, batch_size=2) == {'FAILED': 0, 'CANCELLED': 2, 'PENDING': 3}
+    assert Payment.query.count() == 13
+    assert PaymentArchive.query.filter_by(order_tracking_id='ORDER4').one().status == 'PENDING'
+
+    rebuild_rollups()
+    rebuild_counters()
+    assert sales_report(day, day, group_by=('status',)) == report
+    assert dashboard_stats() == stats
+    assert sorted(row.order_tracking_id for row in payment_rows()) == sorted(f"ORDER{i}" for i in range(20))
+    assert len(list(payment_rows(include_archived=False))) == 13
+
+
+def test_gzipped_payment_export(client, resource, monkeypatch):
+    from sqlalchemy import event
+    from archive import archive_payments
+    from exports import PAYMENT_COLUMNS
+    from models import Payment, db
+
+    add_payments(resource)
+    db.session.add(Payment(order_tracking_id='ORDERX', resource_id=resource.id, user_email='late@example.com',
+                           amount=100, status='COMPLETED', created_at=datetime(2026, 1, 3)))
+    db.session.commit()
+    cutoff = datetime(2026, 1, 1, 10)
+    assert sum(archive_payments({'FAILED': cutoff, 'CANCELLED': cutoff, 'PENDING': cutoff}).values()) == 7
+
+    stream_options = []
+
+    def record_options(conn, cursor, statement, parameters, context, executemany):
+        if 'FROM payment' in statement:
+            stream_options.append((context.execution_options.get('stream_results'),
+                                   context.execution_options.get('yield_per')))
+    event.listen(db.engine, 'before_cursor_execute', record_options)
+    monkeypatch.setattr('exports.ROWS_PER_CHUNK', 4)
+
+    def export(**query):
+        response = client.get('/api/admin/export/payments', query_string=query,
+                              headers={**admin_headers(client), 'Accept-Encoding': 'gzip'})
+        assert (response.status_code, response.headers['Content-Encoding']) == (200, 'gzip')
+        header, *rows = csv.reader(io.StringIO(gzip.decompress(response.data).decode()))
+        assert header == PAYMENT_COLUMNS
+        return [dict(zip(header, row)) for row in rows]
+
+    try:
+        rows = export()
+        assert len(rows) == 21
+        # Archived payments come first, then live ones, each in id order
+        assert [row['order_tracking_id'] for row in rows[:7]] == [f"ORDER{i}" for i in (0, 2, 3, 4, 6, 7, 8)]
+        assert rows[-1]['order_tracking_id'] == 'ORDERX'
+        assert stream_options == [(True, 1000), (True, 1000)]
+
+        pending = export(**{'from': '2026-01-01', 'to': '2026-01-01', 'status': 'PENDING'})
+        assert [row['order_tracking_id'] for row in pending] == ['ORDER0', 'ORDER4', 'ORDER8', 'ORDER12', 'ORDER16']
+        assert {row['status'] for row in pending} == {'PENDING'}
+        assert [row['order_tracking_id'] for row in export(**{'from': '2026-01-02'})] == ['ORDERX']
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record_options)
+
+
+def test_backfill_resumes_from_checkpoint(app, resource, monkeypatch):
+    import sqlalchemy as sa
+    from alembic.migration import MigrationContext
+    from alembic.operations import Operations
+    import online_migration
+    from models import MigrationCheckpoint, Payment, db
+
+    add_payments(resource, 25)
+
+    def migrate(operation, *args, **kwargs):
+        with db.engine.connect() as connection, Operations.context(MigrationContext.configure(connection)):
+            return operation(*args, **kwargs)
+
+    def fill_method():
+        return migrate(online_migration.backfill, 'payment_method_unknown', 'payment', {'payment_method': 'unknown'},
+                       where=sa.text('payment_method IS NULL'), batch_size=10, pause_seconds=0.01)
+
+    def interrupt(seconds):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(online_migration.time, 'sleep', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        fill_method()
+    checkpoint = MigrationCheckpoint.query.filter_by(name='payment_method_unknown').one()
+    assert (checkpoint.rows_done, checkpoint.last_key, checkpoint.finished_at) == (10, 10, None)
+    assert Payment.query.filter_by(payment_method='unknown').count() == 10
+
+    monkeypatch.undo()
+    assert fill_method() == 25
+    assert Payment.query.filter(Payment.payment_method.is_(None)).count() == 0
+    assert fill_method() == 25  # finished, skipped
+
+    assert migrate(online_migration.create_index, 'ix_payment_method', 'payment', ['payment_method'])
+    assert not migrate(online_migration.create_index, 'ix_payment_method', 'payment', ['payment_method'])
+    assert migrate(online_migration.drop_index, 'ix_payment_method', 'payment')
+
+
+def job_runner_for(app, **concurrency):
+    from jobs import JobRunner
+
+    runner = JobRunner()
+    runner.init_app(app)
+    runner.poll_seconds = 0.01
+    runner.queue_concurrency = concurrency
+    return runner
+
+
+def test_jobs_run_retry_and_give_up(app):
+    from jobs import DONE, FAILED, QUEUED
+    from models import Job, Resource, db
+    from tracing import tracer
+
+    runner = job_runner_for(app)
+    seen = []
+
+    @runner.task('add-resource', max_attempts=2)
+    def add_resource(title):
+        seen.append(tracer.current_span().trace_id)
+        db.session.add(Resource(resource_type='book', class_grade='Form 2', subject='English', title=title,
+                                description='Queued'))
+
+    @runner.task('flaky', max_attempts=2)
+    def flaky():
+        raise RuntimeError('gateway down')
+
+    with tracer.span('request') as span:
+        runner.enqueue('add-resource', title='Queued book')
+        runner.enqueue('flaky')
+    db.session.commit()
+    runner.work(['default'], burst=True, schedule=False)
+
+    done, retried = Job.query.order_by(Job.id).all()
+    assert done.status == DONE and done.slot is None
+    assert Resource.query.filter_by(title='Queued book').count() == 1  # committed with the job
+    assert seen == [span.trace_id]
+    assert (retried.status, retried.attempts, retried.last_error) == (QUEUED, 1, 'RuntimeError: gateway down')
+    assert retried.run_at > datetime.utcnow()
+
+    retried.run_at = datetime.utcnow()
+    db.session.commit()
+    runner.work(['default'], burst=True, schedule=False)
+    assert (db.session.get(Job, retried.id).status, retried.attempts) == (FAILED, 2)
+    with pytest.raises(ValueError):
+        runner.enqueue('missing')
+
+
+def test_job_concurrency_and_expired_leases(app):
+    from jobs import RUNNING
+    from models import Job, db
+
+    runner = job_runner_for(app, mail=1)
+    runner.task('send', queue='mail')(lambda: None)
+    for _ in range(2):
+        runner.enqueue('send')
+    db.session.commit()
+
+    first = runner.claim(['mail'], 'worker-a')
+    assert (first.status, first.slot, first.locked_by) == (RUNNING, 0, 'worker-a')
+    assert runner.claim(['mail'], 'worker-b') is None  # the queue's one slot is taken
+
+    # worker-a stops heartbeating; its job is taken over once the lease runs out
+    first.lease_expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    taken = runner.claim(['mail'], 'worker-b')
+    assert (taken.id, taken.locked_by, taken.attempts) == (first.id, 'worker-b', 2)
+    assert not runner._finish(first.id, 'worker-a', {'status': 'done'})
+
+
+def test_job_that_lost_its_lease_commits_nothing(app):
+    from models import Job, Resource, db
+
+    runner = job_runner_for(app)
+
+    @runner.task('add-resource')
+    def add_resource(job_id):
+        db.session.add(Resource(resource_type='book', class_grade='Form 2', subject='English', title='Late',
+                                description='Queued'))
+        # Meanwhile the lease ran out and worker-b took the job over
+        Job.query.filter_by(id=job_id).update({'locked_by': 'worker-b'}, synchronize_session=False)
+
+    job = runner.enqueue('add-resource')
+    db.session.flush()
+    job.payload = json.dumps({'job_id': job.id})
+    db.session.commit()
+    job = runner.claim(['default'], 'worker-a')
+    assert runner.run(job, 'worker-a') is None
+    assert Resource.query.filter_by(title='Late').count() == 0
+
+
+def test_cron_schedules_enqueue_once(app):
+    from jobs import CronSchedule
+    from models import Job
+
+    schedule = CronSchedule('*/15 9-17 * * 1-5')
+    assert schedule.matches(datetime(2026, 10, 19, 9, 45))  # Monday
+    assert not schedule.matches(datetime(2026, 10, 18, 9, 45))  # Sunday
+    assert not schedule.matches(datetime(2026, 10, 19, 18, 0))
+    # Day of month and day of week restricted: either matches
+    assert CronSchedule('0 0 1 * 0').matches(datetime(2026, 10, 18))
+    with pytest.raises(ValueError):
+        CronSchedule('61 * * * *')
+
+    runner = job_runner_for(app)
+    runner.task('report', cron='0 * * * *')(lambda: None)
+    runner.task('paused', cron='* * * * *')(lambda: None)
+    runner.schedules = {'paused': 'off'}
+    since, until = datetime(2026, 10, 19, 8, 30), datetime(2026, 10, 19, 10, 30)
+    assert runner.schedule_due(since, until) == 2
+    assert runner.schedule_due(since, until) == 0  # a second worker's tick
+    assert [job.run_at.hour for job in Job.query.order_by(Job.run_at)] == [9, 10]
+
+
+def test_completed_payment_sends_receipt_and_webhook(client, resource, smtp_sink, tmp_path):
+    from models import Job, OutboxMessage
+    from outbox import outbox
+
+    outbox.webhook_urls = ['https://hooks.example.com/payments']
+    outbox.transport_names['webhook'] = 'file'
+    client.application.config['OUTBOX_FILE_DIR'] = str(tmp_path)
+    add_payments(resource, 1)
+    notification = {'order_tracking_id': 'ORDER0', 'transaction_tracking_id': 'TX1', 'payment_status': 'COMPLETED'}
+    for _ in range(2):  # the repeat is ignored
+        assert client.post('/api/pesapal-callback', json=notification).status_code == 200
+    assert OutboxMessage.query.count() == 2
+    assert Job.query.filter_by(name='deliver-outbox').count() == 1
+    assert smtp_sink.messages == []  # nothing is sent from the request
+
+    assert outbox.deliver() == {'sent': 2, 'retried': 0, 'failed': 0}
+    [mail] = smtp_sink.messages
+    assert (mail['To'], mail['Subject']) == ('buyer0@example.com', 'Your receipt for Form 1 Mathematics')
+    assert 'orderTrackingId=ORDER0' in mail.get_content()
+    [path] = tmp_path.glob('*.json')
+    assert (tmp_path.stat().st_mode & 0o777, path.stat().st_mode & 0o777) == (0o700, 0o600)
+    webhook = json.loads(path.read_text())
+    assert webhook['event'] == 'payment.completed'
+    assert webhook['body']['data']['transaction_tracking_id'] == 'TX1'
+
+
+def test_password_reset_mail_round_trip(client, smtp_sink, monkeypatch):
+    from auth_tokens import session_tokens
+    from outbox import outbox
+
+    register_and_login(client)
+    assert client.post('/api/reset_password', json={'email': 'reader@example.com'}).status_code == 200
+    outbox.deliver()
+    [mail] = smtp_sink.messages
+    token = mail.get_content().split('?token=')[1].split()[0]
+
+    reset = {'token': token, 'new_password': 'N3w!password'}
+    freeze_token_clock(monkeypatch)
+    response = client.post('/api/reset_password/confirm', json=reset)
+    assert response.status_code == 200
+    session_tokens.revocations.clear()
+    assert change_password(client, response.get_json()['access_token'], 'N3w!password', 'N3w!password').status_code == 200
+    replay = client.post('/api/reset_password/confirm', json=dict(reset, new_password='An0ther!pass'))
+    assert replay.get_json()['error'] == 'Token already used'
+    register_and_login(client, password='N3w!password')
+
+
+def test_outbox_reuses_connection_and_retries(app, smtp_sink):
+    from models import OutboxMessage, db
+    from outbox import FAILED, PENDING, SENT, outbox
+
+    smtp_sink.refused_recipients = {'nobody@example.com'}
+    for i in range(4):
+        outbox.send_mail(f"reader{i}@example.com", f"Hello {i}", 'Hi')
+    outbox.send_mail('nobody@example.com', 'Hello', 'Hi')
+    db.session.commit()
+    assert outbox.deliver(batch_size=10) == {'sent': 4, 'retried': 0, 'failed': 1}
+    assert smtp_sink.connections == 1
+    assert OutboxMessage.query.filter_by(recipient='nobody@example.com').one().status == FAILED
+
+    # A dropped connection is reopened; an unreachable server defers the batch
+    smtp_sink.drop_after = 1
+    for i in range(2):
+        outbox.send_mail(f"late{i}@example.com", 'Later', 'Hi')
+    db.session.commit()
+    assert outbox.deliver()['sent'] == 2
+    smtp_sink.stop()
+    outbox.send_mail('reader0@example.com', 'Retry', 'Hi')
+    db.session.commit()
+    assert outbox.deliver() == {'sent': 0, 'retried': 1, 'failed': 0}
+    retry = OutboxMessage.query.filter_by(subject='Retry').one()
+    assert (retry.status, retry.attempts, retry.claimed_by) == (PENDING, 1, None)
+    assert retry.next_attempt_at > datetime.utcnow()
+    assert OutboxMessage.query.filter_by(status=SENT).count() == 6
+
+
+def read_log(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_log_records_are_redacted_json(tmp_path):
+    import logging
+    from logging_config import configure_logging
+
+    pipeline = configure_logging({'LOG_FILE': str(tmp_path / 'app-{pid}.log'), 'LOG_LEVEL': 'INFO'})
+    log = logging.getLogger('checkout')
+    log.info("Auth with password=hunter2 and Authorization: Bearer abc.def", extra={'order': 'ORDER1'})
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        log.exception("Callback failed for token=%s", 's3cret')
+    pipeline.stop()
+
+    first, second = read_log(tmp_path / f"app-{os.getpid()}.log")
+    assert (first['level'], first['logger'], first['order'], first['pid']) == ('INFO', 'checkout', 'ORDER1', os.getpid())
+    assert 'hunter2' not in first['msg'] and 'abc.def' not in first['msg']
+    assert second['msg'] == 'Callback failed for token=***' and 'ZeroDivisionError' in second['exc']
+
+
+def test_sql_profiler_logs_n_plus_one_and_slow_queries(tmp_path):
+    from app import create_app
+    from config import TestConfig
+    from logging_config import logging_pipeline
+    from models import Resource, db
+
+    log_file = tmp_path / 'app-{pid}.log'
+    app = create_app(TestConfig, LOG_FILE=str(log_file), LOG_FORMAT='json', SQL_PROFILER_ENABLED=True,
+                     SQL_N_PLUS_ONE_THRESHOLD=3, SQL_SLOW_QUERY_MS=0, SQL_SERVER_TIMING=True)
+
+    @app.route('/titles')
+    def titles():
+        ids = [resource_id for (resource_id,) in db.session.query(Resource.id)]
+        return {'titles': [db.session.get(Resource, resource_id).title for resource_id in ids]}
+
+    with app.app_context():
+        db.create_all()
+        db.session.add_all(Resource(resource_type='book', class_grade='Form 1', subject='Mathematics',
+                                    title=f"Book {i}", description='') for i in range(4))
+        db.session.commit()
+        response = app.test_client().get('/titles')
+        db.session.remove()
+    logging_pipeline.stop()
+
+    assert response.headers['Server-Timing'].endswith('desc="5 queries"')
+    records = read_log(tmp_path / f"app-{os.getpid()}.log")
+    [n_plus_one] = [record for record in records if record['msg'].startswith('Possible N+1')]
+    assert (n_plus_one['endpoint'], n_plus_one['repeats']) == ('titles', 4)
+    assert n_plus_one['statement'].endswith('FROM resource WHERE resource.id = ?')
+    slow = [record for record in records if record['msg'].startswith('Slow query in titles')]
+    assert len(slow) == 5
+    # Each slow SELECT is logged with SQLite's plan: the lookups by id use the primary key
+    assert all('USING INTEGER PRIMARY KEY' in ' '.join(map(str, record['plan'])) for record in slow[1:])
+
+
+def test_shared_log_file_is_not_rotated(tmp_path):
+    import logging.handlers
+    from logging_config import configure_logging
+
+    pipeline = configure_logging({'LOG_FILE': str(tmp_path / 'app.log'), 'LOG_MAX_BYTES': 1})
+    [file_handler] = [h for h in pipeline.listener.handlers if isinstance(h, logging.FileHandler)]
+    assert type(file_handler) is logging.handlers.WatchedFileHandler
+    pipeline = configure_logging({'LOG_FILE': str(tmp_path / 'app-{pid}.log'), 'LOG_MAX_BYTES': 1})
+    assert any(isinstance(h, logging.handlers.RotatingFileHandler) for h in pipeline.listener.handlers)
+    pipeline.stop()
+
+
+def test_debug_records_are_sampled():
+    import logging
+    from logging_config import SamplingFilter
+
+    def record(level, **extra):
+        entry = logging.LogRecord('jobs', level, __file__, 1, 'msg', (), None)
+        entry.__dict__.update(extra)
+        return entry
+
+    never = SamplingFilter(debug_rate=0.0)
+    assert not never.filter(record(logging.DEBUG))
+    assert never.filter(record(logging.INFO))
+    assert never.filter(record(logging.DEBUG, sample_rate=1.0))  # the call's own rate wins
+    assert SamplingFilter(debug_rate=1.0).filter(record(logging.DEBUG))
+    sampled = sum(SamplingFilter(debug_rate=0.5).filter(record(logging.DEBUG)) for _ in range(1000))
+    assert 350 < sampled < 650
+
+
+def test_full_log_queue_drops_instead_of_blocking():
+    import logging
+    from logging_config import configure_logging
+
+    pipeline = configure_logging({'LOG_FILE': '', 'LOG_QUEUE_SIZE': 2})
+    pipeline.listener.stop()  # nothing drains the queue now
+    try:
+        for i in range(5):
+            logging.getLogger('busy').warning(f"record {i}")
+        assert pipeline.stats() == {'queued': 2, 'dropped': 3}
+    finally:
+        pipeline.listener.start()
+        pipeline.stop()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_forked_worker_restarts_log_listener(tmp_path):
+    import logging
+    from logging_config import configure_logging
+
+    pipeline = configure_logging({'LOG_FILE': str(tmp_path / 'app-{pid}.log'), 'LOG_LEVEL': 'INFO'})
+    logging.getLogger('master').info('before fork')
+    child = os.fork()
+    if child == 0:  # as a gunicorn worker forked from the preloaded app
+        try:
+            logging.getLogger('worker').info('from the worker')
+            pipeline.stop()
+        finally:
+            os._exit(0)
+    os.waitpid(child, 0)
+    pipeline.stop()
+    assert [entry['msg'] for entry in read_log(tmp_path / f"app-{child}.log")] == ['from the worker']
+    assert [entry['msg'] for entry in read_log(tmp_path / f"app-{os.getpid()}.log")] == ['before fork']
+
+
+def test_readiness_waits_for_migrations_and_warmup(app, client, resource):
+    from flask_migrate import stamp
+    from app import get_pesapal_token, init_migrate
+    from health import warmup
+    from pesapal_emulator import EmulatorSettings, PesapalEmulator
+
+    assert client.get('/healthz').status_code == 200
+    response = client.get('/readyz')
+    assert response.status_code == 503  # create_all, never stamped
+    checks = response.get_json()['checks']
+    assert checks['database']['ok'] and not checks['migrations']['ok']
+
+    init_migrate(app)
+    stamp()
+    assert client.get('/readyz').status_code == 200
+
+    emulator = PesapalEmulator(EmulatorSettings(latency_ms=0, latency_jitter_ms=0))
+    app.config.update(PESAPAL_BASE_URL=emulator.start(), PESAPAL_CONSUMER_KEY='key', PESAPAL_CONSUMER_SECRET='secret')
+    try:
+        warmup.enabled = True
+        assert client.get('/readyz').get_json()['checks']['warmup']['ok'] is False
+        results = warmup.run(app)
+        assert all(step['ok'] for step in results.values()), results
+        assert results['catalog']['detail'] == '1 resources, 1 featured'
+        assert client.get('/readyz').status_code == 200
+        # Checkouts reuse the token warmup fetched
+        get_pesapal_token()
+        assert emulator.stats()['token_requests'] == 1
+        get_pesapal_token(refresh=True)
+        assert emulator.stats()['token_requests'] == 2
+    finally:
+        emulator.stop()
+
+
+def test_cpu_profile_sees_running_greenlets():
+    output = subprocess.run([sys.executable, '-c', GEVENT_PROFILE_SCRIPT], cwd=BACKEND, check=True,
+                            capture_output=True, text=True, timeout=30).stdout
+    stacks = dict(line.rsplit(' ', 1) for line in output.splitlines())
+    assert int(stacks.get('__main__:crunch', 0)) > 0
+    assert not any('profiling:' in stack for stack in stacks)
+
+
+def measure_startup():
+    output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd=BACKEND, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_startup_within_budget():
+    runs = [measure_startup() for _ in range(3)]
+    best = min(run['import'] + run['create_app'] for run in runs)
+    assert best < STARTUP_BUDGET_SECONDS
+    # Loaded on first use only
+    for module in ('requests', 'alembic', 'flask_migrate'):
+        assert module not in runs[0]['modules']
@@ -4,6 +4,22 @@ let API_BASE = 'https://books-management-system-bcr5.onrender.com/api';
 // User authentication state
 let currentUser = null;
 
+// Adds the session token from /api/login, when signed in, to request headers
+function withAuth(headers) {
+    const tokens = JSON.parse(localStorage.getItem('authTokens') || 'null');
+    if (tokens && tokens.access_token) {
+        headers['Authorization'] = `Bearer ${tokens.access_token}`;
+    }
+    return headers;
+}
+
+function saveAuthTokens(data) {
+    localStorage.setItem('authTokens', JSON.stringify({
+        access_token: data.access_token,
+        refresh_token: data.refresh_token
+    }));
+}
+
 // Initialize the page
 document.addEventListener('DOMContentLoaded', function() {
     initializePage();
@@ -204,6 +220,13 @@ function setupEventListeners() {
     });
 }
 
+function newIdempotencyKey() {
+    if (window.crypto && window.crypto.randomUUID) {
+        return window.crypto.randomUUID();
+    }
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}${Math.random().toString(36).slice(2)}`;
+}
+
 function handleDownloadSubmit(e) {
     e.preventDefault();
     
@@ -223,17 +246,24 @@ function handleDownloadSubmit(e) {
     
     showDownloadMessage('Processing payment...', 'info');
     
+    const paymentBody = JSON.stringify({
+        resource_id: window.currentDownloadResourceId,
+        email: email,
+        amount: 100,
+        name: name,
+        phone: phone
+    });
+    
+    // Reuse the Idempotency-Key while the same checkout is retried or double-clicked
+    if (!window.paymentIdempotency || window.paymentIdempotency.body !== paymentBody) {
+        window.paymentIdempotency = { body: paymentBody, key: newIdempotencyKey() };
+    }
+    
     // Submit payment request
     fetch(`${API_BASE}/pay`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-            resource_id: window.currentDownloadResourceId,
-            email: email,
-            amount: 100,
-            name: name,
-            phone: phone
-        })
+        headers: withAuth({ 'Content-Type': 'application/json', 'Idempotency-Key': window.paymentIdempotency.key }),
+        body: paymentBody
     })
     .then(res => res.json())
     .then(data => {
@@ -276,6 +306,7 @@ function handleSignIn(e) {
         if (data.success) {
             currentUser = data.user;
             localStorage.setItem('currentUser', JSON.stringify(currentUser));
+            saveAuthTokens(data);
             updateAuthUI();
             closeModal(document.getElementById('signin-modal'));
             alert('Sign in successful!');
@@ -383,6 +414,7 @@ function updateAuthUI() {
 function signOut() {
     currentUser = null;
     localStorage.removeItem('currentUser');
+    localStorage.removeItem('authTokens');
     updateAuthUI();
     alert('Signed out successfully!');
 }
@@ -413,6 +445,7 @@ function closeModal(modal) {
             if (form) form.reset();
             showDownloadMessage('');
             window.currentDownloadResourceId = null;
+            window.paymentIdempotency = null;
         }
     }
 } 
\ No newline at end of file
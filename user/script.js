@@ -19,9 +19,35 @@ function isNullOrEmpty(val) {
 // Add these at the top of the file, outside any function:
 let currentDownloadResourceId = null;
 let downloadFormData = null;
+// One Idempotency-Key per checkout attempt, so retries and the fallback button
+// replay the same payment instead of creating a new one
+let paymentIdempotencyKey = null;
+
+function newIdempotencyKey() {
+    if (window.crypto && window.crypto.randomUUID) {
+        return window.crypto.randomUUID();
+    }
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}${Math.random().toString(36).slice(2)}`;
+}
 let API_BASE = 'https://books-management-system-bcr5.onrender.com/api';
 let currentUser = null; // Add user authentication state
 
+// Adds the session token from /api/login, when signed in, to request headers
+function withAuth(headers) {
+    const tokens = JSON.parse(localStorage.getItem('authTokens') || 'null');
+    if (tokens && tokens.access_token) {
+        headers['Authorization'] = `Bearer ${tokens.access_token}`;
+    }
+    return headers;
+}
+
+function saveAuthTokens(data) {
+    localStorage.setItem('authTokens', JSON.stringify({
+        access_token: data.access_token,
+        refresh_token: data.refresh_token
+    }));
+}
+
 function fetchApiBaseUrl() {
     // API_BASE is already set at the top of the file
     console.log('API Base URL set to:', API_BASE);
@@ -33,6 +59,7 @@ function fetchApiBaseUrl() {
 function resetDownloadState() {
     currentDownloadResourceId = null;
     downloadFormData = null;
+    paymentIdempotencyKey = null;
     // Optionally reset form fields and messages
     const form = document.getElementById('download-form');
     if (form) form.reset();
@@ -284,6 +311,7 @@ function renderGeneralResources(sectionSelector, items, type) {
                 return;
             }
             downloadFormData = { name, email, phone };
+            paymentIdempotencyKey = newIdempotencyKey();
             document.getElementById('download-modal-message').textContent = 'Redirecting to PesaPal for payment...';
             // Show and enable the PesaPal button (for fallback, but we will auto-trigger payment)
             downloadPesapalBtn.style.display = '';
@@ -293,7 +321,7 @@ function renderGeneralResources(sectionSelector, items, type) {
             if (!isNullOrEmpty(currentDownloadResourceId) && downloadFormData) {
                 fetch(`${API_BASE}/pay`, {
                     method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
+                    headers: withAuth({ 'Content-Type': 'application/json', 'Idempotency-Key': paymentIdempotencyKey }),
                     body: JSON.stringify({
                         resource_id: currentDownloadResourceId,
                         email: downloadFormData.email,
@@ -343,7 +371,7 @@ function renderGeneralResources(sectionSelector, items, type) {
             }
             fetch(`${API_BASE}/pay`, {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+                headers: withAuth({ 'Content-Type': 'application/json', 'Idempotency-Key': paymentIdempotencyKey }),
                 body: JSON.stringify({
                     resource_id: currentDownloadResourceId,
                     email: downloadFormData.email,
@@ -485,6 +513,7 @@ function updateAuthUI() {
 
 function signOut() {
     localStorage.removeItem('currentUser');
+    localStorage.removeItem('authTokens');
     currentUser = null;
     updateAuthUI();
     console.log('User signed out');
@@ -531,6 +560,7 @@ function setupModalEventListeners() {
                 if (data.success) {
                     currentUser = data.user;
                     localStorage.setItem('currentUser', JSON.stringify(data.user));
+                    saveAuthTokens(data);
                     updateAuthUI();
                     closeModal(document.getElementById('signin-modal'));
                     signinForm.reset();